@@ -1,19 +1,14 @@
 import streamlit as st
 import json
-import boto3
 from dotenv import load_dotenv
-import os
+
+from bedrock_runtime import get_bedrock_client
 
 # Load environment variables
 load_dotenv()
 
-# Initialize the Bedrock client
-aws_session = boto3.Session(
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("aws_secret_region")
-)
-bedrock_client = aws_session.client(service_name="bedrock-runtime")
+# Shared Bedrock client, created once per process and reused across reruns
+bedrock_client = get_bedrock_client()
 
 # List of required lead details
 REQUIRED_LEAD_DETAILS = {
@@ -1,21 +1,76 @@
 import streamlit as st
 import json
-import boto3
 from dotenv import load_dotenv
 import os
-# from price_estimation import log_chat_new, display_chat_history_new, handle_dynamic_questions, calculate_price
-
+import time
 
-# Load environment variables
+# Load environment variables first: the project modules read their settings when imported
 load_dotenv()
 
-# Initialize the Bedrock client
-aws_session = boto3.Session(
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("aws_secret_region")
+from bedrock_cache import cache_key, cache_stats, cached_call
+from bedrock_executor import run_concurrently
+from bedrock_rate_limit import rate_limit_stats
+from bedrock_runtime import invoke_model, pool_stats, record_usage, usage_stats
+from job_queue import (
+    FINISHED,
+    JOB_INLINE_WAIT,
+    JOB_POLL_SECONDS,
+    job_queue_stats,
+    job_status,
+    register_job_kind,
+    submit_job,
+)
+from lead_extractor import extractor_stats
+from metrics import metrics_summary, observe, session_metrics, start_rerun
+from pricing import calculate_price
+from pricing_questionnaire import (
+    BUSINESS_ENTITIES,
+    FILING_TYPES,
+    LEGAL_STRUCTURES,
+    Question,
+    QuestionFlow,
+    Questionnaire,
+    after_number_of_businesses,
+    after_same_state,
+    after_self_employment,
+    apply_entity_edits,
+    entity_table,
+    finished,
+    read_entity_csv,
+    validate_entities,
 )
-bedrock_client = aws_session.client(service_name="bedrock-runtime")
+from proposal_core import (
+    MODEL_ID,
+    analyze_lead_details,
+    embedded_lead_details,
+    generate_proposal_auto,
+    generate_proposal_cached,
+    is_tax_related,
+)
+from session_model import session_stats
+from profiler import start_rerun_profile, stop_rerun_profile
+from session_store import attach_session, save_session, session_store_stats
+
+# Profile this script run when PROFILE_RERUNS=1, or PROFILE_QUERY=1 and the URL has ?profile=1 (see profiler.py)
+rerun_profile = start_rerun_profile(st.query_params, "matching")
+
+# from price_estimation import log_chat_new, display_chat_history_new, handle_dynamic_questions, calculate_price
+
+
+# Bump when the analyze prompt changes so cached analyses from the old prompt are not reused
+ANALYZE_PROMPT_VERSION = "analyze-matching-v1"
+
+# Stream the proposal as it is generated; set STREAM_PROPOSALS=0 to wait for the full response
+STREAM_PROPOSALS = os.getenv("STREAM_PROPOSALS", "1") == "1"
+
+# Run Bedrock calls as background jobs the page polls; set BACKGROUND_JOBS=0 to call Bedrock in the script run
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") == "1"
+
+# Ask all missing lead details in one form; set BATCHED_QUESTIONS=0 to ask one question per rerun
+BATCHED_QUESTIONS = os.getenv("BATCHED_QUESTIONS", "1") == "1"
+
+# Show Bedrock client statistics (connection pool, result cache, rate limiter, token usage) in the sidebar
+SHOW_BEDROCK_STATS = os.getenv("SHOW_BEDROCK_STATS", "0") == "1"
 
 # List of required lead details
 REQUIRED_LEAD_DETAILS = {
@@ -29,171 +84,174 @@ REQUIRED_LEAD_DETAILS = {
     "States to File Taxes": "Which states do you need to file taxes in?",
 }
 
-# Tax-related keywords
-TAX_KEYWORDS = ["tax", "filing", "tax preparation", "tax filing"]
-
-def is_tax_related(user_input):
-    """Check if the user input relates to tax services."""
-    return any(keyword in user_input.lower() for keyword in TAX_KEYWORDS)
-
-# Initialize session state
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "asked_questions" not in st.session_state:
-    st.session_state.asked_questions = set()
-if "collected_details" not in st.session_state:
-    st.session_state.collected_details = {}
-if "response" not in st.session_state:
-    st.session_state.response = None
-if "final_response" not in st.session_state:
-    st.session_state.final_response = None
-if "asked_questions" not in st.session_state:
-    st.session_state.asked_questions = set()
-if "show_price_estimation_button" not in st.session_state:
-    st.session_state.show_price_estimation_button = False
 
 def log_chat(sender, message):
     """Log chat messages while avoiding duplicates."""
-    if sender == "Bot" and message in st.session_state.asked_questions:
-        return  # Skip if the bot already asked this question
-    st.session_state.chat_history.append({"sender": sender, "message": message})
-    if sender == "Bot":
-        st.session_state.asked_questions.add(message)
+    session.log_chat(sender, message)
 
 def display_chat_history():
     """Display the chat history."""
-    for chat in st.session_state.chat_history:
-        sender, message = chat["sender"], chat["message"]
+    for sender, message in session.chat_log:
         st.markdown(f"**{sender}:** {message}")
         
 # Dynamic questions for price estimation
-def handle_dynamic_questions():
-    """Handle dynamic question flows and store responses."""
-    if "dynamic_details" not in st.session_state:
-        st.session_state.dynamic_details = {}
-
-    # Question 1: Filing Type
-    if "Filing Type" not in st.session_state.dynamic_details:
-        filing_type = st.radio(
-            "Are you filing for Personal, Business, or Both?",
-            ["Personal", "Business", "Both"],
-            key="dynamic_filing_type",
-        )
-        if st.button("Submit Filing Type"):
-            st.session_state.dynamic_details["Filing Type"] = filing_type
-            st.rerun()
-
-    # Personal questions
-    elif st.session_state.dynamic_details["Filing Type"] == "Personal":
-        # State of residence question
-        if "State of Residence" not in st.session_state.dynamic_details:
-            state = st.text_input("What is your state of residence?", key="state_residence")
-            if st.button("Submit State"):
-                st.session_state.dynamic_details["State of Residence"] = state
-                st.rerun()
+def after_filing_type(details):
+    # As before the state machine: "Both" asks no further questions here
+    filing_type = details["Filing Type"]
+    if filing_type == "Personal":
+        return "State of Residence"
+    if filing_type == "Business":
+        return "Number of Businesses"
+    return None
 
-        # Self-employment income question
-        elif "Self Employment Income" not in st.session_state.dynamic_details:
-            self_employment = st.radio(
-                "Did you earn any income through self-employment?",
-                ["Yes-1040-C", "No-1040"],
-                key="self_employment_income",
-            )
-            if st.button("Submit Self Employment Income"):
-                st.session_state.dynamic_details["Self Employment Income"] = self_employment
-                st.rerun()
 
-    # Business questions
-    elif st.session_state.dynamic_details["Filing Type"] == "Business":
-        # Number of businesses
-        if "Number of Businesses" not in st.session_state.dynamic_details:
-            num_businesses = st.number_input(
-                "How many businesses are you filing for?", min_value=1, step=1, key="num_businesses"
-            )
-            if st.button("Submit Number of Businesses"):
-                st.session_state.dynamic_details["Number of Businesses"] = num_businesses
-                st.rerun()
+def after_state_of_residence(details):
+    return "Self Employment Income"
+
+
+# Pricing questions for this app; personal filings also ask the state of residence
+PRICING_FLOW = QuestionFlow(
+    "Filing Type",
+    [
+        Question("Filing Type", "Are you filing for Personal, Business, or Both?", "radio", FILING_TYPES),
+        Question("State of Residence", "What is your state of residence?", "text"),
+        Question("Self Employment Income", "Did you earn any income through self-employment?", "radio", ["Yes-1040-C", "No-1040"]),
+        Question("Number of Businesses", "How many businesses are you filing for?", "number"),
+        Question("Businesses in Same State", "Are all your businesses located in the same state?", "radio", ["Yes", "No"]),
+        Question(BUSINESS_ENTITIES, "Enter the state and legal structure of each business.", "entities", LEGAL_STRUCTURES),
+    ],
+    {
+        "Filing Type": after_filing_type,
+        "State of Residence": after_state_of_residence,
+        "Self Employment Income": after_self_employment,
+        "Number of Businesses": after_number_of_businesses,
+        "Businesses in Same State": after_same_state,
+        BUSINESS_ENTITIES: finished,
+    },
+)
 
-        # Businesses in the same state
-        elif "Businesses in Same State" not in st.session_state.dynamic_details:
-            same_state = st.radio(
-                "Are all your businesses located in the same state?",
-                ["Yes", "No"],
-                key="same_state",
-            )
-            if st.button("Submit Businesses in Same State"):
-                st.session_state.dynamic_details["Businesses in Same State"] = same_state
-                st.rerun()
+# All workflow state of this session (details, responses, chat log, flags) in one compact object,
+# resumed from the session store when the URL carries a ?session= id
+session = attach_session(st.session_state, st.query_params, PRICING_FLOW)
+session.enforce_memory_cap()
 
-        # Legal structure for each business
-        elif st.session_state.dynamic_details["Businesses in Same State"] == "No":
-            for i in range(1, st.session_state.dynamic_details["Number of Businesses"] + 1):
-                if f"Business {i} State" not in st.session_state.dynamic_details:
-                    state = st.text_input(f"What is the state for Business {i}?", key=f"business_{i}_state")
-                    if st.button(f"Submit State for Business {i}"):
-                        st.session_state.dynamic_details[f"Business {i} State"] = state
-                        st.rerun()
-
-                if f"Business {i} Legal Structure" not in st.session_state.dynamic_details:
-                    structure = st.selectbox(
-                        f"What is the legal structure for Business {i}?",
-                        ["Partnership - 1065", "S Corp - 1120-S", "C Corp - 1120"],
-                        key=f"business_{i}_structure"
-                    )
-                    if st.button(f"Submit Legal Structure for Business {i}"):
-                        st.session_state.dynamic_details[f"Business {i} Legal Structure"] = structure
-                        st.rerun()
-
-    return st.session_state.dynamic_details
-
-# Price calculation function
-def calculate_price(dynamic_details):
-    filing_type = dynamic_details.get("Filing Type")
-    price = 0
-    overage_cost = 75
+# Time this script run; metrics recorded on this thread count towards the session
+rerun_span = start_rerun(session.session_id, "matching")
 
-    if filing_type == "Personal":
-        self_employment = dynamic_details.get("Self Employment Income")
-        if self_employment == "Yes-1040-C":
-            price = 350
-        else:
-            price = 300
 
-    elif filing_type == "Business":
-        num_businesses = dynamic_details.get("Number of Businesses", 1)
-        if num_businesses == 1:
-            price = 540
-        else:
-            price = 540 * num_businesses
+def ask_pricing_question(question, details):
+    """Render the widgets of one pricing question."""
+    if question.widget == "radio":
+        st.radio(question.prompt, question.options, key=f"pricing-{question.key}")
+    elif question.widget == "text":
+        st.text_input(question.prompt, key=f"pricing-{question.key}")
+    elif question.widget == "number":
+        st.number_input(question.prompt, min_value=1, step=1, key=f"pricing-{question.key}")
+    else:
+        # Per-business states and legal structures, edited as one table
+        st.write(question.prompt)
+        st.data_editor(
+            entity_table(details.get("Number of Businesses", 1)),
+            key="business-entities",
+            num_rows="dynamic",
+            hide_index=True,
+            column_config={
+                "State": st.column_config.TextColumn("State", help="State name or two-letter code"),
+                "Legal Structure": st.column_config.SelectboxColumn("Legal Structure", options=question.options, required=True),
+            },
+        )
+        st.file_uploader("Or upload a CSV with State and Legal Structure columns", type="csv", key="business-entities-csv")
+        for error in session.entity_errors:
+            st.error(error)
 
-    elif filing_type == "Both":
-        # Separate calculations for each filing type
-        personal_price, business_price = 0, 0
 
-        self_employment = dynamic_details.get("Self Employment Income")
-        if self_employment == "Yes-1040-C":
-            personal_price = 350
+def pricing_answer(question, details):
+    """Read the answer to ``question`` back from its widgets."""
+    if question.widget != "entities":
+        return st.session_state[f"pricing-{question.key}"]
+    # Entities: the uploaded CSV if any, else the editor's edits applied to the blank table
+    upload = st.session_state.get("business-entities-csv")
+    try:
+        if upload is not None:
+            table = read_entity_csv(upload)
         else:
-            personal_price = 300
-
-        num_businesses = dynamic_details.get("Number of Businesses", 1)
-        if num_businesses == 1:
-            business_price = 540
+            table = apply_entity_edits(entity_table(details.get("Number of Businesses", 1)), st.session_state.get("business-entities") or {})
+    except ValueError as e:
+        session.entity_errors = [str(e)]
+        return None
+    entities, session.entity_errors = validate_entities(table)
+    if session.entity_errors:
+        return None
+    return {BUSINESS_ENTITIES: entities, "Number of Businesses": len(table)}
+
+
+def answer_pricing_question():
+    """Next button callback: record the answer before the fragment reruns."""
+    questionnaire = session.questionnaire
+    answer = pricing_answer(questionnaire.current, questionnaire.details)
+    if answer is not None:  # Invalid entities stay on the same question
+        questionnaire.answer(answer)
+        # Fragment reruns do not reach the end of the script, so save here
+        save_session(session)
+
+
+@st.fragment
+def handle_dynamic_questions():
+    """
+    Handle dynamic question flows, store responses and show the price. This
+    runs as a fragment, so answering a question reruns only the questionnaire.
+    """
+    questionnaire = session.questionnaire
+    question = questionnaire.current
+    if question is not None:
+        ask_pricing_question(question, questionnaire.details)
+        st.button(f"Submit {question.key}", key=f"next-{question.key}", on_click=answer_pricing_question)
+
+    dynamic_details = questionnaire.details
+
+    # Ensure all details are complete before calculating the price
+    if "Filing Type" in dynamic_details:
+        if (
+            (dynamic_details["Filing Type"] == "Personal" and "Self Employment Income" in dynamic_details) or
+            (dynamic_details["Filing Type"] == "Business" and "Number of Businesses" in dynamic_details) or
+            (dynamic_details["Filing Type"] == "Both" and "Number of Businesses" in dynamic_details)
+        ):
+            price, overage_cost, total_price = calculate_price(dynamic_details)
+            st.write(f"Service cost: ${price}")
+            st.write(f"Overage cost: ${overage_cost}")
+            st.write(f"Total cost: ${total_price}")
         else:
-            business_price = 540 * num_businesses
+            st.warning("Please complete all required selections for price estimation.")
+    else:
+        st.warning("Filing Type is required for price estimation.")
+
+def commit_missing_details(keys):
+    """Form callback: store every field at once, before the rerun renders."""
+    for key in keys:
+        value = st.session_state.get(f"text-{key}") or ""
+        session.collected_details[key] = value
+        if value:
+            log_chat("User", value)
+        else:
+            session.asked_questions.add(key)  # Mark as answered
 
-        price = personal_price + business_price
 
-    total_price = price + overage_cost
-    return price, overage_cost, total_price
+def collect_missing_details_form(unanswered_keys):
+    """Ask every unanswered question in one form, committed with a single submit."""
+    with st.form("missing-details"):
+        for key in unanswered_keys:
+            question = REQUIRED_LEAD_DETAILS[key]
+            log_chat("Bot", question)
+            st.text_input(question, key=f"text-{key}")
+        st.form_submit_button("Submit", on_click=commit_missing_details, args=(unanswered_keys,))
 
 
 def collect_missing_details_interactive(missing_keys):
     """Iteratively collect missing details in Q&A format and confirm final details."""
-    unanswered_keys = [key for key in missing_keys if key not in st.session_state.collected_details]
+    unanswered_keys = [key for key in missing_keys if key not in session.collected_details]
 
     total_questions = len(missing_keys)
-    asked_questions = len(st.session_state.asked_questions)
+    asked_questions = len(session.asked_questions)
  
     status_bar = "".join(
     ["✅" if i < asked_questions else "⬜" for i in range(total_questions)]
@@ -203,7 +261,10 @@ def collect_missing_details_interactive(missing_keys):
         f"Questions Status: {status_bar} {asked_questions}/{total_questions} questions answered"
     )
     
-    if unanswered_keys:
+    if unanswered_keys and BATCHED_QUESTIONS:
+        collect_missing_details_form(unanswered_keys)
+
+    elif unanswered_keys:
         key = unanswered_keys[0]
         question = REQUIRED_LEAD_DETAILS[key]
 
@@ -214,22 +275,22 @@ def collect_missing_details_interactive(missing_keys):
 
         if st.button("Submit", key=f"submit-{key}"):
             if value:  # Ensure a valid response
-                st.session_state.collected_details[key] = value
+                session.collected_details[key] = value
                 log_chat("User", value)
                 st.rerun()
             if not value:
                 value = ""
-                st.session_state.collected_details[key] = ""
-                st.session_state.asked_questions.add(key)  # Mark as answered
+                session.collected_details[key] = ""
+                session.asked_questions.add(key)  # Mark as answered
                 st.rerun()# Restart the Streamlit app to continue
 
-    elif st.session_state.collected_details:
+    elif session.collected_details:
         st.subheader("Review Your Details")
 
         # Combine available details (from the model) and missing details (Q&A collected)
         combined_details = {
-            **st.session_state.response.get("provided_details", {}),
-            **st.session_state.collected_details,
+            **session.response.get("provided_details", {}),
+            **session.collected_details,
         }
 
         # Create editable fields for each detail
@@ -247,11 +308,11 @@ def collect_missing_details_interactive(missing_keys):
             
             
             # Update the collected details with edits
-            st.session_state.collected_details = edited_details
+            session.collected_details = edited_details
             
             # Update the final response with combined details
-            st.session_state.final_response = combine_responses(
-                st.session_state.response, edited_details
+            session.final_response = combine_responses(
+                session.response, edited_details
             )
             
             # Combine edited details with user input for generating the proposal
@@ -261,29 +322,37 @@ def collect_missing_details_interactive(missing_keys):
                 }
               
 
-            # Generate the analyze details response
-            analyze_response = analyze_details_with_bedrock(
-                json.dumps(edited_details),
-                st.session_state.response)
-
-            # Generate the proposal response
-            proposal_response = generate_proposal(json.dumps(final_data1))
-
-            # Display both responses
+            # Generate the analyze details and proposal responses concurrently;
+            # inputs are bound here because the calls run off the script thread
+            model_response = session.response
+            calls = {
+                "proposal": lambda: generate_proposal_cached(json.dumps(final_data1)),
+                "analyze": lambda: analyze_lead_details(
+                    json.dumps(edited_details), model_response, analyze_details_cached, REQUIRED_LEAD_DETAILS
+                ),
+            }
+
+            # Reserve a slot for each response and fill it as its call finishes
             st.subheader("Generated Proposal Response:")
-            st.json(proposal_response)
+            proposal_slot = st.empty()
             # st.subheader("Analyze Details Response:")
-            st.json(analyze_response)
+            analyze_slot = st.empty()
+            slots = {"proposal": proposal_slot, "analyze": analyze_slot}
+            for slot in slots.values():
+                slot.info("Waiting for model response...")
+
+            for name, result in run_concurrently(calls):
+                slots[name].json(result)
             
              # Set the flag to show the Price Estimation button
-            st.session_state.show_price_estimation_button = True
+            session.show_price_estimation_button = True
 
 
     else:
         st.success("All questions answered!")
         # Combine collected details with the MODEL RESPONSE
-        st.session_state.final_response = combine_responses(
-            st.session_state.response, st.session_state.collected_details
+        session.final_response = combine_responses(
+            session.response, session.collected_details
         )
     return None
 
@@ -311,9 +380,10 @@ def combine_responses(model_response, collected_details):
 
 
 
-def analyze_details_with_bedrock(user_input, model_response):
+def analyze_details_with_bedrock(user_input, model_response, fields=None):
     """
     Analyze user input and model response to extract provided details and identify missing ones using Bedrock.
+    ``fields`` restricts the analysis to a subset of the required lead details.
     """
     prompt = f"""
     You are a highly intelligent assistant responsible for analyzing user input and a model-generated response. Your task is to:
@@ -323,7 +393,7 @@ def analyze_details_with_bedrock(user_input, model_response):
     3. Return a structured JSON output.
 
     The required lead details are:
-    {json.dumps(list(REQUIRED_LEAD_DETAILS.keys()))}
+    {json.dumps(list(fields or REQUIRED_LEAD_DETAILS.keys()))}
 
     Analyze the following inputs:
     - **User Input:** {user_input}
@@ -349,21 +419,16 @@ def analyze_details_with_bedrock(user_input, model_response):
         }
         request_body = json.dumps(request_parameters)
 
-        # Invoke the Bedrock model
-        response = bedrock_client.invoke_model(
-            modelId="anthropic.claude-3-5-sonnet-20240620-v1:0",
-            body=request_body,
-            contentType="application/json"
-        )
-
-        # Decode the response body
-        response_body = response.get("body").read().decode("utf-8")
+        # Invoke the Bedrock model (rate limited, retried on throttling) and decode the body
+        response_body = invoke_model(MODEL_ID, request_body)
 
         if not response_body:
             return {"error": "Empty response from the model"}
 
         # Parse the response content
+        parse_started = time.perf_counter()
         full_response = json.loads(response_body)
+        record_usage(full_response.get("usage"))
         content = full_response.get("content", [])[0].get("text", "")
 
         # Extract JSON from the model response
@@ -373,6 +438,7 @@ def analyze_details_with_bedrock(user_input, model_response):
 
         # Parse the JSON result
         result_json = json.loads(content[start_index:])
+        observe("response_parse_seconds", time.perf_counter() - parse_started, call="matching-analyze")
         return result_json
     
     except json.JSONDecodeError as e:
@@ -381,223 +447,265 @@ def analyze_details_with_bedrock(user_input, model_response):
         return {"error": f"Exception occurred: {str(e)}"}
 
 
-def generate_proposal(user_input):
-    """Generate a tailored financial proposal using Bedrock."""
-    prompt = """    You are FinancialExpertAI, assigned to create a detailed SUMMARY PROPOSAL based on the provided requirements. 
-Your task includes identifying the specific services, required skills, and relevant certifications from the given lists. 
-The summary should be thorough, precise, and tailored to the mentioned requirements and available options.
+def analyze_details_cached(user_input, model_response, fields=None):
+    """
+    Memoized analyze_details_with_bedrock. Streamlit reruns the script on every
+    interaction, so the same analysis is served from the process-wide cache
+    instead of calling Bedrock again.
+    """
+    fields = list(fields or REQUIRED_LEAD_DETAILS)
+    key = cache_key(ANALYZE_PROMPT_VERSION, user_input, model_response, MODEL_ID, fields)
+    return cached_call(
+        key,
+        lambda: analyze_details_with_bedrock(user_input, model_response, fields),
+        namespace="analyze-matching",
+        template_version=ANALYZE_PROMPT_VERSION,
+        model_id=MODEL_ID,
+    )
 
-Required Services:
 
-    - Bookkeeping Clean Up
-    - Accounting Advisory
-    - Monthly Bookkeeping Support
-    - Implementation of Accounting Software
-    - Tax Filing
-    - Tax Preparation
-    - Basic Monthly Bookkeeping Support
-    - Premium Monthly Bookkeeping Support
-    - Plus Monthly Bookkeeping Support
+def run_analysis_job(args, progress):
+    """Background job: this app's lead-detail analysis (see job_queue)."""
+    return analyze_lead_details(args["user_input"], args["response"], analyze_details_cached, REQUIRED_LEAD_DETAILS)
 
-Required Skills:
 
-    - Tax Filing
-    - Accounting
-    - Auditing
-    - Financial Analysis & Management
-    - Data & Analytics
-    - Compliance & Regulation
-    - Soft Skills & General Management
+register_job_kind("matching-analysis", run_analysis_job)
 
-Required Certificates:
 
-    - Accredited in Business Valuations (ABV)
-    - Certified Public Accountant (CPA)
-    - Chartered Financial Analyst (CFA)
-    
-Required Service Lines: 
-
-    - Tax Preparation
-    - CPA/Accounting Advisory
-    - Full Charge Bookkeeping
-    - FP&A
-    - CFO
-
-Instructions:
-
-- **Proposal Description:** Summarize the customer's requirements within this heading. Ensure that all provided information is addressed without adding anything extra.
-- **Required Services:** From the list of available services, identify the specific services needed based on the customer's requirements. Present this as a list.
-- **Required Skills:** Identify the required skills that correspond to the selected services. Present this as a list.
-- **Required Certifications:** Identify the necessary certifications from the provided list based on the identified services and skills. Present this as a list.
-- **Required Software:** Mention any software requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Required Service Line:** From the list of Required Service Lines, identify the specific services needed based on the customer's requirements. Present this as a list. 
-- **Required Language:** Mention any Language requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Required Location and Time Zones:** Mention any location, time zone, or location radius if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Required Teams:** Mention any Teams requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Start/End Dates:** Mention any Start/End Dates or any Timeline requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-
-Return the response as a valid JSON object, **not a string**. The output must follow this exact format:
-
-{
-    "Proposal Description": "<Your detailed summary here>",
-    "Required Services": ["<Service 1>", "<Service 2>", "<Service N>"],
-    "Required Skills": ["<Skill 1>", "<Skill 2>", "<Skill N>"],
-    "Required Certifications": ["<Certification 1>", "<Certification 2>", "<Certification N>"],
-    "Required Software": "<Software name or 'Not Mentioned'>",
-    "Required Service Line": ["<Service Line 1>", "<Service Line 2>", "<Service Line N>"],
-    "Required Language": "<Language or 'Not Mentioned'>",
-    "Required Location and Time Zones": "<Location or 'Not Mentioned'>",
-    "Required Teams": "<Teams or 'Not Mentioned'>",
-    "Start/End Dates": "<Dates or 'Not Mentioned'>"
-}
+def is_tax_input(user_input):
+    """is_tax_related, computed once per distinct input and kept in session state."""
+    if session.tax_checked_input != user_input:
+        session.tax_checked_input = user_input
+        session.is_tax_input = is_tax_related(user_input)
+    return session.is_tax_input
 
-Ensure the response is a valid JSON object, without extra formatting or escape characters."""  # Masked for brevity, same as your provided prompt
-    full_prompt = prompt + "\nUser Input: " + user_input
 
-    try:
-        # Prepare request parameters
-        request_parameters = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 2000,
-            "temperature": 0,
-            "messages": [
-                {"role": "user", "content": full_prompt}
-            ],
-        }
-        request_body = json.dumps(request_parameters)
+def flow_stage():
+    """Step of the flow the page is at (generate, analyze, qa, confirm, pricing or done), to tag profiles."""
+    if not session.process_started:
+        return "generate"
+    if session.tax_checked_input is not None and not session.is_tax_input:
+        return "done"
+    if session.analysis_job is not None or not (session.collected_details or session.missing_keys):
+        return "analyze"
+    if any(key not in session.collected_details for key in session.missing_keys):
+        return "qa"
+    # Pricing starts after the details are confirmed here
+    if not session.price_estimation_started:
+        return "confirm"
+    return "pricing" if session.questionnaire is not None and session.questionnaire.current is not None else "done"
 
-        # Invoke the Bedrock model
-        response = bedrock_client.invoke_model(
-            modelId="anthropic.claude-3-5-sonnet-20240620-v1:0",
-            body=request_body,
-            contentType="application/json"
-        )
 
-        # Read response body
-        response_body = response["body"].read().decode("utf-8")
+def render_proposal_field(slot, key, value):
+    """Render one proposal field into its placeholder."""
+    if isinstance(value, list):
+        slot.markdown(f"**{key}:**\n" + "\n".join(f"- {item}" for item in value))
+    else:
+        slot.markdown(f"**{key}:** {value}")
 
-        # Validate response
-        if not response_body or not response_body.strip():
-            return {"error": "Empty or invalid response from the model"}
 
-        # Parse response content
-        raw_content = json.loads(response_body)
-        content_text = raw_content.get("content")[0]["text"]
-        return json.loads(content_text)  # Final parsed JSON object
+def background_result(job_id, wait=0):
+    """
+    Result of a background job, an error dict if it failed or is gone, or None
+    while it is still queued or running.
+    """
+    job = job_status(job_id, wait)
+    if job is None:
+        return {"error": "The background job was lost, please try again."}
+    if job["status"] == "failed":
+        return {"error": job["error"]}
+    if job["status"] == "done":
+        return job["result"]
+    return None
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def follow_job(job_id, label):
+    """Show a background job's queue position or progress, and rerun the app once it finishes."""
+    job = job_status(job_id)
+    if job is None or job["status"] in FINISHED:
+        st.rerun()
+    if job["status"] == "queued":
+        st.info(f"{label} Waiting in queue: {job['position']} job(s) ahead, {job_queue_stats()['queued']} queued in total.")
+    else:
+        st.progress(job["progress"], text=label)
+        for key, value in (job["partial"] or {}).items():
+            render_proposal_field(st.empty(), key, value)
 
-    except Exception as e:
-        return {"error": f"Exception occurred: {str(e)}"}
+
+def accept_proposal(user_input, response):
+    """Keep a generated proposal in the session, or show its error."""
+    if "error" in response:
+        st.error(f"Error: {response['error']}")
+    else:
+        # A fused response carries the lead details; keep them apart so the proposal reads as usual
+        session.lead_details = embedded_lead_details(response)
+        session.response = response
+        session.user_input = user_input
+        session.process_started = True  # Set process_started to True
+
+
+def lead_analysis(user_input, response):
+    """
+    Lead-detail analysis of the proposal. With BACKGROUND_JOBS, an analysis
+    that needs Bedrock runs as a job and None is returned until it finishes.
+    """
+    if session.lead_details is not None:
+        return session.lead_details
+    if not BACKGROUND_JOBS:
+        # Extract what the rules can and run analyze_details_with_bedrock for the rest
+        with st.spinner("Analyzing details and generating proposal..."):
+            return analyze_lead_details(user_input, response, analyze_details_cached, REQUIRED_LEAD_DETAILS)
+    wait = 0
+    if session.analysis_job is None:
+        session.analysis_job = submit_job("matching-analysis", user_input=user_input, response=response)
+        wait = JOB_INLINE_WAIT
+    result = background_result(session.analysis_job, wait)
+    if result is not None and "error" in result:
+        session.analysis_job = None  # Submitted again on the next run
+    return result
 
 
 
 
 # from price_estimation import log_chat_new, display_chat_history_new, handle_dynamic_questions, calculate_price
 
+# Tagged with the stage the page showed when the user acted, i.e. where the previous run ended
+rerun_profile.tag(st.session_state.get("flow_stage", "generate"), session.session_id)
+
 st.title("Financial Proposal Generator")
 st.write("Enter your business details to generate a tailored financial proposal.")
 
-# Initialize session state variables
-if "response" not in st.session_state:
-    st.session_state.response = None
-if "final_response" not in st.session_state:
-    st.session_state.final_response = None
-if "collected_details" not in st.session_state:
-    st.session_state.collected_details = {}
-if "missing_keys" not in st.session_state:
-    st.session_state.missing_keys = []
-if "show_final_response" not in st.session_state:
-    st.session_state.show_final_response = False
-if "process_started" not in st.session_state:
-    st.session_state.process_started = False
-if "price_estimation_started" not in st.session_state:
-    st.session_state.price_estimation_started = False
+if SHOW_BEDROCK_STATS:
+    with st.sidebar.expander("Bedrock connection pool"):
+        st.json(pool_stats())
+    with st.sidebar.expander("Bedrock result cache"):
+        st.json(cache_stats())
+    with st.sidebar.expander("Bedrock rate limiter"):
+        st.json(rate_limit_stats())
+    with st.sidebar.expander("Bedrock token usage"):
+        st.json(usage_stats())
+    with st.sidebar.expander("Lead detail extractor"):
+        st.json(extractor_stats())
+    with st.sidebar.expander("Session memory"):
+        st.json(session_stats())
+    with st.sidebar.expander("Session store"):
+        st.json(session_store_stats())
+    with st.sidebar.expander("Job queue"):
+        st.json(job_queue_stats())
+    with st.sidebar.expander("Metrics"):
+        st.json(metrics_summary())
+    # Filled at the end of the script, so it includes this run
+    session_metrics_panel = st.sidebar.expander("Session metrics")
+
+# Pricing questionnaire position lives in the session too
+if session.questionnaire is None:
+    session.questionnaire = Questionnaire(PRICING_FLOW, session.dynamic_details)
 
 # Collect user input
-user_input = st.text_area("Enter your requirements for the proposal")
+user_input = st.text_area("Enter your requirements for the proposal", value=session.user_input)
 display_chat_history()
 
 # Only show the "Generate Proposal" button if input is entered and process has not started yet
-if not st.session_state.process_started:
-    if user_input.strip():
+if not session.process_started:
+    if session.proposal_job is None and user_input.strip():
         if st.button("Generate Proposal"):
-            with st.spinner("Generating proposal..."):
-                response = generate_proposal(user_input)  # Replace with your actual function
-                if "error" in response:
-                    st.error(f"Error: {response['error']}")
-                else:
-                    st.session_state.response = response
-                    st.session_state.process_started = True  # Set process_started to True
+            if BACKGROUND_JOBS:
+                # A worker generates it; the page follows the job below, across reruns and refreshes
+                session.user_input = user_input
+                session.proposal_job = submit_job("proposal", user_input=user_input)
+            elif STREAM_PROPOSALS:
+                # One placeholder per field, filled in place as the stream completes it
+                field_slots = {}
+
+                def show_field(key, value):
+                    if key not in field_slots:
+                        field_slots[key] = st.empty()
+                    render_proposal_field(field_slots[key], key, value)
+
+                with st.spinner("Generating proposal..."):
+                    response = generate_proposal_auto(user_input, show_field)
+            else:
+                with st.spinner("Generating proposal..."):
+                    response = generate_proposal_auto(user_input)
+            if not BACKGROUND_JOBS:
+                accept_proposal(user_input, response)
+
+    if session.proposal_job is not None:
+        response = background_result(session.proposal_job, JOB_INLINE_WAIT)
+        if response is None:
+            follow_job(session.proposal_job, "Generating proposal...")
+        else:
+            session.proposal_job = None
+            accept_proposal(session.user_input, response)
 
 # If the process has started, handle tax-related logic or proceed with the flow
-if st.session_state.process_started:
-    if st.session_state.response:
-        response = st.session_state.response
-
-        if is_tax_related(user_input):  # Replace with your tax-checking logic
-            with st.spinner("Analyzing details and generating proposal..."):
-                # Trigger the first model: analyze_details_with_bedrock
-                analysis_result = analyze_details_with_bedrock(user_input, response)  # First model
-                if analysis_result.get("error"):
-                    st.error(f"Error in analysis: {analysis_result['error']}")
-                else:
-                    provided_details = analysis_result.get("provided_details", {})
-                    st.session_state.missing_keys = analysis_result.get("missing_details", [])
-
-                    # Store provided details
-                    st.session_state.collected_details.update(provided_details)
-
-                    # Collect additional details interactively if needed
-                    if st.session_state.missing_keys:
-                        collect_missing_details_interactive(st.session_state.missing_keys)
+if session.process_started:
+    if session.response:
+        response = session.response
+
+        if is_tax_input(user_input):  # Replace with your tax-checking logic
+            # Lead details come with a fused proposal; otherwise lead_analysis runs analyze_details_with_bedrock
+            analysis_result = lead_analysis(user_input, response)  # First model
+            if analysis_result is None:
+                follow_job(session.analysis_job, "Analyzing details...")
+            elif analysis_result.get("error"):
+                st.error(f"Error in analysis: {analysis_result['error']}")
+            else:
+                provided_details = analysis_result.get("provided_details", {})
+                session.missing_keys = analysis_result.get("missing_details", [])
+
+                # Store provided details
+                session.collect(provided_details)
+
+                # Collect additional details interactively if needed
+                if session.missing_keys:
+                    collect_missing_details_interactive(session.missing_keys)
 
             # Display the final combined response
             st.success("This proposal is tax-related. Here's your response:")
-            st.session_state.final_response = response
-            st.session_state.show_final_response = True
+            session.final_response = response
+            session.show_final_response = True
 
         else:
             # If not tax-related, only trigger the proposal model
             st.success("This proposal is not related to tax. Here's your response:")
-            st.session_state.final_response = response
-            st.session_state.show_final_response = True
+            session.final_response = response
+            session.show_final_response = True
             st.subheader("Final Response")
-            st.json(st.session_state.final_response)
+            st.json(session.final_response)
 
 # Display the final combined response only after details are submitted
-# if st.session_state.show_final_response:
-#     st.json(st.session_state.final_response)
+# if session.show_final_response:
+#     st.json(session.final_response)
            
                 
 # Display the generated proposal response if available
-# if st.session_state.final_response:
+# if session.final_response:
 #     st.subheader("Generated Proposal Response:")
-#     st.json(st.session_state.final_response)
+#     st.json(session.final_response)
 # if is_tax_related(user_input):
 # Show the Price Estimation button after confirming details
-if st.session_state.show_price_estimation_button:
+if session.show_price_estimation_button:
     st.subheader("Price Estimation")
-    if is_tax_related(user_input):  # Assuming this function checks if the input is tax-related
+    if is_tax_input(user_input):  # Assuming this function checks if the input is tax-related
         # Button to start price estimation
         if st.button("Start Price Estimation"):
-            st.session_state.price_estimation_started = True
+            session.price_estimation_started = True
 
         # Proceed with price estimation process if button is clicked
-    if st.session_state.price_estimation_started:
-        # Gather additional details interactively
-        dynamic_details = handle_dynamic_questions()
-
-        # Ensure all details are complete before calculating the price
-        if "Filing Type" in dynamic_details:
-            if (
-                (dynamic_details["Filing Type"] == "Personal" and "Self Employment Income" in dynamic_details) or
-                (dynamic_details["Filing Type"] == "Business" and "Number of Businesses" in dynamic_details) or
-                (dynamic_details["Filing Type"] == "Both" and "Number of Businesses" in dynamic_details)
-            ):
-                price, overage_cost, total_price = calculate_price(dynamic_details)
-                st.write(f"Service cost: ${price}")
-                st.write(f"Overage cost: ${overage_cost}")
-                st.write(f"Total cost: ${total_price}")
-            else:
-                st.warning("Please complete all required selections for price estimation.")
-        else:
-            st.warning("Filing Type is required for price estimation.")
\ No newline at end of file
+    if session.price_estimation_started:
+        # Gather additional details interactively and show the price
+        handle_dynamic_questions()
+
+# Persist whatever changed in this run
+save_session(session)
+rerun_span.stop()
+if SHOW_BEDROCK_STATS:
+    session_metrics_panel.json(session_metrics(session.session_id))
+
+# Last, so the profile covers the whole run
+st.session_state["flow_stage"] = flow_stage()
+profile_paths = stop_rerun_profile(rerun_profile)
+if profile_paths:
+    st.sidebar.caption("Profile of this run: " + ", ".join(profile_paths))
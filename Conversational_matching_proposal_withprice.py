@@ -1,169 +1,153 @@
 import streamlit as st
 import json
-import boto3
 from dotenv import load_dotenv
 import os
 
-# Load environment variables
+# Load environment variables first: the project modules read their settings when imported
 load_dotenv()
 
-# Initialize the Bedrock client
-aws_session = boto3.Session(
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("aws_secret_region")
+from bedrock_cache import cache_stats
+from bedrock_executor import run_concurrently
+from bedrock_rate_limit import rate_limit_stats
+from bedrock_runtime import pool_stats, usage_stats
+from job_queue import FINISHED, JOB_INLINE_WAIT, JOB_POLL_SECONDS, job_queue_stats, job_status, submit_job
+from lead_extractor import extractor_stats
+from metrics import metrics_summary, session_metrics, start_rerun
+from pricing import calculate_price
+from pricing_questionnaire import (
+    BUSINESS_ENTITIES,
+    PRICING_FLOW,
+    Questionnaire,
+    apply_entity_edits,
+    entity_table,
+    read_entity_csv,
+    validate_entities,
 )
-bedrock_client = aws_session.client(service_name="bedrock-runtime")
-
-# List of required lead details
-REQUIRED_LEAD_DETAILS = {
-    "Annual Revenue": "What is the approximate annual revenue of your business?",
-    "Industry": "Which industry does your business operate in?",
-    "Entity Type": "What is the entity type of your business (e.g., LLC, Corporation)?",
-    "Publicly Traded": "Is your business publicly traded or privately held?",
-    "Primary Accounting Software": "What is the primary accounting software your business uses (e.g., QuickBooks, Xero)?",
-    "Months to Clean-Up": "How many months of clean-up are needed?",
-    "Year to Be Filed": "Which financial year do you want to file taxes for?",
-    "States to File Taxes": "Which states do you need to file taxes in?",
-}
-
-# Tax-related keywords
-TAX_KEYWORDS = ["tax", "filing", "tax preparation", "tax filing"]
-
-def is_tax_related(user_input):
-    """Check if the user input relates to tax services."""
-    return any(keyword in user_input.lower() for keyword in TAX_KEYWORDS)
-
-# Initialize session state
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "asked_questions" not in st.session_state:
-    st.session_state.asked_questions = set()
-if "collected_details" not in st.session_state:
-    st.session_state.collected_details = {}
-if "response" not in st.session_state:
-    st.session_state.response = None
-if "final_response" not in st.session_state:
-    st.session_state.final_response = None
-if "asked_questions" not in st.session_state:
-    st.session_state.asked_questions = set()
+from proposal_core import (
+    REQUIRED_LEAD_DETAILS,
+    analyze_lead_details,
+    embedded_lead_details,
+    generate_proposal_auto,
+    generate_proposal_cached,
+    is_tax_related,
+    lead_details_for,
+)
+from session_model import session_stats
+from profiler import start_rerun_profile, stop_rerun_profile
+from session_store import attach_session, save_session, session_store_stats
+
+# Profile this script run when PROFILE_RERUNS=1, or PROFILE_QUERY=1 and the URL has ?profile=1 (see profiler.py)
+rerun_profile = start_rerun_profile(st.query_params, "withprice")
+
+# Stream the proposal as it is generated; set STREAM_PROPOSALS=0 to wait for the full response
+STREAM_PROPOSALS = os.getenv("STREAM_PROPOSALS", "1") == "1"
+
+# Run Bedrock calls as background jobs the page polls; set BACKGROUND_JOBS=0 to call Bedrock in the script run
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") == "1"
+
+# Ask all missing lead details in one form; set BATCHED_QUESTIONS=0 to ask one question per rerun
+BATCHED_QUESTIONS = os.getenv("BATCHED_QUESTIONS", "1") == "1"
+
+# Show Bedrock client statistics (connection pool, result cache, rate limiter, token usage) in the sidebar
+SHOW_BEDROCK_STATS = os.getenv("SHOW_BEDROCK_STATS", "0") == "1"
+
+# All workflow state of this session (details, responses, chat log, flags) in one compact object,
+# resumed from the session store when the URL carries a ?session= id
+session = attach_session(st.session_state, st.query_params, PRICING_FLOW)
+session.enforce_memory_cap()
+
+# Time this script run; metrics recorded on this thread count towards the session
+rerun_span = start_rerun(session.session_id, "withprice")
 
 def log_chat(sender, message):
     """Log chat messages while avoiding duplicates."""
-    if sender == "Bot" and message in st.session_state.asked_questions:
-        return  # Skip if the bot already asked this question
-    st.session_state.chat_history.append({"sender": sender, "message": message})
-    if sender == "Bot":
-        st.session_state.asked_questions.add(message)
+    session.log_chat(sender, message)
 
 def display_chat_history():
     """Display the chat history."""
-    for chat in st.session_state.chat_history:
-        sender, message = chat["sender"], chat["message"]
+    for sender, message in session.chat_log:
         st.markdown(f"**{sender}:** {message}")
 
-def calculate_price(dynamic_details):
-    filing_type = dynamic_details.get("Filing Type")
-    price = 0
-    overage_cost = 75
-
-    if filing_type == "Personal":
-        self_employment = dynamic_details.get("Self Employment Income")
-        if self_employment == "Yes-1040-C":
-            price = 350
-        else:
-            price = 300
-
-    elif filing_type == "Business":
-        num_businesses = dynamic_details.get("Number of Businesses", 1)
-        if num_businesses == 1:
-            price = 540
-        else:
-            price = 540 * num_businesses
-
-    elif filing_type == "Both":
-        personal_price, business_price = 0, 0
+def ask_pricing_question(question, details):
+    """Render the widgets of one pricing question."""
+    if question.widget == "selectbox":
+        st.selectbox(question.prompt, question.options, key=f"pricing-{question.key}")
+    elif question.widget == "radio":
+        st.radio(question.prompt, question.options, key=f"pricing-{question.key}")
+    elif question.widget == "number":
+        st.number_input(question.prompt, min_value=1, step=1, key=f"pricing-{question.key}")
+    else:
+        # Per-business states and legal structures, edited as one table
+        st.write(question.prompt)
+        st.data_editor(
+            entity_table(details.get("Number of Businesses", 1)),
+            key="business-entities",
+            num_rows="dynamic",
+            hide_index=True,
+            column_config={
+                "State": st.column_config.TextColumn("State", help="State name or two-letter code"),
+                "Legal Structure": st.column_config.SelectboxColumn("Legal Structure", options=question.options, required=True),
+            },
+        )
+        st.file_uploader("Or upload a CSV with State and Legal Structure columns", type="csv", key="business-entities-csv")
+        for error in session.entity_errors:
+            st.error(error)
 
-        self_employment = dynamic_details.get("Self Employment Income")
-        if self_employment == "Yes-1040-C":
-            personal_price = 350
-        else:
-            personal_price = 300
 
-        num_businesses = dynamic_details.get("Number of Businesses", 1)
-        if num_businesses == 1:
-            business_price = 540
+def pricing_answer(question, details):
+    """Read the answer to ``question`` back from its widgets."""
+    if question.widget != "entities":
+        return st.session_state[f"pricing-{question.key}"]
+    # Entities: the uploaded CSV if any, else the editor's edits applied to the blank table
+    upload = st.session_state.get("business-entities-csv")
+    try:
+        if upload is not None:
+            table = read_entity_csv(upload)
         else:
-            business_price = 540 * num_businesses
-
-        price = personal_price + business_price
-
-    total_price = price + overage_cost
-    return price, overage_cost, total_price
-
-
-def handle_dynamic_questions(step):
-    # Initialize session state if not already set
-    if "dynamic_details" not in st.session_state:
-        st.session_state.dynamic_details = {}
-
-    dynamic_details = st.session_state.dynamic_details
-
-    if step == 1:
-        filing_type = st.selectbox("What is your filing type?", ["Personal", "Business", "Both"], key="filing_type")
-        dynamic_details["Filing Type"] = filing_type
-
-        if st.button("Next", key="step1_next"):
-            st.session_state.dynamic_step = 2
-            st.rerun()
-
-    elif step == 2:
-        filing_type = dynamic_details.get("Filing Type")
-
-        if filing_type in ["Personal", "Both"]:
-            self_employment = st.radio("Do you have self-employment income?", ["Yes-1040-C", "No"], key="self_employment")
-            dynamic_details["Self Employment Income"] = self_employment
-
-        if filing_type in ["Business", "Both"]:
-            num_businesses = st.number_input("How many businesses do you own?", min_value=1, step=1, key="num_businesses")
-            dynamic_details["Number of Businesses"] = num_businesses
-
-            same_state = st.radio("Are all businesses in the same state?", ["Yes", "No"], key="same_state")
-            dynamic_details["Businesses in Same State"] = same_state
-
-            if same_state == "No":
-                for i in range(1, num_businesses + 1):
-                    if f"Business {i} State" not in dynamic_details:
-                        state = st.text_input(f"What is the state for Business {i}?", key=f"business_{i}_state")
-                        if st.button(f"Submit State for Business {i}"):
-                            dynamic_details[f"Business {i} State"] = state
-                            st.rerun()
-
-                    if f"Business {i} Legal Structure" not in dynamic_details:
-                        structure = st.selectbox(
-                            f"What is the legal structure for Business {i}?",
-                            ["Partnership - 1065", "S Corp - 1120-S", "C Corp - 1120"],
-                            key=f"business_{i}_structure"
-                        )
-                        if st.button(f"Submit Legal Structure for Business {i}"):
-                            dynamic_details[f"Business {i} Legal Structure"] = structure
-                            st.rerun()
-
-        # Calculate price without displaying
-        price, overage_cost, total_price = calculate_price(dynamic_details)
-        st.session_state.price_details = {
-            "Base Price": price,
-            "Overage Cost": overage_cost,
-            "Total Price": total_price,
-        }
+            table = apply_entity_edits(entity_table(details.get("Number of Businesses", 1)), st.session_state.get("business-entities") or {})
+    except ValueError as e:
+        session.entity_errors = [str(e)]
+        return None
+    entities, session.entity_errors = validate_entities(table)
+    if session.entity_errors:
+        return None
+    return {BUSINESS_ENTITIES: entities, "Number of Businesses": len(table)}
+
+
+def answer_pricing_question():
+    """Next button callback: record the answer and reprice before the fragment reruns."""
+    questionnaire = session.questionnaire
+    answer = pricing_answer(questionnaire.current, questionnaire.details)
+    if answer is None:  # Invalid entities stay on the same question
+        return
+    questionnaire.answer(answer)
+
+    # Calculate price without displaying
+    price, overage_cost, total_price = calculate_price(questionnaire.details)
+    session.price_details = {
+        "Base Price": price,
+        "Overage Cost": overage_cost,
+        "Total Price": total_price,
+    }
+    # Fragment reruns do not reach the end of the script, so save here
+    save_session(session)
 
-        if st.button("Finish", key="step2_finish"):
-            st.session_state.dynamic_step = 3
-            st.rerun()
 
-    elif step == 3:
+@st.fragment
+def handle_dynamic_questions():
+    """
+    Ask the pricing questions one at a time. This runs as a fragment, so
+    answering a question reruns only the questionnaire, not the whole app.
+    """
+    questionnaire = session.questionnaire
+    question = questionnaire.current
+    if question is None:
         st.success("Confirm Details to see Price along with Proposal Descriptions.")
         # Final details and price are stored in session state for use elsewhere
+        return
+
+    ask_pricing_question(question, questionnaire.details)
+    st.button("Next", key=f"next-{question.key}", on_click=answer_pricing_question)
 
 
 # def run_additional_streamlit_code():
@@ -173,7 +157,7 @@ def handle_dynamic_questions(step):
 #         st.session_state.dynamic_step = 1
 
 #     if "dynamic_details" not in st.session_state:
-#         st.session_state.dynamic_details = {}
+#         session.dynamic_details = {}
 
 #     current_step = st.session_state.dynamic_step
 #     handle_dynamic_questions(current_step)
@@ -188,24 +172,36 @@ def run_additional_streamlit_code():
     # Simulated output from the above Streamlit code
     # st.title("Dynamic Question Handling")
 
-    if "dynamic_step" not in st.session_state:
-        st.session_state.dynamic_step = 1
-
-    if "dynamic_details" not in st.session_state:
-        st.session_state.dynamic_details = {}
-
-    current_step = st.session_state.dynamic_step
-    handle_dynamic_questions(current_step)
+    handle_dynamic_questions()
     additional_output = {"additional_key": "additional_value"}
     return additional_output
 
 
+def commit_missing_details(keys):
+    """Form callback: store every answered field at once, before the rerun renders."""
+    for key in keys:
+        value = st.session_state.get(f"text-{key}")
+        if value:  # Unanswered fields are asked again
+            session.collected_details[key] = value
+            log_chat("User", value)
+
+
+def collect_missing_details_form(unanswered_keys):
+    """Ask every unanswered question in one form, committed with a single submit."""
+    with st.form("missing-details"):
+        for key in unanswered_keys:
+            question = REQUIRED_LEAD_DETAILS[key]
+            log_chat("Bot", question)
+            st.text_input(question, key=f"text-{key}")
+        st.form_submit_button("Submit", on_click=commit_missing_details, args=(unanswered_keys,))
+
+
 def collect_missing_details_interactive(missing_keys):
     """Iteratively collect missing details in Q&A format and confirm final details."""
-    unanswered_keys = [key for key in missing_keys if key not in st.session_state.collected_details]
+    unanswered_keys = [key for key in missing_keys if key not in session.collected_details]
 
     total_questions = len(missing_keys)
-    asked_questions = len(st.session_state.collected_details)
+    asked_questions = len(session.collected_details)
 
     # Progress bar for questions answered
     status_bar = "".join(
@@ -215,7 +211,10 @@ def collect_missing_details_interactive(missing_keys):
         f"Questions Status: {status_bar} {asked_questions}/{total_questions} questions answered"
     )
 
-    if unanswered_keys:
+    if unanswered_keys and BATCHED_QUESTIONS:
+        collect_missing_details_form(unanswered_keys)
+
+    elif unanswered_keys:
         key = unanswered_keys[0]
         question = REQUIRED_LEAD_DETAILS[key]
 
@@ -226,17 +225,17 @@ def collect_missing_details_interactive(missing_keys):
 
         if st.button("Submit", key=f"submit-{key}"):
             if value:  # Ensure a valid response
-                st.session_state.collected_details[key] = value
+                session.collected_details[key] = value
                 log_chat("User", value)
                 st.rerun()  # Re-run to update the state and proceed to the next question
 
-    elif st.session_state.collected_details:
+    elif session.collected_details:
         st.subheader("Review Your Details")
 
         # Combine available details (from the model) and missing details (Q&A collected)
         combined_details = {
-            **st.session_state.response.get("provided_details", {}),
-            **st.session_state.collected_details,
+            **session.response.get("provided_details", {}),
+            **session.collected_details,
         }
 
         # Run additional Streamlit code and append its output
@@ -256,37 +255,42 @@ def collect_missing_details_interactive(missing_keys):
             st.success("Details confirmed! Analyzing details and generating proposal...")
 
             # Update the collected details with edits
-            st.session_state.collected_details = edited_details
+            session.collected_details = edited_details
 
             # Update the final response with combined details
-            st.session_state.final_response = combine_responses(
-                st.session_state.response, edited_details
+            session.final_response = combine_responses(
+                session.response, edited_details
             )
 
             # Combine edited details with user input for generating the proposal
             final_data = {
-                "user_input": st.session_state.user_input,  # Add the original user input
+                "user_input": session.user_input,  # Add the original user input
                 "edited_details": edited_details,  # Add the finalized edited details
             }
 
-            # Generate the analyze details response
-            analyze_response = analyze_details_with_bedrock(
-                json.dumps(edited_details),
-                st.session_state.response
-            )
-
-            # Generate the proposal response
-            proposal_response = generate_proposal(json.dumps(final_data))
+            # Generate the analyze details and proposal responses concurrently;
+            # inputs are bound here because the calls run off the script thread
+            model_response = session.response
+            calls = {
+                "proposal": lambda: generate_proposal_cached(json.dumps(final_data)),
+                "analyze": lambda: analyze_lead_details(json.dumps(edited_details), model_response),
+            }
 
-            # Display both responses
+            # Reserve a slot for each response and fill it as its call finishes
             st.subheader("Generated Proposal Response:")
-            st.json(proposal_response)
+            proposal_slot = st.empty()
             st.subheader("Additional Details collected:")
-            st.json(analyze_response)
+            analyze_slot = st.empty()
+            slots = {"proposal": proposal_slot, "analyze": analyze_slot}
+            for slot in slots.values():
+                slot.info("Waiting for model response...")
+
+            for name, result in run_concurrently(calls):
+                slots[name].json(result)
 
             # Add Price Details as JSON (Only if tax-related)
-            if is_tax_related(st.session_state.user_input):  # Assuming user input is stored in session state
-                price, overage_cost, total_price = calculate_price(st.session_state.dynamic_details)
+            if is_tax_input(session.user_input):  # Assuming user input is stored in session state
+                price, overage_cost, total_price = calculate_price(session.dynamic_details)
 
                 # Create a dictionary for price details
                 price_details = {
@@ -300,18 +304,18 @@ def collect_missing_details_interactive(missing_keys):
                 # st.json(price_details)
 
                 # Update session state for price details (if needed for future use)
-                st.session_state.price_details = price_details
+                session.price_details = price_details
 
             # Display the final price details section alongside other responses
             st.subheader("Estimated Price Details:")
             st.write("Here are the estimated price details:")
-            st.json(st.session_state.price_details)
+            st.json(session.price_details)
 
     else:
         st.success("All questions answered!")
         # Combine collected details with the model response
-        st.session_state.final_response = combine_responses(
-            st.session_state.response, st.session_state.collected_details
+        session.final_response = combine_responses(
+            session.response, session.collected_details
         )
     return None
 
@@ -340,320 +344,229 @@ def combine_responses(model_response, collected_details):
 
 
 
-def analyze_details_with_bedrock(user_input, model_response):
-    """
-    Analyze user input and model response to extract provided details and identify missing ones using Bedrock.
-    """
-    prompt = f"""
-    You are a highly intelligent assistant responsible for analyzing user input and a model-generated response. Your task is to:
-
-    1. Extract any lead details provided in either the user input or the model response.
-    2. Identify missing details based on the required lead details list and ask questions to collect them.
-    3. Return a structured JSON output.
-
-    The required lead details are:
-    {json.dumps(list(REQUIRED_LEAD_DETAILS.keys()))}
+def is_tax_input(user_input):
+    """is_tax_related, computed once per distinct input and kept in session state."""
+    if session.tax_checked_input != user_input:
+        session.tax_checked_input = user_input
+        session.is_tax_input = is_tax_related(user_input)
+    return session.is_tax_input
 
-    Analyze the following inputs:
-    - **User Input:** {user_input}
-    - **Model Response:** {json.dumps(model_response)}
 
-    Return the results as a JSON object with these keys:
-    - "provided_details": A dictionary of all extracted lead details.
-    - "missing_details": A list of missing lead details, if any.
-    """
+def flow_stage():
+    """Step of the flow the page is at (generate, analyze, qa, pricing, confirm or done), to tag profiles."""
+    if not session.process_started:
+        return "generate"
+    if session.tax_checked_input is not None and not session.is_tax_input:
+        return "done"
+    if session.analysis_job is not None or not (session.collected_details or session.missing_keys):
+        return "analyze"
+    if any(key not in session.collected_details for key in session.missing_keys):
+        return "qa"
+    # Pricing questions come before the confirm button here
+    if session.questionnaire is not None and session.questionnaire.current is not None:
+        return "pricing"
+    return "done" if session.show_final_response else "confirm"
 
-    try:
-        # Prepare the request parameters
-        request_parameters = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 1000,
-            "temperature": 0,
-            "messages": [{"role": "user", "content": prompt}],
-        }
-        request_body = json.dumps(request_parameters)
 
-        # Invoke the Bedrock model
-        response = bedrock_client.invoke_model(
-            modelId="anthropic.claude-3-5-sonnet-20240620-v1:0",
-            body=request_body,
-            contentType="application/json"
-        )
-
-        # Decode the response body
-        response_body = response.get("body").read().decode("utf-8")
-
-        if not response_body:
-            return {"error": "Empty response from the model"}
-
-        # Debugging: log the raw response
-        # st.write("Raw model response:", response_body)
-
-        # Check if the response body contains valid JSON and strip extra content
-        try:
-            # Extract the first valid JSON object from the response
-            start_index = response_body.find("{")
-            if start_index == -1:
-                return {"error": "No JSON object found in model response"}
-
-            # Extract the valid JSON string
-            valid_json_str = response_body[start_index:]
-
-            # Parse the valid JSON
-            result_json = json.loads(valid_json_str)
-
-            # Log the parsed JSON for further debugging
-            # st.write("Parsed model response:", result_json)
-        except json.JSONDecodeError as e:
-            return {"error": f"JSON parsing error: {str(e)}"}
-
-        # Access the 'content' field and parse the details from the first item
-        model_content = result_json.get("content", [])
-        if not model_content:
-            return {"error": "No content found in model response"}
-
-        content = model_content[0].get("text", "")
-        # Extract the valid JSON part from the content
-        json_start_index = content.find("{")
-        json_end_index = content.rfind("}") + 1  # Ensure the full JSON is captured
-
-        if json_start_index == -1 or json_end_index == -1:
-            return {"error": "No valid JSON object found in content"}
-
-        # Extract the JSON string and parse it
-        valid_json_str = content[json_start_index:json_end_index]
-        try:
-            details_json = json.loads(valid_json_str)
-        except json.JSONDecodeError as e:
-            return {"error": f"Error extracting JSON from content: {str(e)}"}
-
-        # Now, extract the provided and missing details
-        provided_details = details_json.get("provided_details", {})
-        missing_details = details_json.get("missing_details", [])
-
-        if not provided_details and not missing_details:
-            return {"error": "No provided or missing details found in model response"}
-
-        return {
-            "provided_details": provided_details,
-            "missing_details": missing_details
-        }
-
-    except Exception as e:
-        return {"error": f"Exception occurred: {str(e)}"}
-
-
-
-
-def generate_proposal(user_input):
-    """Generate a tailored financial proposal using Bedrock."""
-    prompt = """    You are FinancialExpertAI, assigned to create a detailed SUMMARY PROPOSAL based on the provided requirements. 
-Your task includes identifying the specific services, required skills, and relevant certifications from the given lists. 
-The summary should be thorough, precise, and tailored to the mentioned requirements and available options.
-
-Required Services:
-
-    - Bookkeeping Clean Up
-    - Accounting Advisory
-    - Monthly Bookkeeping Support
-    - Implementation of Accounting Software
-    - Tax Filing
-    - Tax Preparation
-    - Basic Monthly Bookkeeping Support
-    - Premium Monthly Bookkeeping Support
-    - Plus Monthly Bookkeeping Support
-
-Required Skills:
+def render_proposal_field(slot, key, value):
+    """Render one proposal field into its placeholder."""
+    if isinstance(value, list):
+        slot.markdown(f"**{key}:**\n" + "\n".join(f"- {item}" for item in value))
+    else:
+        slot.markdown(f"**{key}:** {value}")
 
-    - Tax Filing
-    - Accounting
-    - Auditing
-    - Financial Analysis & Management
-    - Data & Analytics
-    - Compliance & Regulation
-    - Soft Skills & General Management
 
-Required Certificates:
+def background_result(job_id, wait=0):
+    """
+    Result of a background job, an error dict if it failed or is gone, or None
+    while it is still queued or running.
+    """
+    job = job_status(job_id, wait)
+    if job is None:
+        return {"error": "The background job was lost, please try again."}
+    if job["status"] == "failed":
+        return {"error": job["error"]}
+    if job["status"] == "done":
+        return job["result"]
+    return None
 
-    - Accredited in Business Valuations (ABV)
-    - Certified Public Accountant (CPA)
-    - Chartered Financial Analyst (CFA)
-    
-Required Service Lines: 
-
-    - Tax Preparation
-    - CPA/Accounting Advisory
-    - Full Charge Bookkeeping
-    - FP&A
-    - CFO
-
-Instructions:
-
-- **Proposal Description:** Summarize the customer's requirements within this heading. Ensure that all provided information is addressed without adding anything extra.
-- **Required Services:** From the list of available services, identify the specific services needed based on the customer's requirements. Present this as a list.
-- **Required Skills:** Identify the required skills that correspond to the selected services. Present this as a list.
-- **Required Certifications:** Identify the necessary certifications from the provided list based on the identified services and skills. Present this as a list.
-- **Required Software:** Mention any software requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Required Service Line:** From the list of Required Service Lines, identify the specific services needed based on the customer's requirements. Present this as a list. 
-- **Required Language:** Mention any Language requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Required Location and Time Zones:** Mention any location, time zone, or location radius if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Required Teams:** Mention any Teams requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-- **Start/End Dates:** Mention any Start/End Dates or any Timeline requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
-
-Return the response as a valid JSON object, **not a string**. The output must follow this exact format:
-
-{
-    "Proposal Description": "<Your detailed summary here>",
-    "Required Services": ["<Service 1>", "<Service 2>", "<Service N>"],
-    "Required Skills": ["<Skill 1>", "<Skill 2>", "<Skill N>"],
-    "Required Certifications": ["<Certification 1>", "<Certification 2>", "<Certification N>"],
-    "Required Software": "<Software name or 'Not Mentioned'>",
-    "Required Service Line": ["<Service Line 1>", "<Service Line 2>", "<Service Line N>"],
-    "Required Language": "<Language or 'Not Mentioned'>",
-    "Required Location and Time Zones": "<Location or 'Not Mentioned'>",
-    "Required Teams": "<Teams or 'Not Mentioned'>",
-    "Start/End Dates": "<Dates or 'Not Mentioned'>"
-}
-
-Ensure the response is a valid JSON object, without extra formatting or escape characters."""  # Masked for brevity, same as your provided prompt
-    full_prompt = prompt + "\nUser Input: " + user_input
 
-    try:
-        # Prepare request parameters
-        request_parameters = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 2000,
-            "temperature": 0,
-            "messages": [
-                {"role": "user", "content": full_prompt}
-            ],
-        }
-        request_body = json.dumps(request_parameters)
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def follow_job(job_id, label):
+    """Show a background job's queue position or progress, and rerun the app once it finishes."""
+    job = job_status(job_id)
+    if job is None or job["status"] in FINISHED:
+        st.rerun()
+    if job["status"] == "queued":
+        st.info(f"{label} Waiting in queue: {job['position']} job(s) ahead, {job_queue_stats()['queued']} queued in total.")
+    else:
+        st.progress(job["progress"], text=label)
+        for key, value in (job["partial"] or {}).items():
+            render_proposal_field(st.empty(), key, value)
 
-        # Invoke the Bedrock model
-        response = bedrock_client.invoke_model(
-            modelId="anthropic.claude-3-5-sonnet-20240620-v1:0",
-            body=request_body,
-            contentType="application/json"
-        )
 
-        # Read response body
-        response_body = response["body"].read().decode("utf-8")
+def accept_proposal(user_input, response):
+    """Keep a generated proposal in the session, or show its error."""
+    if "error" in response:
+        st.error(f"Error: {response['error']}")
+    else:
+        # A fused response carries the lead details; keep them apart so the proposal reads as usual
+        session.lead_details = embedded_lead_details(response)
+        session.response = response
+        session.user_input = user_input
+        session.process_started = True
 
-        # Validate response
-        if not response_body or not response_body.strip():
-            return {"error": "Empty or invalid response from the model"}
 
-        # Parse response content
-        raw_content = json.loads(response_body)
-        content_text = raw_content.get("content")[0]["text"]
-        return json.loads(content_text)  # Final parsed JSON object
+def lead_analysis(user_input, response):
+    """
+    Lead-detail analysis of the proposal. With BACKGROUND_JOBS, an analysis
+    that needs Bedrock runs as a job and None is returned until it finishes.
+    """
+    if session.lead_details is not None:
+        return session.lead_details
+    if not BACKGROUND_JOBS:
+        with st.spinner("Analyzing details and generating proposal..."):
+            return lead_details_for(user_input, response)
+    wait = 0
+    if session.analysis_job is None:
+        session.analysis_job = submit_job("analysis", user_input=user_input, response=response)
+        wait = JOB_INLINE_WAIT
+    result = background_result(session.analysis_job, wait)
+    if result is not None and "error" in result:
+        session.analysis_job = None  # Submitted again on the next run
+    return result
 
-    except Exception as e:
-        return {"error": f"Exception occurred: {str(e)}"}
-    
 # st.write(response)
 
+# Tagged with the stage the page showed when the user acted, i.e. where the previous run ended
+rerun_profile.tag(st.session_state.get("flow_stage", "generate"), session.session_id)
+
 # Streamlit App
 st.title("Financial Proposal Generator")
 st.write("Enter your business details to generate a tailored financial proposal.")
 
-# Initialize session state variables
-if "response" not in st.session_state:
-    st.session_state.response = None
-if "final_response" not in st.session_state:
-    st.session_state.final_response = None
-if "collected_details" not in st.session_state:
-    st.session_state.collected_details = {}
-if "missing_keys" not in st.session_state:
-    st.session_state.missing_keys = []
-if "show_final_response" not in st.session_state:
-    st.session_state.show_final_response = False
-if "process_started" not in st.session_state:
-    st.session_state.process_started = False
-if "dynamic_step" not in st.session_state:
-    st.session_state.dynamic_step = 1
-if "dynamic_details" not in st.session_state:
-    st.session_state.dynamic_details = {}
-if "user_input" not in st.session_state:
-    st.session_state.user_input = ""
-if "price_details" not in st.session_state:
-    st.session_state.price_details = {}
+if SHOW_BEDROCK_STATS:
+    with st.sidebar.expander("Bedrock connection pool"):
+        st.json(pool_stats())
+    with st.sidebar.expander("Bedrock result cache"):
+        st.json(cache_stats())
+    with st.sidebar.expander("Bedrock rate limiter"):
+        st.json(rate_limit_stats())
+    with st.sidebar.expander("Bedrock token usage"):
+        st.json(usage_stats())
+    with st.sidebar.expander("Lead detail extractor"):
+        st.json(extractor_stats())
+    with st.sidebar.expander("Session memory"):
+        st.json(session_stats())
+    with st.sidebar.expander("Session store"):
+        st.json(session_store_stats())
+    with st.sidebar.expander("Job queue"):
+        st.json(job_queue_stats())
+    with st.sidebar.expander("Metrics"):
+        st.json(metrics_summary())
+    # Filled at the end of the script, so it includes this run
+    session_metrics_panel = st.sidebar.expander("Session metrics")
+
+# Pricing questionnaire position lives in the session too
+if session.questionnaire is None:
+    session.questionnaire = Questionnaire(PRICING_FLOW, session.dynamic_details)
 
 # Collect user input
-user_input = st.text_area("Enter your requirements for the proposal")
+user_input = st.text_area("Enter your requirements for the proposal", value=session.user_input)
 display_chat_history()
 
 # Only show the "Generate Proposal" button if input is entered and process has not started yet
-if not st.session_state.process_started:
-    if user_input.strip():
+if not session.process_started:
+    if session.proposal_job is None and user_input.strip():
         if st.button("Generate Proposal"):
-            with st.spinner("Generating proposal..."):
-                response = generate_proposal(user_input)  # Replace with your actual function
-                if "error" in response:
-                    st.error(f"Error: {response['error']}")
-                else:
-                    st.session_state.response = response
-                    st.session_state.user_input = user_input
-                    st.session_state.process_started = True
+            if BACKGROUND_JOBS:
+                # A worker generates it; the page follows the job below, across reruns and refreshes
+                session.user_input = user_input
+                session.proposal_job = submit_job("proposal", user_input=user_input)
+            elif STREAM_PROPOSALS:
+                # One placeholder per field, filled in place as the stream completes it
+                field_slots = {}
+
+                def show_field(key, value):
+                    if key not in field_slots:
+                        field_slots[key] = st.empty()
+                    render_proposal_field(field_slots[key], key, value)
+
+                with st.spinner("Generating proposal..."):
+                    response = generate_proposal_auto(user_input, show_field)
+            else:
+                with st.spinner("Generating proposal..."):
+                    response = generate_proposal_auto(user_input)
+            if not BACKGROUND_JOBS:
+                accept_proposal(user_input, response)
+
+    if session.proposal_job is not None:
+        response = background_result(session.proposal_job, JOB_INLINE_WAIT)
+        if response is None:
+            follow_job(session.proposal_job, "Generating proposal...")
+        else:
+            session.proposal_job = None
+            accept_proposal(session.user_input, response)
 
 # If the process has started, handle tax-related logic or proceed with the flow
-if st.session_state.process_started:
-    if st.session_state.response:
-        response = st.session_state.response
-
-        if is_tax_related(st.session_state.user_input):  # Check if input is tax-related
-            with st.spinner("Analyzing details and generating proposal..."):
-                # Trigger the first model: analyze_details_with_bedrock
-                analysis_result = analyze_details_with_bedrock(
-                    st.session_state.user_input, response
-                )  # First model
-                if analysis_result.get("error"):
-                    st.error(f"Error in analysis: {analysis_result['error']}")
+if session.process_started:
+    if session.response:
+        response = session.response
+
+        if is_tax_input(session.user_input):  # Check if input is tax-related
+            # Lead details come with a fused proposal; otherwise run analyze_details_with_bedrock
+            analysis_result = lead_analysis(
+                session.user_input, response
+            )  # First model
+            if analysis_result is None:
+                follow_job(session.analysis_job, "Analyzing details...")
+            elif analysis_result.get("error"):
+                st.error(f"Error in analysis: {analysis_result['error']}")
+            else:
+                provided_details = analysis_result.get("provided_details", {})
+                missing_details = analysis_result.get("missing_details", [])
+
+                # Update session state with provided and missing details
+                session.collect(provided_details)
+                session.missing_keys = missing_details
+
+                # Continue with collecting missing details or showing results
+                if session.missing_keys:
+                    collect_missing_details_interactive(session.missing_keys)
                 else:
-                    provided_details = analysis_result.get("provided_details", {})
-                    missing_details = analysis_result.get("missing_details", [])
-
-                    # Update session state with provided and missing details
-                    st.session_state.collected_details.update(provided_details)
-                    st.session_state.missing_keys = missing_details
-
-                    # Continue with collecting missing details or showing results
-                    if st.session_state.missing_keys:
-                        collect_missing_details_interactive(st.session_state.missing_keys)
-                    else:
-                        # Handle dynamic questions for tax-related details
-                        current_step = st.session_state.dynamic_step
-                        handle_dynamic_questions(current_step)
-
-                        # If dynamic questions are completed, calculate and display price
-                        if current_step == 3:
-                            price, overage_cost, total_price = calculate_price(
-                                st.session_state.dynamic_details
-                            )
-                            st.session_state.price_details = {
-                                "Base Price": price,
-                                "Overage Cost": overage_cost,
-                                "Total Price": total_price,
-                            }
+                    # Handle dynamic questions for tax-related details; the price is
+                    # kept up to date in session state as they are answered
+                    handle_dynamic_questions()
 
         else:
             # If not tax-related, only trigger the proposal model
             st.success("This proposal is not related to tax. Here's your response:")
-            st.session_state.final_response = response
-            st.session_state.show_final_response = True
+            session.final_response = response
+            session.show_final_response = True
 
 # Display the final combined response only after details are submitted
-if st.session_state.show_final_response:
+if session.show_final_response:
     st.subheader("Final Combined Response")
-    st.json(st.session_state.final_response)
+    st.json(session.final_response)
 
     # # Only show price details for tax-related inputs
-    # if is_tax_related(st.session_state.user_input):
+    # if is_tax_related(session.user_input):
     #     st.subheader("Final Price Details:")
-    #     if st.session_state.price_details:
-    #         st.write("Base Price:", st.session_state.price_details.get("Base Price", "N/A"))
-    #         st.write("Overage Cost:", st.session_state.price_details.get("Overage Cost", "N/A"))
-    #         st.write("Total Price:", st.session_state.price_details.get("Total Price", "N/A"))
+    #     if session.price_details:
+    #         st.write("Base Price:", session.price_details.get("Base Price", "N/A"))
+    #         st.write("Overage Cost:", session.price_details.get("Overage Cost", "N/A"))
+    #         st.write("Total Price:", session.price_details.get("Total Price", "N/A"))
     #     else:
     #         st.write("No price details available.")
+
+# Persist whatever changed in this run
+save_session(session)
+rerun_span.stop()
+if SHOW_BEDROCK_STATS:
+    session_metrics_panel.json(session_metrics(session.session_id))
+
+# Last, so the profile covers the whole run
+st.session_state["flow_stage"] = flow_stage()
+profile_paths = stop_rerun_profile(rerun_profile)
+if profile_paths:
+    st.sidebar.caption("Profile of this run: " + ", ".join(profile_paths))
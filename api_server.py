@@ -0,0 +1,281 @@
+"""
+Headless JSON API for proposals, lead-detail analysis and pricing.
+
+The Streamlit apps rerun a whole script per interaction; this server exposes
+the same operations to other systems (e.g. the CRM) as plain HTTP endpoints on
+one tornado event loop:
+
+- ``POST /proposal`` ``{"user_input": "..."}``: the proposal (fused with the
+  lead details for tax-related input) and ``is_tax_related``
+- ``POST /proposal/stream``: the same, streamed as newline-delimited JSON, one
+  ``{"field": ..., "value": ...}`` line per completed proposal field and a final
+  ``{"done": true, "proposal": {...}}`` line
+- ``POST /analysis`` ``{"user_input": "...", "proposal": {...}}``: provided and
+  missing lead details (``proposal`` is optional)
+- ``POST /price`` ``{"dynamic_details": {...}}`` or ``{"quotes": [...]}``, with
+  an optional ``rate_version``
+- ``GET /health``, ``GET /stats`` and ``GET /metrics`` (Prometheus text format)
+
+Bedrock calls run on the shared executor (bedrock_executor), so the event loop
+never blocks and the process-wide rate limiter, result cache and connection
+pool apply as in the apps. At most API_MAX_CONCURRENCY requests are handled at
+once; others wait up to API_QUEUE_TIMEOUT seconds for a slot and then get 503.
+
+    python3 api_server.py --port 8080
+"""
+import argparse
+import datetime
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.queues
+import tornado.web
+from dotenv import load_dotenv
+from tornado.util import TimeoutError as QueueTimeout
+
+# Load environment variables first: the project modules read their settings when imported
+load_dotenv()
+
+from bedrock_cache import cache_stats
+from bedrock_executor import get_executor
+from bedrock_rate_limit import rate_limit_stats
+from bedrock_runtime import usage_stats
+from lead_extractor import extractor_stats
+from metrics import observe, prometheus_text
+from pricing import RATE_VERSION, calculate_price, price_quotes
+from proposal_core import generate_proposal_auto, is_tax_related, lead_details_for
+
+# Requests handled at the same time; Bedrock calls among them are further capped by BEDROCK_MAX_WORKERS
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "64"))
+# Seconds a request waits for a free slot before it is rejected with 503
+API_QUEUE_TIMEOUT = float(os.getenv("API_QUEUE_TIMEOUT", "5"))
+# Largest request body accepted, in bytes
+API_MAX_BODY_BYTES = int(os.getenv("API_MAX_BODY_BYTES", str(1024 * 1024)))
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "rejected": 0, "errors": 0, "in_flight": 0, "seconds": 0.0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def api_stats():
+    """Request counters of this server process and the mean time of requests that were served."""
+    with _stats_lock:
+        stats = dict(_stats)
+    # Rejected requests never got a slot and are not part of the mean
+    finished = stats["requests"] - stats["rejected"] - stats["in_flight"]
+    stats["mean_seconds"] = round(stats.pop("seconds") / finished, 3) if finished else None
+    stats["max_concurrency"] = API_MAX_CONCURRENCY
+    return stats
+
+
+def run_blocking(fn, *args):
+    """Run a blocking call on the shared Bedrock executor and return an awaitable of its result."""
+    return tornado.ioloop.IOLoop.current().run_in_executor(get_executor(), fn, *args)
+
+
+class JSONHandler(tornado.web.RequestHandler):
+    """Base handler: JSON bodies in and out, and a slot of the concurrency limit per request."""
+
+    def initialize(self, slots):
+        self.slots = slots
+        self.holds_slot = False
+        self.started = time.perf_counter()
+
+    async def prepare(self):
+        _count("requests")
+        try:
+            await self.slots.acquire(timeout=datetime.timedelta(seconds=API_QUEUE_TIMEOUT))
+        except QueueTimeout:
+            _count("rejected")
+            self.set_header("Retry-After", str(max(1, round(API_QUEUE_TIMEOUT))))
+            self.send_error(503, reason="Server busy")
+            return
+        self.holds_slot = True
+        _count("in_flight")
+
+    def on_finish(self):
+        if self.holds_slot:
+            self.holds_slot = False
+            self.slots.release()
+            _count("in_flight", -1)
+            _count("seconds", time.perf_counter() - self.started)
+        observe("api_request_seconds", time.perf_counter() - self.started, path=self.request.path, status=self.get_status())
+
+    def json_body(self):
+        """The parsed JSON object of the request body; a bad body is a 400."""
+        if len(self.request.body) > API_MAX_BODY_BYTES:
+            raise tornado.web.HTTPError(413, reason="Request body too large")
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, reason="Request body must be a JSON object")
+        return body
+
+    def user_input(self, body):
+        user_input = body.get("user_input")
+        if not isinstance(user_input, str) or not user_input.strip():
+            raise tornado.web.HTTPError(400, reason="user_input is required")
+        return user_input
+
+    def write_json(self, payload, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(payload, ensure_ascii=False))
+
+    def write_result(self, result, **extra):
+        """Write an operation result; an ``error`` result from Bedrock is a 502."""
+        if "error" in result:
+            _count("errors")
+            self.write_json({"error": result["error"]}, status=502)
+        else:
+            self.write_json({**result, **extra} if extra else result)
+
+    def write_error(self, status_code, **kwargs):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"error": self._reason}))
+
+
+class ProposalHandler(JSONHandler):
+    async def post(self):
+        user_input = self.user_input(self.json_body())
+        proposal = await run_blocking(generate_proposal_auto, user_input)
+        if "error" in proposal:
+            self.write_result(proposal)
+        else:
+            self.write_result({"proposal": proposal}, is_tax_related=is_tax_related(user_input))
+
+
+class ProposalStreamHandler(JSONHandler):
+    """Stream proposal fields as NDJSON lines as soon as each one is complete."""
+
+    async def post(self):
+        user_input = self.user_input(self.json_body())
+        loop = tornado.ioloop.IOLoop.current()
+        fields = tornado.queues.Queue()
+
+        def on_field(key, value):
+            # Called on the executor thread; hand the field to the event loop
+            loop.add_callback(fields.put_nowait, {"field": key, "value": value})
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        future = run_blocking(generate_proposal_auto, user_input, on_field)
+        future.add_done_callback(lambda f: loop.add_callback(fields.put_nowait, None))
+        while True:
+            line = await fields.get()
+            if line is None:
+                break
+            self.write(json.dumps(line, ensure_ascii=False) + "\n")
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                return  # The client went away; the proposal still finishes on the executor
+
+        proposal = future.result()
+        if "error" in proposal:
+            _count("errors")
+            last = {"done": True, "error": proposal["error"]}
+        else:
+            last = {"done": True, "proposal": proposal, "is_tax_related": is_tax_related(user_input)}
+        self.finish(json.dumps(last, ensure_ascii=False) + "\n")
+
+
+class AnalysisHandler(JSONHandler):
+    async def post(self):
+        body = self.json_body()
+        user_input = self.user_input(body)
+        proposal = body.get("proposal") or {}
+        if not isinstance(proposal, dict):
+            raise tornado.web.HTTPError(400, reason="proposal must be a JSON object")
+        self.write_result(await run_blocking(lead_details_for, user_input, proposal))
+
+
+class PriceHandler(JSONHandler):
+    """Pricing is table lookups, so it runs on the event loop without the executor."""
+
+    def post(self):
+        body = self.json_body()
+        version = body.get("rate_version") or RATE_VERSION
+        try:
+            if "quotes" in body:
+                if not isinstance(body["quotes"], list):
+                    raise tornado.web.HTTPError(400, reason="quotes must be a list")
+                quotes = pd.json_normalize([quote if isinstance(quote, dict) else {} for quote in body["quotes"]], max_level=0)
+                prices = price_quotes(quotes, version)
+                self.write_json({"prices": json.loads(prices.to_json(orient="records"))})
+                return
+            details = body.get("dynamic_details")
+            if not isinstance(details, dict):
+                raise tornado.web.HTTPError(400, reason="dynamic_details is required")
+            price, overage_cost, total_price = calculate_price(details, version)
+        except KeyError as e:
+            raise tornado.web.HTTPError(400, reason=str(e).strip("'\""))
+        except (TypeError, ValueError) as e:
+            raise tornado.web.HTTPError(400, reason=f"Invalid pricing details: {e}")
+        self.write_json({"Base Price": price, "Overage Cost": overage_cost, "Total Price": total_price, "Rate Version": version})
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({"status": "ok"})
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(
+            {
+                "api": api_stats(),
+                "bedrock_usage": usage_stats(),
+                "result_cache": cache_stats(),
+                "rate_limiter": rate_limit_stats(),
+                "lead_extractor": extractor_stats(),
+            }
+        )
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(prometheus_text())
+
+
+def make_app(max_concurrency=None):
+    """Build the tornado application; requests share one concurrency limit."""
+    slots = {"slots": tornado.locks.Semaphore(max_concurrency or API_MAX_CONCURRENCY)}
+    return tornado.web.Application(
+        [
+            (r"/proposal", ProposalHandler, slots),
+            (r"/proposal/stream", ProposalStreamHandler, slots),
+            (r"/analysis", AnalysisHandler, slots),
+            (r"/price", PriceHandler, slots),
+            (r"/health", HealthHandler),
+            (r"/stats", StatsHandler),
+            (r"/metrics", MetricsHandler),
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON API for proposals, lead-detail analysis and pricing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    make_app().listen(args.port, args.host, max_body_size=API_MAX_BODY_BYTES)
+    print(f"Serving on http://{args.host}:{args.port}")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Content-addressed result cache for Bedrock calls.
+
+Streamlit re-executes the app script on every interaction, so any model call
+made while rendering is repeated on each rerun. Results are keyed on a hash of
+everything that determines the model output (prompt template version, inputs,
+model id) and kept for the lifetime of the process, so an identical request
+reaches Bedrock only once and is shared by every session.
+
+Because the prompts run with ``temperature: 0``, results are also written to a
+SQLite file so repeat requests are served after a restart. Disk entries expire
+after a TTL, the file is bounded by least-recently-used eviction, and entries
+written under an older prompt template or model id are purged the first time
+the current template is used.
+
+Misses go through a single-flight layer, so concurrent identical requests from
+different sessions share one Bedrock call.
+"""
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from cachetools import LRUCache
+
+from bedrock_singleflight import SingleFlight
+from metrics import count
+
+# Maximum number of results kept in memory per process
+MAX_ENTRIES = int(os.getenv("BEDROCK_CACHE_MAX_ENTRIES", "1024"))
+# SQLite file for the persistent cache; set to an empty string to disable it
+CACHE_PATH = os.getenv("BEDROCK_CACHE_PATH", "bedrock_cache.sqlite3")
+# Seconds a persisted result stays valid (0 keeps entries until evicted)
+CACHE_TTL = int(os.getenv("BEDROCK_CACHE_TTL", str(7 * 24 * 3600)))
+# Maximum number of results kept on disk before the least recently used are evicted
+DISK_MAX_ENTRIES = int(os.getenv("BEDROCK_DISK_CACHE_MAX_ENTRIES", "10000"))
+
+_results = LRUCache(maxsize=MAX_ENTRIES)
+_lock = threading.Lock()
+_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+_inflight = SingleFlight()
+
+
+def canonicalize(value):
+    """Serialize a value to a stable JSON string (sorted keys, no whitespace)."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def cache_key(*parts):
+    """Return a SHA-256 hex digest over the canonical form of the given parts."""
+    return hashlib.sha256(canonicalize(list(parts)).encode("utf-8")).hexdigest()
+
+
+def normalize_text(text):
+    """Collapse whitespace so inputs that differ only in spacing share a cache entry."""
+    return " ".join(text.split())
+
+
+class PersistentCache:
+    """
+    SQLite-backed result store with TTL expiry and LRU eviction.
+
+    A single connection is shared by all threads behind a lock; WAL mode lets
+    several app processes on the same host read while one writes.
+    """
+
+    def __init__(self, path, ttl=CACHE_TTL, max_entries=DISK_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"expired": 0, "evicted": 0, "invalidated": 0}
+        self._lock = threading.Lock()
+        self._templates = set()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    namespace TEXT NOT NULL,
+                    template_version TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+
+    def get(self, key):
+        """Return the stored value for ``key`` or None if missing or expired."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.stats["expired"] += 1
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def set(self, key, value, namespace, template_version, model_id):
+        """Store ``value`` and evict the least recently used entries beyond the size bound."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, namespace, template_version, model_id, json.dumps(value), now, now),
+            )
+            (rows,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+            if rows > self.max_entries:
+                overflow = rows - self.max_entries
+                self._conn.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY last_access LIMIT ?)",
+                    (overflow,),
+                )
+                self.stats["evicted"] += overflow
+
+    def invalidate_stale(self, namespace, template_version, model_id):
+        """
+        Delete entries in ``namespace`` written under another template version or
+        model id. Runs once per process for each (namespace, version, model) seen.
+        """
+        template = (namespace, template_version, model_id)
+        if template in self._templates:
+            return
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND (template_version != ? OR model_id != ?)",
+                template,
+            )
+            self.stats["invalidated"] += cursor.rowcount
+            self._templates.add(template)
+
+    def size(self):
+        with self._lock:
+            (rows,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        return rows
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entries")
+
+
+_disk = None
+
+
+def get_disk_cache():
+    """Return the process-wide persistent cache, or None when it is disabled."""
+    global _disk
+    if _disk is None and CACHE_PATH:
+        with _lock:
+            if _disk is None:
+                _disk = PersistentCache(CACHE_PATH)
+    return _disk
+
+
+def cached_call(key, compute, namespace="default", template_version="", model_id=""):
+    """
+    Return the cached result for ``key``, calling ``compute()`` on a miss.
+
+    Lookups go to the in-memory LRU first, then to the persistent cache.
+    ``namespace``, ``template_version`` and ``model_id`` are stored alongside
+    persisted entries so results from an older prompt or model are invalidated.
+
+    On a miss, concurrent callers with the same key wait for a single call to
+    ``compute()`` and share its result. Results containing an "error" key are
+    returned but not cached, so a failed call is retried on the next rerun.
+    Callers get their own copy of the result because cached entries are shared
+    across sessions.
+    """
+    with _lock:
+        if key in _results:
+            _stats["hits"] += 1
+            count("result_cache_lookups_total", namespace=namespace, result="hit")
+            return copy.deepcopy(_results[key])
+
+    result = disk = None
+    try:
+        disk = get_disk_cache()
+        if disk is not None:
+            disk.invalidate_stale(namespace, template_version, model_id)
+            result = disk.get(key)
+    except sqlite3.Error:
+        pass  # An unwritable, locked or broken cache file must never block a Bedrock call
+    if result is not None:
+        with _lock:
+            _stats["disk_hits"] += 1
+            _results[key] = result
+        count("result_cache_lookups_total", namespace=namespace, result="disk_hit")
+        return copy.deepcopy(result)
+
+    with _lock:
+        _stats["misses"] += 1
+    count("result_cache_lookups_total", namespace=namespace, result="miss")
+
+    return _inflight.do(key, lambda: _compute_and_store(key, compute, disk, namespace, template_version, model_id))
+
+
+def _compute_and_store(key, compute, disk, namespace, template_version, model_id):
+    result = compute()
+    if isinstance(result, dict) and "error" not in result:
+        with _lock:
+            _results[key] = copy.deepcopy(result)
+        if disk is not None:
+            try:
+                disk.set(key, result, namespace, template_version, model_id)
+            except sqlite3.Error:
+                pass
+    return result
+
+
+def cache_stats():
+    """
+    Return hit/miss counters, coalesced call counts and the number of cached
+    results in memory and on disk.
+    """
+    with _lock:
+        stats = {**_stats, "entries": len(_results), "max_entries": MAX_ENTRIES}
+    stats["coalesced"] = _inflight.stats["coalesced"]
+    stats["in_flight"] = _inflight.in_flight()
+    try:
+        disk = get_disk_cache()
+        if disk is not None:
+            stats["disk"] = {**disk.stats, "path": disk.path, "entries": disk.size(), "max_entries": disk.max_entries, "ttl": disk.ttl}
+    except sqlite3.Error as e:
+        stats["disk"] = {"path": CACHE_PATH, "error": str(e)}  # Reported, not raised, as in cached_call
+    return stats
+
+
+def clear_cache():
+    """Drop every cached result (memory and disk) and reset the counters."""
+    with _lock:
+        _results.clear()
+        for name in _stats:
+            _stats[name] = 0
+    try:
+        disk = get_disk_cache()
+        if disk is not None:
+            disk.clear()
+    except sqlite3.Error:
+        pass  # Unusable cache file: the memory cache is cleared, the disk is left as is
@@ -0,0 +1,42 @@
+"""
+Shared, bounded thread pool for running independent Bedrock calls concurrently.
+
+The pool lives at module level so it is created once per process and shared by
+every Streamlit session; the worker count caps how many Bedrock requests a
+single instance can have in flight at once.
+"""
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Maximum number of Bedrock calls running at the same time in this process
+MAX_WORKERS = int(os.getenv("BEDROCK_MAX_WORKERS", "8"))
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the process-wide executor, creating it on first use."""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="bedrock")
+    return _executor
+
+
+def run_concurrently(calls):
+    """
+    Run each zero-argument callable in ``calls`` (a dict of name -> callable)
+    on the shared executor and yield ``(name, result)`` pairs as they finish.
+
+    The callables run outside the Streamlit script thread, so they must not
+    touch ``st.session_state`` or render anything; bind their inputs first.
+    Each runs in a copy of the caller's context, so its metrics count towards
+    the caller's session.
+    """
+    futures = {get_executor().submit(contextvars.copy_context().run, fn): name for name, fn in calls.items()}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
@@ -0,0 +1,184 @@
+"""
+Client-side rate limiting and retries for Bedrock calls.
+
+All sessions in a process share two token buckets sized to the account's
+Bedrock quota: one for requests per minute and one for tokens per minute. A
+call waits for capacity instead of failing, up to a deadline. Throttling and
+transient errors are retried with jittered exponential backoff until the same
+deadline, and every throttle lowers the bucket rate (recovering gradually on
+success) so aggregate throughput settles just under the quota.
+"""
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+from tenacity import Retrying, retry_if_exception, stop_before_delay, wait_random_exponential
+
+from metrics import count, observe
+
+# Bedrock quota for the model; keep these in line with the account's service quotas
+REQUESTS_PER_MINUTE = float(os.getenv("BEDROCK_REQUESTS_PER_MINUTE", "50"))
+TOKENS_PER_MINUTE = float(os.getenv("BEDROCK_TOKENS_PER_MINUTE", "200000"))
+# Fraction of the quota to aim for, leaving headroom for other clients
+QUOTA_HEADROOM = float(os.getenv("BEDROCK_QUOTA_HEADROOM", "0.9"))
+# Seconds of quota that may be spent in a burst
+BURST_SECONDS = float(os.getenv("BEDROCK_BURST_SECONDS", "10"))
+# Total seconds a call may spend queueing and retrying before it fails
+RETRY_DEADLINE = float(os.getenv("BEDROCK_RETRY_DEADLINE", "30"))
+
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelNotReadyException",
+}
+
+
+class RateLimitTimeout(Exception):
+    """Raised when no capacity frees up before the call's deadline."""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket with additive-increase/multiplicative-decrease rate.
+
+    ``rate`` is the target refill rate in tokens per second. ``throttled()``
+    cuts the current rate, ``succeeded()`` grows it back towards the target.
+    """
+
+    def __init__(self, rate, capacity, min_rate_fraction=0.1):
+        self.target_rate = rate
+        self.rate = rate
+        self.min_rate = rate * min_rate_fraction
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1, deadline=None):
+        """Wait until ``amount`` tokens are available; False if ``deadline`` passes first."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return True
+                wait = (amount - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def release(self, amount=1):
+        """Give back ``amount`` tokens taken for a call that was never made."""
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * 0.5)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.target_rate, self.rate + self.target_rate * 0.05)
+
+
+request_bucket = TokenBucket(
+    REQUESTS_PER_MINUTE * QUOTA_HEADROOM / 60,
+    max(1.0, REQUESTS_PER_MINUTE * QUOTA_HEADROOM / 60 * BURST_SECONDS),
+)
+token_bucket = TokenBucket(
+    TOKENS_PER_MINUTE * QUOTA_HEADROOM / 60,
+    TOKENS_PER_MINUTE * QUOTA_HEADROOM / 60 * BURST_SECONDS,
+)
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "retries": 0, "throttled": 0, "queue_timeouts": 0, "queued_seconds": 0.0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def is_throttle(exc):
+    return isinstance(exc, ClientError) and exc.response.get("Error", {}).get("Code") in ("ThrottlingException", "TooManyRequestsException")
+
+
+def is_retryable(exc):
+    """Retry throttling, transient service errors and dropped connections only."""
+    if isinstance(exc, ClientError):
+        return exc.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+    return isinstance(exc, (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError))
+
+
+def estimate_tokens(request_body, max_tokens):
+    """Rough token cost of a request: ~4 characters per input token plus the output budget."""
+    return len(request_body) // 4 + max_tokens
+
+
+def _before_retry(retry_state):
+    _count("retries")
+    count("bedrock_retries_total")
+
+
+def call_with_rate_limit(call, tokens, deadline=RETRY_DEADLINE):
+    """
+    Run ``call()`` once capacity is available, retrying retryable errors with
+    jittered exponential backoff until ``deadline`` seconds have passed.
+    """
+    expires = time.monotonic() + deadline
+
+    def attempt():
+        queued = time.monotonic()
+        acquired = request_bucket.acquire(1, expires)
+        if acquired and not token_bucket.acquire(tokens, expires):
+            request_bucket.release(1)  # The request slot was never used
+            acquired = False
+        if not acquired:
+            _count("queue_timeouts")
+            count("bedrock_queue_timeouts_total")
+            raise RateLimitTimeout("Bedrock is busy; no capacity freed up before the deadline")
+        waited = time.monotonic() - queued
+        _count("queued_seconds", waited)
+        observe("bedrock_queue_wait_seconds", waited)
+        _count("calls")
+        try:
+            result = call()
+        except Exception as e:
+            if is_throttle(e):
+                _count("throttled")
+                count("bedrock_throttles_total")
+                request_bucket.throttled()
+                token_bucket.throttled()
+            raise
+        request_bucket.succeeded()
+        token_bucket.succeeded()
+        return result
+
+    retrying = Retrying(
+        retry=retry_if_exception(is_retryable),
+        wait=wait_random_exponential(multiplier=0.5, max=8),
+        stop=stop_before_delay(deadline),
+        before_sleep=_before_retry,
+        reraise=True,
+    )
+    return retrying(attempt)
+
+
+def rate_limit_stats():
+    """Return call/retry/throttle counters and the current bucket rates (per minute)."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["requests_per_minute"] = round(request_bucket.rate * 60, 2)
+    stats["tokens_per_minute"] = round(token_bucket.rate * 60)
+    return stats
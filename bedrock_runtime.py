@@ -0,0 +1,212 @@
+"""
+Process-wide Bedrock runtime client.
+
+Streamlit re-executes the app script on every interaction, so building the
+boto3 session and client at script top level repeats credential and endpoint
+resolution each time and drops warm TLS connections. This module builds one
+client per process, shared by every session and worker thread (boto3 clients
+are thread-safe), with a connection pool sized for the expected number of
+concurrent Bedrock calls.
+
+``invoke_model`` and ``invoke_model_stream`` are the entry points the apps
+use; they add client-side rate limiting and retries (see bedrock_rate_limit),
+so botocore's own retries are switched off to avoid retrying twice. If the
+model rejects prompt-caching markers, they are stripped for the rest of the
+process. Token usage reported by responses (including prompt-cache reads and
+writes) is accumulated by ``record_usage`` for ``usage_stats``. Calls, the
+request itself and the body read are timed as metrics spans.
+"""
+import json
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+
+from bedrock_rate_limit import call_with_rate_limit, estimate_tokens
+from metrics import count, observe, span
+
+# Load environment variables
+load_dotenv()
+
+# Connections kept per endpoint; size it to the number of concurrent users
+MAX_POOL_CONNECTIONS = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+# Enable TCP keep-alive so idle pooled connections are not dropped by middleboxes
+TCP_KEEPALIVE = os.getenv("BEDROCK_TCP_KEEPALIVE", "1") == "1"
+# Long proposals can take well over the botocore default of 60 seconds
+READ_TIMEOUT = int(os.getenv("BEDROCK_READ_TIMEOUT", "120"))
+# Point the client at another endpoint, e.g. the local stand-in in bedrock_stub_server.py
+ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL") or None
+
+_client = None
+_lock = threading.Lock()
+
+# Set once Bedrock rejects a request because of cache_control markers
+_prompt_caching_rejected = False
+
+_usage_lock = threading.Lock()
+_usage = {
+    "responses": 0,
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "cache_read_input_tokens": 0,
+    "cache_creation_input_tokens": 0,
+    "streams": 0,
+    "first_token_seconds": 0.0,
+}
+
+
+def get_bedrock_client():
+    """Return the shared bedrock-runtime client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                aws_session = boto3.Session(
+                    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                    region_name=os.getenv("aws_secret_region")
+                )
+                config = Config(
+                    max_pool_connections=MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=TCP_KEEPALIVE,
+                    read_timeout=READ_TIMEOUT,
+                    retries={"total_max_attempts": 1, "mode": "standard"},
+                )
+                _client = aws_session.client(service_name="bedrock-runtime", config=config, endpoint_url=ENDPOINT_URL)
+    return _client
+
+
+def _request_tokens(request_body):
+    return estimate_tokens(request_body, json.loads(request_body).get("max_tokens", 0))
+
+
+def _strip_cache_control(request_body):
+    request = json.loads(request_body)
+    blocks = list(request.get("system", [])) if isinstance(request.get("system"), list) else []
+    for message in request.get("messages", []):
+        if isinstance(message.get("content"), list):
+            blocks.extend(message["content"])
+    for block in blocks:
+        block.pop("cache_control", None)
+    return json.dumps(request)
+
+
+def _with_prompt_caching_fallback(send, request_body):
+    """
+    Call ``send(body)``; if Bedrock rejects the prompt-caching markers (model
+    without prompt caching), resend without them and stop sending them.
+    """
+    global _prompt_caching_rejected
+    if "cache_control" not in request_body:
+        return send(request_body)
+    if _prompt_caching_rejected:
+        return send(_strip_cache_control(request_body))
+    try:
+        return send(request_body)
+    except ClientError as e:
+        error = e.response.get("Error", {})
+        if error.get("Code") != "ValidationException" or "cach" not in error.get("Message", "").lower():
+            raise
+        _prompt_caching_rejected = True
+        return send(_strip_cache_control(request_body))
+
+
+def invoke_model(model_id, request_body):
+    """Invoke a model with rate limiting and retries; returns the response body text."""
+    def send(body):
+        def call():
+            with span("bedrock_request", operation="invoke"):
+                response = get_bedrock_client().invoke_model(
+                    modelId=model_id,
+                    body=body,
+                    contentType="application/json"
+                )
+            with span("bedrock_body_read"):
+                return response["body"].read().decode("utf-8")
+
+        return call_with_rate_limit(call, _request_tokens(body))
+
+    # Includes rate-limit queueing and retries
+    with span("bedrock_call", operation="invoke"):
+        return _with_prompt_caching_fallback(send, request_body)
+
+
+def invoke_model_stream(model_id, request_body):
+    """
+    Start a streamed invocation with rate limiting and retries. Only opening the
+    stream is retried; errors raised while reading events reach the caller.
+    """
+    def send(body):
+        def call():
+            with span("bedrock_request", operation="stream"):
+                return get_bedrock_client().invoke_model_with_response_stream(
+                    modelId=model_id,
+                    body=body,
+                    contentType="application/json"
+                )
+
+        return call_with_rate_limit(call, _request_tokens(body))
+
+    with span("bedrock_call", operation="stream"):
+        return _with_prompt_caching_fallback(send, request_body)
+
+
+def record_usage(usage, first_token_seconds=None):
+    """Add the token usage of one response (and its time to first token, if streamed)."""
+    if not usage:
+        return
+    with _usage_lock:
+        _usage["responses"] += 1
+        for name in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"):
+            _usage[name] += usage.get(name) or 0
+        if first_token_seconds is not None:
+            _usage["streams"] += 1
+            _usage["first_token_seconds"] += first_token_seconds
+    for name in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"):
+        if usage.get(name):
+            count("bedrock_tokens_total", usage[name], type=name)
+    if first_token_seconds is not None:
+        observe("bedrock_first_token_seconds", first_token_seconds)
+
+
+def usage_stats():
+    """
+    Return accumulated token usage, the share of prompt tokens served from the
+    prompt cache and the mean time to first token of streamed responses.
+    """
+    with _usage_lock:
+        stats = dict(_usage)
+    prompt_tokens = stats["input_tokens"] + stats["cache_read_input_tokens"] + stats["cache_creation_input_tokens"]
+    stats["cache_read_ratio"] = round(stats["cache_read_input_tokens"] / prompt_tokens, 3) if prompt_tokens else 0.0
+    stats["mean_first_token_seconds"] = round(stats.pop("first_token_seconds") / stats["streams"], 3) if stats["streams"] else None
+    stats["prompt_caching_rejected"] = _prompt_caching_rejected
+    return stats
+
+
+def pool_stats():
+    """
+    Return connection pool statistics for the shared client.
+
+    For each endpoint host this reports how many connections have been opened,
+    how many requests they served and how many are idle in the pool right now.
+    """
+    stats = {"max_pool_connections": MAX_POOL_CONNECTIONS, "tcp_keepalive": TCP_KEEPALIVE, "pools": []}
+    if _client is None:
+        return stats
+
+    manager = _client._endpoint.http_session._manager
+    for pool_key in list(manager.pools.keys()):
+        pool = manager.pools.get(pool_key)
+        if pool is None:
+            continue
+        idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+        stats["pools"].append({
+            "host": pool.host,
+            "connections_opened": pool.num_connections,
+            "requests": pool.num_requests,
+            "idle_connections": idle,
+        })
+    return stats
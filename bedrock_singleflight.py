@@ -0,0 +1,64 @@
+"""
+Single-flight coalescing of identical in-flight calls.
+
+When several sessions in the same process ask for the same result at the same
+time (the same RFP pasted by several reps, a double-clicked button), only the
+first caller runs the call; the others wait for it and share its result.
+"""
+import copy
+import threading
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time and share its outcome with concurrent callers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key, fn):
+        """
+        Return ``fn()``, or the result of an identical call already in flight.
+
+        Waiting callers get a deep copy of the result (it is shared across
+        sessions) and see the same exception if the call raised.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,368 @@
+"""
+Local stand-in for the Bedrock runtime API.
+
+Serves ``InvokeModel`` and ``InvokeModelWithResponseStream`` for Claude request
+bodies so the apps, benchmarks and load tests can run without AWS access. Point
+the shared client at it with an endpoint override (any non-empty credentials
+work, the stand-in does not check signatures):
+
+    python bedrock_stub_server.py --port 8765 --latency lognormal:2.0:0.4 --throttle-rate 0.05
+    BEDROCK_ENDPOINT_URL=http://127.0.0.1:8765 aws_secret_region=us-east-1 \\
+        AWS_ACCESS_KEY_ID=stub AWS_SECRET_ACCESS_KEY=stub \\
+        python3 -m streamlit run Conversational_matching_proposal_withprice.py
+
+Responses are canned (first ``match`` substring found in the prompt from a
+``--canned`` JSON file) or templated from the prompt: analysis prompts get a
+``provided_details``/``missing_details`` object built from the required detail
+list, anything else gets a proposal object (with the lead details appended for
+fused prompts). Latency is drawn from a
+configurable distribution, and throttling errors and malformed JSON can be
+injected at a given rate. Blocks marked with ``cache_control`` are tracked
+like Bedrock prompt caching: the first request reports
+``cache_creation_input_tokens`` for them, later ones ``cache_read_input_tokens``.
+``GET /stats`` returns request counters.
+"""
+import argparse
+import base64
+import binascii
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+PROPOSAL_FIELDS = [
+    "Proposal Description",
+    "Required Services",
+    "Required Skills",
+    "Required Certifications",
+    "Required Software",
+    "Required Service Line",
+    "Required Language",
+    "Required Location and Time Zones",
+    "Required Teams",
+    "Start/End Dates",
+]
+
+# Characters of model text sent per streamed content delta
+STREAM_CHUNK_SIZE = 12
+
+
+def parse_latency(spec):
+    """
+    Parse a latency distribution spec into a sampler taking a ``random.Random``.
+
+    Specs are in seconds: ``fixed:S``, ``uniform:LOW:HIGH`` or
+    ``lognormal:MEDIAN:SIGMA``.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(":") if value]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    raise ValueError(f"Invalid latency spec: {spec!r}")
+
+
+class StubConfig:
+    """Behaviour of the stand-in; all rates are probabilities per request."""
+
+    def __init__(self, latency="fixed:0", first_token_fraction=0.15, throttle_rate=0.0,
+                 malformed_rate=0.0, max_inflight=0, provided_details=0, canned=None, seed=None):
+        self.latency = latency
+        self.sample_latency = parse_latency(latency)
+        self.first_token_fraction = first_token_fraction
+        self.throttle_rate = throttle_rate
+        self.malformed_rate = malformed_rate
+        self.max_inflight = max_inflight
+        self.provided_details = provided_details
+        self.canned = canned or []
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+
+    def roll(self, rate):
+        with self.rng_lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def draw_latency(self):
+        with self.rng_lock:
+            return max(0.0, self.sample_latency(self.rng))
+
+
+def prompt_text(request):
+    """Concatenate the system blocks and message contents of a Claude request."""
+    parts = []
+    system = request.get("system", "")
+    blocks = system if isinstance(system, list) else [{"text": system}]
+    parts.extend(block.get("text", "") for block in blocks)
+    for message in request.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get("text", "") for block in content if isinstance(block, dict))
+    return "\n".join(parts)
+
+
+def cached_prefix(request):
+    """Return the text of the system blocks marked for prompt caching."""
+    system = request.get("system")
+    if not isinstance(system, list):
+        return ""
+    return "".join(block.get("text", "") for block in system if "cache_control" in block)
+
+
+def templated_text(prompt, config):
+    """Build a plausible model reply for the kind of prompt received."""
+    match = re.search(r"The required lead details are:\s*(\[.*?\])", prompt, re.S)
+    details = {}
+    if "provided_details" in prompt and match:
+        required = json.loads(match.group(1))
+        details = {
+            "provided_details": {name: f"Sample {name}" for name in required[:config.provided_details]},
+            "missing_details": required[config.provided_details:],
+        }
+        if "FinancialExpertAI" not in prompt:
+            return json.dumps(details, indent=2)
+
+    user_input = prompt.rsplit("User Input:", 1)[-1].strip().strip("*").strip()
+    proposal = {
+        "Proposal Description": f"Summary proposal for the following requirements: {user_input[:300]}",
+        "Required Services": ["Tax Preparation", "Tax Filing"],
+        "Required Skills": ["Tax Filing", "Accounting"],
+        "Required Certifications": ["Certified Public Accountant (CPA)"],
+        "Required Software": "Not Mentioned",
+        "Required Service Line": ["Tax Preparation"],
+        "Required Language": "Not Mentioned",
+        "Required Location and Time Zones": "Not Mentioned",
+        "Required Teams": "Not Mentioned",
+        "Start/End Dates": "Not Mentioned",
+    }
+    # Fused prompts get the lead details after the proposal fields
+    return json.dumps({**{field: proposal[field] for field in PROPOSAL_FIELDS}, **details}, indent=4)
+
+
+def reply_text(prompt, config):
+    for entry in config.canned:
+        if entry["match"] in prompt:
+            text = entry["text"]
+            break
+    else:
+        text = templated_text(prompt, config)
+    if config.roll(config.malformed_rate):
+        # Cut the JSON short, as a truncated or garbled completion would be
+        with config.rng_lock:
+            text = text[:config.rng.randint(1, max(1, len(text) // 2))]
+    return text
+
+
+def encode_event(payload, event_type="chunk"):
+    """Frame one message in the AWS event-stream binary format."""
+    headers = b""
+    for name, value in ((":event-type", event_type), (":content-type", "application/json"), (":message-type", "event")):
+        name_bytes, value_bytes = name.encode(), value.encode()
+        headers += struct.pack(">B", len(name_bytes)) + name_bytes + b"\x07" + struct.pack(">H", len(value_bytes)) + value_bytes
+    total_length = 12 + len(headers) + len(payload) + 4
+    prelude = struct.pack(">II", total_length, len(headers))
+    message = prelude + struct.pack(">I", binascii.crc32(prelude)) + headers + payload
+    return message + struct.pack(">I", binascii.crc32(message))
+
+
+def chunk_event(body):
+    """Wrap a Claude streaming event as a Bedrock ``chunk`` payload part."""
+    encoded = base64.b64encode(json.dumps(body).encode("utf-8")).decode("ascii")
+    return encode_event(json.dumps({"bytes": encoded}).encode("utf-8"))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "BedrockStub/1.0"
+
+    def log_message(self, format, *args):
+        pass  # Keep load tests quiet
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.server.stats_lock:
+                body = json.dumps(self.server.stats).encode("utf-8")
+            self._send(200, body)
+        else:
+            self._send_error(404, "ResourceNotFoundException", "Unknown path")
+
+    def do_POST(self):
+        match = re.fullmatch(r"/model/([^/]+)/(invoke|invoke-with-response-stream)", self.path)
+        request_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not match:
+            self._send_error(404, "ResourceNotFoundException", "Unknown path")
+            return
+
+        model_id, operation = unquote(match.group(1)), match.group(2)
+        server = self.server
+        config = server.config
+        self._count("requests")
+
+        with server.stats_lock:
+            server.inflight += 1
+            over_limit = config.max_inflight and server.inflight > config.max_inflight
+        try:
+            if over_limit or config.roll(config.throttle_rate):
+                self._count("throttled")
+                self._send_error(429, "ThrottlingException", "Too many requests, please wait before trying again.")
+                return
+            try:
+                request = json.loads(request_body)
+            except json.JSONDecodeError:
+                self._send_error(400, "ValidationException", "Malformed input request")
+                return
+
+            prompt = prompt_text(request)
+            text = reply_text(prompt, config)
+            usage = {"input_tokens": max(1, len(prompt) // 4), "output_tokens": max(1, len(text) // 4)}
+            prefix = cached_prefix(request)
+            if prefix:
+                digest = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+                with server.stats_lock:
+                    seen = digest in server.prompt_cache
+                    server.prompt_cache.add(digest)
+                prefix_tokens = len(prefix) // 4
+                usage["input_tokens"] = max(1, usage["input_tokens"] - prefix_tokens)
+                usage["cache_read_input_tokens" if seen else "cache_creation_input_tokens"] = prefix_tokens
+            latency = config.draw_latency()
+            if operation == "invoke":
+                time.sleep(latency)
+                self._send(200, json.dumps(self._message(model_id, text, usage)).encode("utf-8"))
+            else:
+                self._stream(model_id, text, usage, latency)
+        finally:
+            with server.stats_lock:
+                server.inflight -= 1
+
+    def _message(self, model_id, text, usage):
+        return {
+            "id": f"msg_stub_{random.getrandbits(48):012x}",
+            "type": "message",
+            "role": "assistant",
+            "model": model_id,
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": usage,
+        }
+
+    def _stream(self, model_id, text, usage, latency):
+        chunks = [text[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(text), STREAM_CHUNK_SIZE)] or [""]
+        first_token_delay = latency * self.server.config.first_token_fraction
+        chunk_delay = (latency - first_token_delay) / len(chunks)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        message = self._message(model_id, "", {**usage, "output_tokens": 1})
+        message["content"] = []
+        self._write_chunk(chunk_event({"type": "message_start", "message": message}))
+        self._write_chunk(chunk_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}))
+        time.sleep(first_token_delay)
+        for chunk in chunks:
+            self._write_chunk(chunk_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}}))
+            time.sleep(chunk_delay)
+        self._write_chunk(chunk_event({"type": "content_block_stop", "index": 0}))
+        self._write_chunk(chunk_event({
+            "type": "message_delta",
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": usage["output_tokens"]},
+        }))
+        self._write_chunk(chunk_event({"type": "message_stop"}))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send(self, status, body, extra_headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, error_type, message):
+        body = json.dumps({"message": message}).encode("utf-8")
+        self._send(status, body, {"x-amzn-ErrorType": f"{error_type}:http://internal.amazon.com/coral/com.amazon.bedrock/"})
+
+    def _count(self, name):
+        with self.server.stats_lock:
+            self.server.stats[name] = self.server.stats.get(name, 0) + 1
+
+
+def make_server(config, host="127.0.0.1", port=0):
+    """Create (but do not start) a stand-in server; ``port=0`` picks a free port."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = {"requests": 0, "throttled": 0}
+    server.stats_lock = threading.Lock()
+    server.inflight = 0
+    server.prompt_cache = set()
+    return server
+
+
+def start_stub_server(config=None, host="127.0.0.1", port=0):
+    """Start a stand-in on a background thread and return ``(server, endpoint_url)``."""
+    server = make_server(config or StubConfig(), host, port)
+    threading.Thread(target=server.serve_forever, name="bedrock-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Bedrock runtime API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA (seconds)")
+    parser.add_argument("--first-token-fraction", type=float, default=0.15, help="Share of the latency spent before the first streamed token")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of a ThrottlingException")
+    parser.add_argument("--max-inflight", type=int, default=0, help="Throttle requests beyond this many in flight (0 = no limit)")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Probability of returning truncated JSON text")
+    parser.add_argument("--provided-details", type=int, default=0, help="Required lead details reported as provided by analysis prompts")
+    parser.add_argument("--canned", help='JSON file with a list of {"match": "...", "text": "..."} replies')
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    canned = None
+    if args.canned:
+        with open(args.canned, encoding="utf-8") as f:
+            canned = json.load(f)
+
+    config = StubConfig(
+        latency=args.latency,
+        first_token_fraction=args.first_token_fraction,
+        throttle_rate=args.throttle_rate,
+        malformed_rate=args.malformed_rate,
+        max_inflight=args.max_inflight,
+        provided_details=args.provided_details,
+        canned=canned,
+        seed=args.seed,
+    )
+    server = make_server(config, args.host, args.port)
+    print(f"Bedrock stand-in listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+End-to-end latency benchmark of the proposal flow.
+
+Drives the real Streamlit app (Conversational_matching_proposal_withprice.py, or
+a copy of it under test) headlessly with Streamlit's AppTest, against the local Bedrock
+stand-in in bedrock_stub_server.py, through every stage a lead goes through:
+
+- ``generate``: enter the lead and click Generate Proposal until the proposal is in
+- ``analyze``: further waiting until the lead-detail analysis is in (an analysis
+  that finishes in the same script run as the proposal counts under ``generate``)
+- ``qa``: answer the missing lead details
+- ``pricing``: answer the pricing questionnaire (leads alternate between
+  businesses in one state and in several, which adds the per-business entity editor)
+- ``confirm``: click Confirm Details (final proposal, analysis and price)
+
+For each stage it reports p50/p95/p99 wall time; per lead the Bedrock calls
+made, the script reruns and the session size; and the peak memory of the run.
+Results are written as JSON (with the git commit) so runs can be compared
+across commits; ``--baseline`` compares against an earlier result and exits
+non-zero when a stage's p95 regressed by more than ``--max-regression``.
+
+    python3 benchmark_flows.py --leads 50 --latency lognormal:2.0:0.4 --output bench.json
+    python3 benchmark_flows.py --leads 50 --latency lognormal:2.0:0.4 --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bedrock_stub_server import StubConfig, start_stub_server
+
+STAGES = ("generate", "analyze", "qa", "pricing", "confirm")
+
+SAMPLE_LEADS = [
+    "We need tax filing and bookkeeping for our retail LLC in Texas with about $2M annual revenue.",
+    "Looking for help filing federal and state taxes for my consulting S Corp, we use QuickBooks.",
+    "Need a CPA to prepare personal and business tax returns; I own two restaurants in California.",
+    "Our manufacturing C Corp needs 6 months of bookkeeping clean-up and a 2023 tax filing.",
+    "Private partnership in healthcare needs tax preparation for New York and New Jersey.",
+]
+
+# Answers typed into the missing lead-detail questions
+LEAD_ANSWERS = {
+    "Annual Revenue": "$1.5M",
+    "Industry": "Retail",
+    "Entity Type": "LLC",
+    "Publicly Traded": "Privately held",
+    "Primary Accounting Software": "QuickBooks",
+    "Months to Clean-Up": "3",
+    "Year to Be Filed": "2024",
+    "States to File Taxes": "Texas",
+}
+
+# Answers to the pricing questionnaire by question key, one set per lead in turn
+PRICING_ANSWERS = [
+    {
+        "Filing Type": "Both",
+        "Self Employment Income": "Yes-1040-C",
+        "Number of Businesses": 2,
+        "Businesses in Same State": "Yes",
+    },
+    {
+        "Filing Type": "Business",
+        "Number of Businesses": 2,
+        "Businesses in Same State": "No",
+        # Edit record of the per-business entity editor
+        "Business Entities": {"edited_rows": {0: {"State": "TX"}, 1: {"State": "California"}}, "added_rows": [], "deleted_rows": []},
+    },
+]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def distribution(values, digits=4):
+    """p50/p95/p99, mean and max of ``values``."""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.50), digits),
+        "p95": round(percentile(values, 0.95), digits),
+        "p99": round(percentile(values, 0.99), digits),
+        "mean": round(sum(values) / len(values), digits),
+        "max": round(values[-1], digits),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class FlowDriver:
+    """Runs one lead through the app with AppTest, timing each stage."""
+
+    def __init__(self, app_path, timeout, poll_seconds, reruns):
+        self.app_path = app_path
+        self.timeout = timeout
+        self.poll_seconds = poll_seconds
+        # Shared counter of script executions, bumped by the st.title wrapper
+        self.reruns = reruns
+
+    def labels(self, at):
+        return [button.label for button in at.button]
+
+    def click(self, at, label):
+        [button for button in at.button if button.label == label][0].click().run()
+
+    def wait_until(self, at, done, stage):
+        """Rerun the app (as the page's job polling would) until ``done(at)`` or the timeout."""
+        deadline = time.perf_counter() + self.timeout
+        while not done(at):
+            if at.exception:
+                raise RuntimeError(at.exception[0].message)
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"{stage} did not finish in {self.timeout}s")
+            time.sleep(self.poll_seconds)
+            at.run()
+
+    def answer_pricing(self, at, session, answers):
+        """Answer the pricing questionnaire with ``answers``; returns the seconds it took."""
+        started = time.perf_counter()
+        questionnaire = session.questionnaire
+        while questionnaire is not None and not questionnaire.done:
+            question = questionnaire.current
+            next_buttons = [button for button in at.button if button.key == f"next-{question.key}"]
+            if not next_buttons:
+                break  # The app does not ask for a price on this path
+            key = f"pricing-{question.key}"
+            value = answers.get(question.key)
+            if question.widget == "selectbox":
+                at.selectbox(key=key).set_value(value)
+            elif question.widget == "radio":
+                at.radio(key=key).set_value(value)
+            elif question.widget == "number":
+                at.number_input(key=key).set_value(value)
+            elif question.widget == "entities":
+                # AppTest has no data editor element; its edit record lives under the widget key
+                at.session_state["business-entities"] = value
+            next_buttons[0].click().run()
+            if questionnaire.current is question:
+                raise RuntimeError(f"questionnaire did not accept an answer to {question.key!r}")
+        return time.perf_counter() - started
+
+    def confirm(self, at):
+        """Click Confirm Details; returns the seconds it took."""
+        started = time.perf_counter()
+        if "Confirm Details" in self.labels(at):
+            self.click(at, "Confirm Details")
+        return time.perf_counter() - started
+
+    def run(self, text, answers=None):
+        """Return ``(stage seconds, session)`` for one lead, priced with ``answers`` (one of PRICING_ANSWERS)."""
+        answers = PRICING_ANSWERS[0] if answers is None else answers
+        from streamlit.testing.v1 import AppTest
+
+        timings = {}
+        at = AppTest.from_file(self.app_path, default_timeout=self.timeout).run()
+        session = at.session_state["proposal_session"]
+
+        started = time.perf_counter()
+        at.text_area[0].input(text).run()
+        self.click(at, "Generate Proposal")
+        self.wait_until(at, lambda at: session.process_started or bool(at.error), "generate")
+        timings["generate"] = time.perf_counter() - started
+
+        if not session.is_tax_input:
+            return timings, session  # Not tax-related: the proposal is all there is
+
+        started = time.perf_counter()
+        self.wait_until(at, lambda at: session.collected_details or session.missing_keys or bool(at.error), "analyze")
+        timings["analyze"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        while "Submit" in self.labels(at):
+            for field in at.text_input:
+                if field.key and field.key.startswith("text-"):
+                    field.input(LEAD_ANSWERS.get(field.key[len("text-"):], "n/a"))
+            self.click(at, "Submit")
+        timings["qa"] = time.perf_counter() - started
+
+        timings["pricing"] = self.answer_pricing(at, session, answers)
+        timings["confirm"] = self.confirm(at)
+
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        return timings, session
+
+
+def compare(result, baseline, max_regression):
+    """Print stage p50/p95 against ``baseline``; returns the stages whose p95 regressed too much."""
+    regressed = []
+    print(f"{'stage':<10} {'p50':>9} {'base p50':>9} {'p95':>9} {'base p95':>9} {'change':>8}")
+    for stage in STAGES:
+        now, then = result["stages"].get(stage, {}), baseline.get("stages", {}).get(stage, {})
+        if not now.get("count") or not then.get("count"):
+            continue
+        change = (now["p95"] - then["p95"]) / then["p95"] if then["p95"] else 0.0
+        print(f"{stage:<10} {now['p50']:>9.3f} {then['p50']:>9.3f} {now['p95']:>9.3f} {then['p95']:>9.3f} {change:>+8.1%}")
+        if change > max_regression:
+            regressed.append(stage)
+    return regressed
+
+
+def prepare_environment(stub_config, background_jobs):
+    """
+    Start the Bedrock stand-in and point the app's Bedrock, session and job
+    settings at it; this must run before the app's modules are imported.
+    Returns the stand-in server and a one-item list counting script runs.
+    """
+    server, url = start_stub_server(stub_config)
+    workdir = tempfile.mkdtemp(prefix="proposal-bench-")
+    os.environ.update(
+        {
+            "BEDROCK_ENDPOINT_URL": url,
+            "aws_secret_region": os.getenv("aws_secret_region") or "us-east-1",
+            "AWS_ACCESS_KEY_ID": "stub",
+            "AWS_SECRET_ACCESS_KEY": "stub",
+            "BEDROCK_CACHE_PATH": "",
+            "SESSION_STORE": "memory",
+            "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.sqlite3"),
+            "BACKGROUND_JOBS": "1" if background_jobs else "0",
+        }
+    )
+
+    import streamlit
+
+    reruns = [0]
+    title = streamlit.title
+
+    def counting_title(*a, **k):
+        reruns[0] += 1
+        return title(*a, **k)
+
+    # Both apps call st.title once per script execution, so this counts reruns
+    streamlit.title = counting_title
+    return server, reruns
+
+
+def run(args):
+    server, reruns = prepare_environment(
+        StubConfig(latency=args.latency, throttle_rate=args.throttle_rate, provided_details=args.provided_details, seed=args.seed),
+        args.background_jobs,
+    )
+    if args.trace_memory:
+        tracemalloc.start()
+    driver = FlowDriver(os.path.abspath(args.app), args.timeout, args.poll_seconds, reruns)
+    stage_seconds = {stage: [] for stage in STAGES}
+    lead_seconds, calls, rerun_counts, session_bytes, errors = [], [], [], [], []
+    started = time.perf_counter()
+    for number in range(args.leads):
+        # A distinct text per lead, so every lead reaches Bedrock instead of the result cache
+        text = f"{SAMPLE_LEADS[number % len(SAMPLE_LEADS)]} (lead {number + 1})"
+        requests_before, reruns_before = server.stats["requests"], reruns[0]
+        lead_started = time.perf_counter()
+        try:
+            timings, session = driver.run(text, PRICING_ANSWERS[number % len(PRICING_ANSWERS)])
+        except (RuntimeError, TimeoutError, IndexError) as e:
+            errors.append(f"lead {number + 1}: {e}")
+            continue
+        lead_seconds.append(time.perf_counter() - lead_started)
+        for stage, seconds in timings.items():
+            stage_seconds[stage].append(seconds)
+        calls.append(server.stats["requests"] - requests_before)
+        rerun_counts.append(reruns[0] - reruns_before)
+        session_bytes.append(session.memory_bytes())
+        if args.progress:
+            print(f"lead {number + 1}/{args.leads}: {lead_seconds[-1]:.2f}s", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    memory = {"peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    if args.trace_memory:
+        memory["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+    memory["session_bytes"] = distribution(session_bytes, 0)
+    server.shutdown()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "app": args.app,
+            "leads": args.leads,
+            "latency": args.latency,
+            "throttle_rate": args.throttle_rate,
+            "background_jobs": os.environ["BACKGROUND_JOBS"] == "1",
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "completed": len(lead_seconds),
+        "errors": errors,
+        "stages": {stage: distribution(values) for stage, values in stage_seconds.items()},
+        "lead_seconds": distribution(lead_seconds),
+        "bedrock_calls_per_lead": distribution(calls, 2),
+        "reruns_per_lead": distribution(rerun_counts, 2),
+        "memory": memory,
+        "bedrock_stub": dict(server.stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the proposal flow end to end against the Bedrock stand-in.")
+    parser.add_argument(
+        "--app",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "Conversational_matching_proposal_withprice.py"),
+        help="Streamlit app to drive",
+    )
+    parser.add_argument("--leads", type=int, default=20, help="Leads run through the flow, one after another")
+    parser.add_argument("--latency", default="fixed:0.2", help="Bedrock stand-in latency: fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of a throttled Bedrock request")
+    parser.add_argument("--provided-details", type=int, default=4, help="Lead details the stand-in reports as provided")
+    parser.add_argument("--background-jobs", type=int, choices=(0, 1), default=1, help="Run Bedrock calls as background jobs (BACKGROUND_JOBS)")
+    parser.add_argument("--poll-seconds", type=float, default=0.05, help="Pause between reruns while waiting on a background job")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds a stage may take before the lead counts as failed")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report the tracemalloc peak (slower)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed relative p95 increase per stage against the baseline")
+    parser.add_argument("--progress", action="store_true", help="Print each lead's time to stderr")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressed = compare(result, json.load(f), args.max_regression)
+        if regressed:
+            print(f"p95 regressed by more than {args.max_regression:.0%}: {', '.join(regressed)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Headless bulk proposal generation over a JSONL file of leads.
+
+Each input line is a JSON object with the lead text under ``user_input`` (or
+``text``), an optional ``id`` (defaults to the line number) and optional
+``dynamic_details`` answers for pricing, e.g.
+``{"Filing Type": "Business", "Number of Businesses": 2}``. Every lead gets a
+proposal; tax-related leads are also analyzed and, when ``dynamic_details``
+are given, priced. Leads run with bounded concurrency and each result is
+appended to the output JSONL as soon as it finishes, so the output file is
+also the checkpoint: rerunning the same command after a crash skips the leads
+already written. A lead that fails, including a line that is not a JSON
+object, is written as a record with an ``error`` and the run carries on.
+
+    python3 bulk_proposals.py leads.jsonl proposals.jsonl --concurrency 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+# Load environment variables first: the project modules read their settings when imported
+load_dotenv()
+
+from bedrock_runtime import usage_stats
+from lead_extractor import extractor_stats
+from pricing import RATE_VERSION, calculate_price
+from proposal_core import embedded_lead_details, generate_proposal_auto, lead_details_for
+from tax_classifier import classify_batch
+
+# Leads classified together in one vectorized pass
+CLASSIFY_BATCH_SIZE = 1000
+
+
+def read_leads(path):
+    """
+    Yield ``(lead_id, lead)`` for each non-empty line of a JSONL file. A line
+    that is not a JSON object yields ``{"error": ...}`` under its line number.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                lead = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield str(line_number), {"error": f"Malformed lead on line {line_number}: {e}"}
+                continue
+            if not isinstance(lead, dict):
+                yield str(line_number), {"error": f"Malformed lead on line {line_number}: not a JSON object"}
+                continue
+            yield str(lead.get("id", line_number)), lead
+
+
+def lead_text(lead):
+    return str(lead.get("user_input") or lead.get("text") or "")
+
+
+def classify_leads(leads, batch_size=CLASSIFY_BATCH_SIZE):
+    """Yield ``(lead_id, lead, tax_related)``, classifying ``batch_size`` leads at a time."""
+    batch = []
+    for item in leads:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield from _classified(batch)
+            batch = []
+    yield from _classified(batch)
+
+
+def _classified(batch):
+    flags = classify_batch([lead_text(lead) for _, lead in batch])
+    for (lead_id, lead), tax_related in zip(batch, flags):
+        yield lead_id, lead, bool(tax_related)
+
+
+def load_checkpoint(path):
+    """
+    Return the ids already written to ``path``. A partial last line left by a
+    crash is truncated so new results append cleanly.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path, "rb+") as f:
+        data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if len(complete) != len(data):
+            f.truncate(len(complete))
+    for line in complete.decode("utf-8").splitlines():
+        if line.strip():
+            done.add(str(json.loads(line)["id"]))
+    return done
+
+
+def process_lead(lead_id, lead, tax_related):
+    """
+    Run proposal generation, analysis and pricing for one lead. Never raises:
+    a failure (e.g. pricing answers of the wrong type) becomes the record's ``error``.
+    """
+    started = time.perf_counter()
+    record = {"id": lead_id, "is_tax_related": tax_related}
+    if "error" in lead:
+        record["error"] = lead["error"]
+        record["latency_seconds"] = 0.0
+        return record
+    user_input = lead_text(lead)
+
+    failure = None
+    try:
+        proposal = generate_proposal_auto(user_input)
+        # The record's proposal carries proposal fields only, fused mode or not
+        embedded = embedded_lead_details(proposal)
+        record["proposal"] = proposal
+
+        if record["is_tax_related"] and "error" not in proposal:
+            record["analysis"] = embedded or lead_details_for(user_input, proposal)
+            if "dynamic_details" in lead:
+                price, overage_cost, total_price = calculate_price(lead["dynamic_details"])
+                record["price_details"] = {
+                    "Base Price": price,
+                    "Overage Cost": overage_cost,
+                    "Total Price": total_price,
+                    "Rate Version": RATE_VERSION,
+                }
+    except Exception as e:
+        failure = f"Exception occurred: {e}"
+
+    errors = [part["error"] for part in (record.get("proposal", {}), record.get("analysis", {})) if "error" in part]
+    if failure:
+        errors.append(failure)
+    if errors:
+        record["error"] = "; ".join(errors)
+    record["latency_seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, skipped, elapsed):
+    latencies = sorted(latencies)
+    completed = len(latencies)
+    return {
+        "completed": completed,
+        "errors": errors,
+        "skipped_from_checkpoint": skipped,
+        "elapsed_seconds": round(elapsed, 3),
+        "leads_per_minute": round(completed / elapsed * 60, 2) if elapsed else None,
+        "bedrock_usage": usage_stats(),
+        "lead_extractor": extractor_stats(),
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+
+def run(input_path, output_path, concurrency, progress_every=100):
+    """Process every lead not yet in ``output_path`` and return the run summary."""
+    done = load_checkpoint(output_path)
+    skipped = 0
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+
+        def drain(return_when):
+            nonlocal errors, pending
+            finished, pending = wait(pending, return_when=return_when)
+            for future in finished:
+                record = future.result()
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                latencies.append(record["latency_seconds"])
+                errors += "error" in record
+            out.flush()
+            if progress_every and finished and len(latencies) // progress_every != (len(latencies) - len(finished)) // progress_every:
+                print(f"{len(latencies)} leads done, {errors} errors", file=sys.stderr)
+
+        def unprocessed():
+            nonlocal skipped
+            for lead_id, lead in read_leads(input_path):
+                if lead_id in done:
+                    skipped += 1
+                else:
+                    yield lead_id, lead
+
+        for lead_id, lead, tax_related in classify_leads(unprocessed()):
+            # Keep a bounded window of submitted leads so huge inputs are not loaded at once
+            if len(pending) >= concurrency * 2:
+                drain(FIRST_COMPLETED)
+            pending.add(executor.submit(process_lead, lead_id, lead, tax_related))
+
+        while pending:
+            drain(FIRST_COMPLETED)
+
+    return summarize(latencies, errors, skipped, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate proposals for a JSONL file of leads.")
+    parser.add_argument("input", help="JSONL file of leads")
+    parser.add_argument("output", help="JSONL file results are appended to (also the resume checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BEDROCK_MAX_WORKERS", "8")), help="Leads processed at the same time")
+    parser.add_argument("--summary", help="Also write the run summary JSON to this file")
+    args = parser.parse_args()
+
+    summary = run(args.input, args.output, args.concurrency)
+    print(json.dumps(summary, indent=2))
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+Persistent background job queue for Bedrock calls.
+
+Proposal generation and lead-detail analysis take 10-30 seconds; run inside
+the Streamlit script they freeze the session and a page refresh throws the work
+away. Here they are submitted as jobs to a SQLite queue file and run by a pool
+of worker threads in the app process. The session keeps only the job id, polls
+``job_status`` for the queue position, progress and fields generated so far,
+and reads the result once the job is done, so jobs survive reruns, refreshes
+and (with the session store) a different app instance on the same host.
+
+Jobs are deduplicated: submitting the same kind and arguments while an earlier
+job is queued or running returns that job's id. Finished results are not
+reused here; the result cache (``cached_call``) decides that, with its TTL
+and prompt/model invalidation. A job whose
+worker stopped updating it for JOB_STALE_SECONDS (e.g. the process restarted)
+is picked up again, up to JOB_MAX_ATTEMPTS times.
+
+Job kinds are functions ``fn(args, progress)`` returning a JSON-serializable
+result; ``progress(fraction, partial=None)`` records progress and a partial
+result. ``proposal`` and ``analysis`` are built in and apps may add their own
+with ``register_job_kind``. Workers only claim jobs of kinds registered in
+their process.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from bedrock_cache import cache_key
+from metrics import count, observe
+from proposal_core import generate_proposal_auto, lead_details_for
+
+# SQLite file holding the queue; shared by every app process on the host
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3")
+# Worker threads per process running jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# A running job not updated for this many seconds is taken over by another worker
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Finished jobs (and their results) are kept this many seconds
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(24 * 3600)))
+# Seconds between polls of the queue, by idle workers and by pages waiting on a job
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+# Seconds a page waits for a job it just submitted, so quick (e.g. cached) jobs need no poll
+JOB_INLINE_WAIT = float(os.getenv("JOB_INLINE_WAIT", "0.5"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+logger = logging.getLogger(__name__)
+
+# Top-level fields of a proposal, for progress reporting
+PROPOSAL_FIELD_COUNT = 10
+
+_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"submitted": 0, "deduplicated": 0, "completed": 0, "failed": 0, "retried": 0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def run_proposal_job(args, progress):
+    """Generate a proposal, recording each field as it streams in."""
+    fields = {}
+
+    def on_field(key, value):
+        fields[key] = value
+        progress(min(len(fields) / PROPOSAL_FIELD_COUNT, 0.99), fields)
+
+    return generate_proposal_auto(args["user_input"], on_field)
+
+
+def run_analysis_job(args, progress):
+    """Lead-detail analysis of a proposal."""
+    return lead_details_for(args["user_input"], args["response"])
+
+
+JOB_KINDS = {"proposal": run_proposal_job, "analysis": run_analysis_job}
+
+
+def register_job_kind(kind, fn):
+    """Make ``fn(args, progress)`` available to this process's workers as job kind ``kind``."""
+    JOB_KINDS[kind] = fn
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue with a pool of worker threads.
+
+    A single connection is shared by all threads behind a lock; WAL mode lets
+    several app processes on the same host use the same queue file, and a job
+    is claimed with one atomic UPDATE so two workers never run it twice.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH, workers=JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    dedupe_key TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    partial TEXT,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe_key ON jobs (dedupe_key)")
+
+    def start(self):
+        """Start the worker threads."""
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, kind, args):
+        """Queue a job and return its id (or the id of an identical queued or running job)."""
+        if kind not in JOB_KINDS:
+            raise KeyError(f"Unknown job kind: {kind}")
+        dedupe_key = cache_key(kind, args)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE dedupe_key = ? AND status IN (?, ?) ORDER BY created_at DESC LIMIT 1",
+                (dedupe_key, QUEUED, RUNNING),
+            ).fetchone()
+            if row is not None:
+                _count("deduplicated")
+                return row[0]
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, args, dedupe_key, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(args), dedupe_key, QUEUED, now, now),
+            )
+            # Finished jobs past retention are purged as a side effect
+            self._conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (*FINISHED, now - JOB_RETENTION_SECONDS))
+        _count("submitted")
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def status(self, job_id, wait=0):
+        """
+        Return the job as a dict (``status``, ``progress``, ``partial``,
+        ``result``, ``error`` and, while queued, ``position``), or None if it is
+        unknown. With ``wait`` it blocks up to that many seconds for the job to finish.
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            job = self._load(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in FINISHED or remaining <= 0:
+                return job
+            with self._wakeup:
+                self._wakeup.wait(min(remaining, JOB_POLL_SECONDS))
+
+    def _load(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT kind, status, progress, partial, result, error, created_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            kind, status, progress, partial, result, error, created_at = row
+            position = None
+            if status == QUEUED:
+                (position,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?", (QUEUED, created_at)
+                ).fetchone()
+        return {
+            "id": job_id,
+            "kind": kind,
+            "status": status,
+            "progress": progress,
+            "partial": json.loads(partial) if partial else None,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "position": position,
+        }
+
+    def depth(self):
+        """Number of jobs per status."""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        counts.update(dict(rows))
+        return counts
+
+    def _claim(self):
+        """Atomically take the oldest runnable job of a known kind; returns ``(id, kind, args)`` or None."""
+        now = time.time()
+        kinds = list(JOB_KINDS)
+        marks = ", ".join("?" * len(kinds))
+        with self._lock, self._conn:
+            # Jobs abandoned too often are given up on
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE status = ? AND updated_at < ? AND attempts >= ?",
+                (FAILED, "Job was abandoned by its worker too many times", now, RUNNING, now - JOB_STALE_SECONDS, JOB_MAX_ATTEMPTS),
+            )
+            row = self._conn.execute(
+                f"""SELECT id, kind, args, attempts, created_at FROM jobs
+                WHERE kind IN ({marks}) AND (status = ? OR (status = ? AND updated_at < ?))
+                ORDER BY created_at LIMIT 1""",
+                (*kinds, QUEUED, RUNNING, now - JOB_STALE_SECONDS),
+            ).fetchone()
+            if row is None:
+                return None
+            # Conditional on the job still being runnable, in case another process claimed it first
+            # (UPDATE ... RETURNING would do this in one statement but needs SQLite 3.35)
+            claimed = self._conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ? AND (status = ? OR (status = ? AND updated_at < ?))",
+                (RUNNING, now, row[0], QUEUED, RUNNING, now - JOB_STALE_SECONDS),
+            ).rowcount
+        if not claimed:
+            return None
+        job_id, kind, args, attempts, created_at = row
+        attempts += 1
+        if attempts > 1:
+            _count("retried")
+        observe("job_queue_wait_seconds", now - created_at, kind=kind)
+        return job_id, kind, json.loads(args)
+
+    def _update(self, job_id, **columns):
+        columns["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*columns.values(), job_id))
+
+    def _run(self, job_id, kind, args):
+        def progress(fraction, partial=None):
+            self._update(job_id, progress=fraction, partial=json.dumps(partial) if partial is not None else None)
+
+        started = time.perf_counter()
+        try:
+            result = JOB_KINDS[kind](args, progress)
+        except Exception as e:
+            result = {"error": f"Exception occurred: {e}"}
+        observe("job_run_seconds", time.perf_counter() - started, kind=kind)
+        if isinstance(result, dict) and "error" in result:
+            # Failed jobs are not deduplicated, so submitting again retries
+            self._update(job_id, status=FAILED, error=str(result["error"]))
+            _count("failed")
+            count("jobs_finished_total", kind=kind, status=FAILED)
+        else:
+            self._update(job_id, status=DONE, progress=1.0, result=json.dumps(result))
+            _count("completed")
+            count("jobs_finished_total", kind=kind, status=DONE)
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _work(self):
+        while True:
+            try:
+                claimed = self._claim()
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    logger.exception("Could not claim a job")
+                claimed = None  # Queue file busy; try again after the poll interval
+            except Exception:
+                logger.exception("Could not claim a job")
+                claimed = None
+            if claimed is None:
+                with self._wakeup:
+                    self._wakeup.wait(JOB_POLL_SECONDS)
+                continue
+            try:
+                self._run(*claimed)
+            except Exception as e:
+                # e.g. the result is not JSON-serializable or the queue file is locked; keep the worker alive
+                job_id, kind, _ = claimed
+                logger.exception("Job %s (%s) failed outside its job function", job_id, kind)
+                try:
+                    self._update(job_id, status=FAILED, error=f"Exception occurred: {e}")
+                except sqlite3.Error:
+                    pass  # Left RUNNING; another worker takes it over after JOB_STALE_SECONDS
+                _count("failed")
+                count("jobs_finished_total", kind=kind, status=FAILED)
+
+
+_queue = None
+
+
+def get_job_queue():
+    """Return the process-wide job queue, starting its workers on first use."""
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                queue = JobQueue()
+                queue.start()
+                _queue = queue
+    return _queue
+
+
+def submit_job(kind, **args):
+    """Queue a ``kind`` job with keyword arguments ``args`` and return its id."""
+    return get_job_queue().submit(kind, args)
+
+
+def job_status(job_id, wait=0):
+    """Return the job ``job_id`` (see JobQueue.status), waiting up to ``wait`` seconds for it to finish."""
+    return get_job_queue().status(job_id, wait)
+
+
+def job_queue_stats():
+    """Jobs per status in the queue file and this process's job counters."""
+    queue = get_job_queue()
+    with _stats_lock:
+        stats = dict(_stats)
+    stats.update(queue.depth())
+    stats["workers"] = queue.workers
+    return stats
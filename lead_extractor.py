@@ -0,0 +1,246 @@
+"""
+Rule-based extraction of REQUIRED_LEAD_DETAILS from free text.
+
+Many lead details are written in a predictable way: currency amounts next to
+"revenue", four-digit tax years, US state names and codes, well-known
+accounting packages, entity types. Compiled patterns and lookup tables pull
+these out in microseconds, so the Bedrock analysis only has to be asked about
+the fields left over (or is skipped entirely when every field is found).
+
+Each extractor returns ``(value, confidence)``; only values at or above
+``MIN_CONFIDENCE`` are used, and only those at or above SKIP_LLM_CONFIDENCE
+are trusted enough that Bedrock is not asked about the field. Fields such as
+Industry and Publicly Traded are not written predictably enough and are always
+left to the LLM.
+"""
+import os
+import re
+import threading
+import time
+
+# Lowest confidence at which an extracted value is trusted without the LLM
+MIN_CONFIDENCE = float(os.getenv("EXTRACTOR_MIN_CONFIDENCE", "0.8"))
+# Confidence at which the LLM is not asked about a field at all
+SKIP_LLM_CONFIDENCE = float(os.getenv("EXTRACTOR_SKIP_LLM_CONFIDENCE", "0.9"))
+
+US_STATES = {
+    "AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas", "CA": "California",
+    "CO": "Colorado", "CT": "Connecticut", "DE": "Delaware", "FL": "Florida", "GA": "Georgia",
+    "HI": "Hawaii", "ID": "Idaho", "IL": "Illinois", "IN": "Indiana", "IA": "Iowa",
+    "KS": "Kansas", "KY": "Kentucky", "LA": "Louisiana", "ME": "Maine", "MD": "Maryland",
+    "MA": "Massachusetts", "MI": "Michigan", "MN": "Minnesota", "MS": "Mississippi", "MO": "Missouri",
+    "MT": "Montana", "NE": "Nebraska", "NV": "Nevada", "NH": "New Hampshire", "NJ": "New Jersey",
+    "NM": "New Mexico", "NY": "New York", "NC": "North Carolina", "ND": "North Dakota", "OH": "Ohio",
+    "OK": "Oklahoma", "OR": "Oregon", "PA": "Pennsylvania", "RI": "Rhode Island", "SC": "South Carolina",
+    "SD": "South Dakota", "TN": "Tennessee", "TX": "Texas", "UT": "Utah", "VT": "Vermont",
+    "VA": "Virginia", "WA": "Washington", "WV": "West Virginia", "WI": "Wisconsin", "WY": "Wyoming",
+    "DC": "District of Columbia",
+}
+
+# State codes that are also common English words; only trusted when written in capitals
+AMBIGUOUS_STATE_CODES = {"IN", "OR", "ME", "OK", "HI", "OH", "DE", "PA", "LA", "MA", "AL", "CO", "ID", "MD", "MS"}
+
+ACCOUNTING_SOFTWARE = {
+    "quickbooks online": "QuickBooks Online",
+    "quickbooks desktop": "QuickBooks Desktop",
+    "quickbooks": "QuickBooks",
+    "qbo": "QuickBooks Online",
+    "xero": "Xero",
+    "netsuite": "NetSuite",
+    "sage intacct": "Sage Intacct",
+    "sage": "Sage",
+    "freshbooks": "FreshBooks",
+    "zoho books": "Zoho Books",
+    "wave accounting": "Wave",
+    "microsoft dynamics": "Microsoft Dynamics",
+    "dynamics 365": "Microsoft Dynamics",
+    "myob": "MYOB",
+    "bill.com": "Bill.com",
+    "gusto": "Gusto",
+}
+
+ENTITY_TYPES = {
+    "llc": "LLC",
+    "limited liability company": "LLC",
+    "llp": "LLP",
+    "s corp": "S Corp",
+    "s-corp": "S Corp",
+    "s corporation": "S Corp",
+    "scorp": "S Corp",
+    "c corp": "C Corp",
+    "c-corp": "C Corp",
+    "c corporation": "C Corp",
+    "ccorp": "C Corp",
+    "partnership": "Partnership",
+    "sole proprietorship": "Sole Proprietorship",
+    "sole proprietor": "Sole Proprietorship",
+    "non-profit": "Nonprofit",
+    "nonprofit": "Nonprofit",
+    "501(c)(3)": "Nonprofit",
+}
+
+def _alternation(phrases):
+    # Longest first so "quickbooks online" wins over "quickbooks"
+    return "|".join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+
+
+AMOUNT = r"\$\s?\d[\d,]*(?:\.\d+)?\s*(?:k|m|mm|million|thousand|billion|bn|b)?\b|\d[\d,]*(?:\.\d+)?\s*(?:k|m|mm|million|thousand|billion|bn)\b(?:\s*(?:usd|dollars))?|\d[\d,]*(?:\.\d+)?\s*(?:usd|dollars)\b"
+REVENUE_PATTERN = re.compile(
+    rf"(?:revenue|sales|turnover|gross receipts)\D{{0,40}}?({AMOUNT})|({AMOUNT})\s*(?:in|of|annual|yearly|per year|a year)?\s*(?:annual\s+)?(?:revenue|sales|turnover)",
+    re.I,
+)
+YEAR_PATTERN = re.compile(r"\b(?:FY\s?)?((?:19|20)\d{2})\b", re.I)
+# A year or list of years ("2022 and 2023", "2021-2023")
+YEAR_LIST_PATTERN = re.compile(r"\b(?:FY\s?)?(?:19|20)\d{2}\b(?:\s*(?:,|and|&|-|to|through|or)\s*(?:FY\s?)?(?:19|20)\d{2}\b)*", re.I)
+# Tax wording shortly before a year list ("tax filing for 2022") or right after it ("2022 tax return")
+TAX_CONTEXT_BEFORE = re.compile(r"\b(?:tax(?:es)?|fil(?:e|es|ed|ing)|returns?|fiscal|financial year|FY)\b(?:\W+\w+){0,4}?\W+$", re.I)
+TAX_CONTEXT_AFTER = re.compile(r"^\s+(?:tax|returns?|filings?|fiscal)\b", re.I)
+STATE_NAME_PATTERN = re.compile(rf"\b({_alternation(name for name in US_STATES.values())})\b", re.I)
+STATE_CODE_PATTERN = re.compile(rf"\b({'|'.join(US_STATES)})\b")
+SOFTWARE_PATTERN = re.compile(rf"(?<![\w.])({_alternation(ACCOUNTING_SOFTWARE)})(?![\w])", re.I)
+ENTITY_PATTERN = re.compile(rf"(?<![\w-])({_alternation(ENTITY_TYPES)})(?![\w-])", re.I)
+CLEANUP_PATTERN = re.compile(
+    r"(\d{1,3}|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve)\s+months?\b(?:\W+\w+){0,5}?\W+(?:clean[\s-]?up|catch[\s-]?up|behind|backlog)"
+    r"|(?:clean[\s-]?up|catch[\s-]?up|behind|backlog)(?:\W+\w+){0,5}?\W+(\d{1,3}|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve)\s+months?\b",
+    re.I,
+)
+
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12,
+}
+
+
+def extract_annual_revenue(text):
+    match = REVENUE_PATTERN.search(text)
+    if match:
+        return " ".join((match.group(1) or match.group(2)).split()), 0.9
+    return None, 0.0
+
+
+def extract_year_to_be_filed(text):
+    in_context = []
+    for match in YEAR_LIST_PATTERN.finditer(text):
+        before, after = text[max(0, match.start() - 60):match.start()], text[match.end():match.end() + 20]
+        if TAX_CONTEXT_BEFORE.search(before) or TAX_CONTEXT_AFTER.search(after):
+            in_context.extend(YEAR_PATTERN.findall(match.group(0)))
+    if in_context:
+        return ", ".join(dict.fromkeys(in_context)), 0.95
+    # A year without tax wording may be a founding year or a quantity ("founded in 2015", "2000 units")
+    years = set(YEAR_PATTERN.findall(text))
+    if len(years) == 1:
+        return years.pop(), 0.6
+    return None, 0.0
+
+
+def extract_states(text):
+    states = []
+    for name in STATE_NAME_PATTERN.findall(text):
+        states.append(next(full for full in US_STATES.values() if full.lower() == name.lower()))
+    confidence = 0.9
+    for code in STATE_CODE_PATTERN.findall(text):
+        if code in AMBIGUOUS_STATE_CODES:
+            confidence = 0.6
+        states.append(US_STATES[code])
+    if not states:
+        return None, 0.0
+    unique = list(dict.fromkeys(states))
+    return ", ".join(unique), confidence
+
+
+def extract_software(text):
+    found = list(dict.fromkeys(ACCOUNTING_SOFTWARE[match.lower()] for match in SOFTWARE_PATTERN.findall(text)))
+    if not found:
+        return None, 0.0
+    # Several packages mentioned: the primary one is ambiguous
+    return found[0], 0.9 if len(found) == 1 else 0.5
+
+
+def extract_entity_type(text):
+    found = list(dict.fromkeys(ENTITY_TYPES[match.lower()] for match in ENTITY_PATTERN.findall(text)))
+    if not found:
+        return None, 0.0
+    return found[0], 0.9 if len(found) == 1 else 0.5
+
+
+def extract_months_to_cleanup(text):
+    match = CLEANUP_PATTERN.search(text)
+    if not match:
+        return None, 0.0
+    raw = (match.group(1) or match.group(2)).lower()
+    return str(NUMBER_WORDS.get(raw, raw)), 0.9
+
+
+EXTRACTORS = {
+    "Annual Revenue": extract_annual_revenue,
+    "Entity Type": extract_entity_type,
+    "Primary Accounting Software": extract_software,
+    "Months to Clean-Up": extract_months_to_cleanup,
+    "Year to Be Filed": extract_year_to_be_filed,
+    "States to File Taxes": extract_states,
+}
+
+# Field names used as keys ("Entity Type": ..., Primary Accounting Software: ...) must not count as values
+FIELD_NAME_PATTERN = re.compile(rf"({_alternation([*EXTRACTORS, 'Industry', 'Publicly Traded'])})\"?\s*:", re.I)
+
+_stats_lock = threading.Lock()
+_stats = {
+    "runs": 0,
+    "llm_skipped": 0,
+    "llm_calls": 0,
+    "fields_requested": 0,
+    "fields_extracted": 0,
+    "extract_seconds": 0.0,
+    "llm_seconds": 0.0,
+}
+
+
+def score_lead_details(text, fields, min_confidence=MIN_CONFIDENCE):
+    """
+    Return ``{field: (value, confidence)}`` for the ``fields`` extracted with
+    at least ``min_confidence``. Fields without an extractor are left to the LLM.
+    """
+    started = time.perf_counter()
+    text = FIELD_NAME_PATTERN.sub(" ", text)
+    scored = {}
+    for field in fields:
+        extractor = EXTRACTORS.get(field)
+        if extractor is None:
+            continue
+        value, confidence = extractor(text)
+        if value is not None and confidence >= min_confidence:
+            scored[field] = (value, confidence)
+    with _stats_lock:
+        _stats["runs"] += 1
+        _stats["fields_requested"] += len(fields)
+        _stats["fields_extracted"] += len(scored)
+        _stats["extract_seconds"] += time.perf_counter() - started
+    return scored
+
+
+def extract_lead_details(text, fields, min_confidence=MIN_CONFIDENCE):
+    """Return ``{field: value}`` for the ``fields`` extracted with at least ``min_confidence``."""
+    return {field: value for field, (value, confidence) in score_lead_details(text, fields, min_confidence).items()}
+
+
+def record_llm_path(skipped, seconds=0.0):
+    """Record whether the LLM analysis was skipped, or how long the fallback call took."""
+    with _stats_lock:
+        if skipped:
+            _stats["llm_skipped"] += 1
+        else:
+            _stats["llm_calls"] += 1
+            _stats["llm_seconds"] += seconds
+
+
+def extractor_stats():
+    """Return hit rates and mean latency of the rule-based and LLM paths."""
+    with _stats_lock:
+        stats = dict(_stats)
+    runs, llm_calls = stats["runs"], stats["llm_calls"]
+    stats["llm_skip_rate"] = round(stats["llm_skipped"] / runs, 3) if runs else 0.0
+    stats["field_hit_rate"] = round(stats["fields_extracted"] / stats["fields_requested"], 3) if stats["fields_requested"] else 0.0
+    extract_seconds, llm_seconds = stats.pop("extract_seconds"), stats.pop("llm_seconds")
+    stats["mean_extract_ms"] = round(extract_seconds / runs * 1000, 3) if runs else None
+    stats["mean_llm_seconds"] = round(llm_seconds / llm_calls, 3) if llm_calls else None
+    return stats
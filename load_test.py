@@ -0,0 +1,219 @@
+"""
+Concurrent-session load test of the proposal app.
+
+Simulates reps using one app process at the same time: each simulated user is
+a headless AppTest session of Conversational_matching_proposal_withprice.py
+(by default) that enters a lead, answers the missing REQUIRED_LEAD_DETAILS
+questions, finishes the pricing questionnaire and confirms, again and again,
+against the local Bedrock stand-in with a configurable latency. All sessions
+run in this one process, as they would on one Streamlit server, so they share
+its CPU, Bedrock client, caches and job workers (the harness's own work is in
+the CPU figures too).
+
+Concurrency ramps through ``--levels``; at each level every user loops for
+``--duration`` seconds and the harness reports throughput, lead latency
+percentiles (per lead and per stage), Bedrock calls and reruns per lead, CPU
+and RSS. The saturation point is the last level whose throughput still grew
+by at least ``--min-gain`` over the best level before it. The client-side
+Bedrock rate limiter applies as in production (``--requests-per-minute`` to
+model a different quota); its stats show when the quota is the bottleneck.
+
+    python3 load_test.py --levels 1,2,4,8,16,32 --duration 60 --latency lognormal:2.0:0.4 --output load.json
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from bedrock_stub_server import StubConfig
+from benchmark_flows import PRICING_ANSWERS, SAMPLE_LEADS, STAGES, FlowDriver, distribution, git_commit, prepare_environment
+
+
+def share_app_runtime():
+    """
+    Let AppTest sessions run concurrently. Each AppTest run installs its own
+    mock Streamlit runtime and removes it when it ends, which breaks runs still
+    going on other threads, so every run is given one shared mock instead.
+    """
+    from unittest.mock import MagicMock
+
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+    # Runs restore the option they found on exit, so keep it set for all of them
+    config.set_option("global.appTest", True)
+
+
+def rss_mb():
+    """Current resident set size of this process in MB (peak RSS where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except (OSError, ValueError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+def simulated_user(driver, user, stop_at, latencies, stage_seconds, errors, lock):
+    """Run leads through the app one after another until ``stop_at``."""
+    number = 0
+    while time.perf_counter() < stop_at:
+        number += 1
+        # A distinct text per lead, so every lead reaches Bedrock instead of the result cache
+        text = f"{SAMPLE_LEADS[(user + number) % len(SAMPLE_LEADS)]} (user {user} lead {number})"
+        started = time.perf_counter()
+        try:
+            timings, session = driver.run(text, PRICING_ANSWERS[(user + number) % len(PRICING_ANSWERS)])
+        except Exception as e:  # A failed lead is counted, not fatal to the run
+            with lock:
+                errors.append(f"user {user} lead {number}: {e}")
+            continue
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            for stage, seconds in timings.items():
+                stage_seconds[stage].append(seconds)
+
+
+def run_level(driver, server, reruns, users, duration):
+    """Run ``users`` concurrent simulated users for ``duration`` seconds and measure the level."""
+    latencies, errors, lock = [], [], threading.Lock()
+    stage_seconds = {stage: [] for stage in STAGES}
+    requests_before, reruns_before = server.stats["requests"], reruns[0]
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    stop_at = started + duration
+    threads = [
+        threading.Thread(target=simulated_user, args=(driver, user, stop_at, latencies, stage_seconds, errors, lock), name=f"user-{user}")
+        for user in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    completed = len(latencies)
+    return {
+        "users": users,
+        "elapsed_seconds": round(elapsed, 3),
+        "completed": completed,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "leads_per_minute": round(completed / elapsed * 60, 2),
+        "lead_seconds": distribution(latencies),
+        "stages": {stage: distribution(values) for stage, values in stage_seconds.items()},
+        "bedrock_calls_per_lead": round((server.stats["requests"] - requests_before) / completed, 2) if completed else None,
+        "reruns_per_lead": round((reruns[0] - reruns_before) / completed, 2) if completed else None,
+        "cpu_percent": round((cpu_seconds() - cpu_before) / elapsed * 100, 1),
+        "rss_mb": rss_mb(),
+        "throttled": server.stats.get("throttled", 0),
+    }
+
+
+def saturation_point(levels, min_gain):
+    """Users of the last level whose throughput grew by at least ``min_gain`` over every earlier level."""
+    best, saturated_at = 0.0, None
+    for level in levels:
+        if level["leads_per_minute"] >= best * (1 + min_gain):
+            best, saturated_at = level["leads_per_minute"], level["users"]
+    return saturated_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramp concurrent simulated sessions against the proposal app.")
+    parser.add_argument(
+        "--app",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "Conversational_matching_proposal_withprice.py"),
+        help="Streamlit app to drive",
+    )
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated numbers of concurrent users")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds each level runs")
+    parser.add_argument("--latency", default="lognormal:2.0:0.4", help="Bedrock stand-in latency: fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of a throttled Bedrock request")
+    parser.add_argument("--max-inflight", type=int, default=0, help="Stand-in throttles requests beyond this many in flight (0 = no limit)")
+    parser.add_argument("--provided-details", type=int, default=4, help="Lead details the stand-in reports as provided")
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        help="Bedrock request quota the client-side rate limiter enforces (default: BEDROCK_REQUESTS_PER_MINUTE)",
+    )
+    parser.add_argument("--tokens-per-minute", type=float, help="Bedrock token quota (default: BEDROCK_TOKENS_PER_MINUTE)")
+    parser.add_argument("--background-jobs", type=int, choices=(0, 1), default=1, help="Run Bedrock calls as background jobs (BACKGROUND_JOBS)")
+    parser.add_argument("--poll-seconds", type=float, default=0.5, help="Pause between reruns while waiting on a background job")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds a stage may take before the lead counts as failed")
+    parser.add_argument("--min-gain", type=float, default=0.1, help="Throughput growth a level needs to count as unsaturated")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results JSON to this file")
+    args = parser.parse_args()
+
+    # The rate limiter reads its quota when the app first imports it
+    if args.requests_per_minute:
+        os.environ["BEDROCK_REQUESTS_PER_MINUTE"] = str(args.requests_per_minute)
+    if args.tokens_per_minute:
+        os.environ["BEDROCK_TOKENS_PER_MINUTE"] = str(args.tokens_per_minute)
+    server, reruns = prepare_environment(
+        StubConfig(
+            latency=args.latency,
+            throttle_rate=args.throttle_rate,
+            max_inflight=args.max_inflight,
+            provided_details=args.provided_details,
+            seed=args.seed,
+        ),
+        args.background_jobs,
+    )
+    share_app_runtime()
+    driver = FlowDriver(os.path.abspath(args.app), args.timeout, args.poll_seconds, reruns)
+
+    levels = []
+    print(f"{'users':>6} {'leads/min':>10} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'errors':>7} {'cpu %':>7} {'rss MB':>8}", file=sys.stderr)
+    for users in (int(level) for level in args.levels.split(",")):
+        level = run_level(driver, server, reruns, users, args.duration)
+        levels.append(level)
+        latency = level["lead_seconds"]
+        print(
+            f"{users:>6} {level['leads_per_minute']:>10.1f} {latency.get('p50') or 0:>8.2f} {latency.get('p95') or 0:>8.2f}"
+            f" {latency.get('p99') or 0:>8.2f} {level['errors']:>7} {level['cpu_percent']:>7.1f} {level['rss_mb']:>8.1f}",
+            file=sys.stderr,
+        )
+    server.shutdown()
+
+    from bedrock_rate_limit import rate_limit_stats
+
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "app": args.app,
+            "latency": args.latency,
+            "duration_seconds": args.duration,
+            "background_jobs": bool(args.background_jobs),
+            "cpu_count": os.cpu_count(),
+        },
+        "levels": levels,
+        "saturation_users": saturation_point(levels, args.min_gain),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        # Waits here mean the Bedrock quota, not this process, is the limit
+        "bedrock_rate_limiter": rate_limit_stats(),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
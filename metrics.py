@@ -0,0 +1,314 @@
+"""
+Lightweight timing spans and counters for the hot paths.
+
+The Bedrock call (queueing, the request itself, reading the body), parsing of
+model responses, result-cache lookups, retries, token usage, background jobs
+and script reruns report here. Everything is kept in process memory:
+
+- counters, e.g. ``count("result_cache_lookups_total", namespace="proposal", result="hit")``
+- latency histograms, fed by ``with span("bedrock_request"):`` or ``observe(name, seconds)``
+
+``prometheus_text()`` renders them in the Prometheus text format; the API
+server serves it at ``/metrics`` and a Streamlit process can serve it on
+METRICS_PORT. Spans and counts recorded on a thread bound to a session (see
+``start_rerun``) are also kept per session for the app's debug panel.
+
+With METRICS=0 every call returns at once: ``span`` hands back a shared no-op
+object and ``count``/``observe`` return before taking any lock.
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cachetools import LRUCache
+
+# Record metrics; set METRICS=0 to turn instrumentation into no-ops
+METRICS = os.getenv("METRICS", "1") == "1"
+# Serve /metrics from Streamlit processes on this port (0 = no exporter; the API server has its own)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Recent spans kept per session for the debug panel
+METRICS_SESSION_SPANS = int(os.getenv("METRICS_SESSION_SPANS", "50"))
+
+# Upper bounds in seconds, from in-memory work to slow Bedrock calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_sessions = LRUCache(maxsize=1000)
+_session = contextvars.ContextVar("metrics_session", default=None)
+_exporter = None
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, as Prometheus expects it."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile ``q`` (None when empty)."""
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class SessionMetrics:
+    """What one session's reruns did: reruns, counters, span totals and the latest spans."""
+
+    def __init__(self):
+        self.reruns = 0
+        self.counters = {}
+        self.spans = {}
+        self.recent = deque(maxlen=METRICS_SESSION_SPANS)
+
+    def add_span(self, name, labels, seconds):
+        total = self.spans.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        total["count"] += 1
+        total["total_seconds"] += seconds
+        total["max_seconds"] = max(total["max_seconds"], seconds)
+        self.recent.append({"span": name, **labels, "ms": round(seconds * 1000, 2)})
+
+    def summary(self):
+        return {
+            "reruns": self.reruns,
+            "counters": dict(self.counters),
+            "spans": {
+                name: {
+                    "count": total["count"],
+                    "total_ms": round(total["total_seconds"] * 1000, 1),
+                    "mean_ms": round(total["total_seconds"] / total["count"] * 1000, 1),
+                    "max_ms": round(total["max_seconds"] * 1000, 1),
+                }
+                for name, total in self.spans.items()
+            },
+            "recent": list(self.recent),
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def count(name, amount=1, **labels):
+    """Add ``amount`` to the counter ``name`` (by convention ending in ``_total``)."""
+    if not METRICS:
+        return
+    key = _key(name, labels)
+    recorder = _session.get()
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+        if recorder is not None:
+            recorder.counters[name] = recorder.counters.get(name, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """Record ``seconds`` in the histogram ``name`` (by convention ending in ``_seconds``)."""
+    if not METRICS:
+        return
+    key = _key(name, labels)
+    recorder = _session.get()
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+        if recorder is not None:
+            recorder.add_span(name, labels, seconds)
+
+
+class Span:
+    """
+    Times a block into the histogram ``<name>_seconds``; a block that raises
+    also counts ``<name>_errors_total``. Use as a context manager, or call
+    ``stop()`` where a ``with`` block does not fit (e.g. a whole script run).
+    """
+
+    __slots__ = ("name", "labels", "started")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.started = time.perf_counter()
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop(error=exc_type is not None)
+        return False
+
+    def stop(self, error=False):
+        observe(self.name + "_seconds", time.perf_counter() - self.started, **self.labels)
+        if error:
+            count(self.name + "_errors_total", **self.labels)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def stop(self, error=False):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **labels):
+    """Span timing a block into ``<name>_seconds``; a shared no-op when METRICS is off."""
+    if not METRICS:
+        return _NOOP_SPAN
+    return Span(name, labels)
+
+
+def bind_session(session_id):
+    """
+    Attribute what this thread (and calls it hands to the Bedrock executor)
+    records from now on to ``session_id``, for ``session_metrics``.
+    """
+    if not METRICS or session_id is None:
+        return None
+    with _lock:
+        recorder = _sessions.get(session_id)
+        if recorder is None:
+            recorder = _sessions[session_id] = SessionMetrics()
+    _session.set(recorder)
+    return recorder
+
+
+def start_rerun(session_id, app):
+    """
+    Bind the script thread to ``session_id``, count the rerun and return a
+    started span of the script run; call its ``stop()`` at the end of the script.
+    """
+    if not METRICS:
+        return _NOOP_SPAN
+    start_exporter()
+    recorder = bind_session(session_id)
+    if recorder is not None:
+        with _lock:
+            recorder.reruns += 1
+    count("app_reruns_total", app=app)
+    return Span("app_rerun", {"app": app})
+
+
+def session_metrics(session_id):
+    """Reruns, counters, span totals and recent spans recorded for ``session_id``."""
+    with _lock:
+        recorder = _sessions.get(session_id)
+        return recorder.summary() if recorder is not None else {}
+
+
+def metrics_summary():
+    """Counters and, per histogram, count, mean and approximate p50/p95 (bucket upper bounds)."""
+    def name_of(key):
+        name, labels = key
+        return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+
+    with _lock:
+        counters = {name_of(key): value for key, value in sorted(_counters.items())}
+        histograms = {
+            name_of(key): {
+                "count": h.count,
+                "mean_ms": round(h.sum / h.count * 1000, 2) if h.count else None,
+                "p50_ms": h.quantile(0.5) * 1000 if h.count else None,
+                "p95_ms": h.quantile(0.95) * 1000 if h.count else None,
+            }
+            for key, h in sorted(_histograms.items())
+        }
+    return {"enabled": METRICS, "counters": counters, "histograms": histograms}
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = ((name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def prometheus_text():
+    """All counters and histograms in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, list(h.counts), h.sum, h.count, h.buckets) for key, h in _histograms.items())
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_label_text(labels)} {value}")
+    for (name, labels), counts, total, observations, buckets in histograms:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {observations}")
+        lines.append(f"{name}_sum{_label_text(labels)} {total}")
+        lines.append(f"{name}_count{_label_text(labels)} {observations}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the app log
+
+
+def start_exporter(port=None):
+    """
+    Serve ``/metrics`` on ``port`` (METRICS_PORT) from a daemon thread, once
+    per process. If another process on the host already has the port, this one
+    is not exported.
+    """
+    global _exporter
+    port = METRICS_PORT if port is None else port
+    if _exporter is not None or not port:
+        return _exporter
+    with _lock:
+        if _exporter is None:
+            try:
+                server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+            except OSError:
+                server = False
+            else:
+                threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+            _exporter = server
+    return _exporter
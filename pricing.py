@@ -0,0 +1,192 @@
+"""
+Table-driven pricing of tax filing quotes.
+
+Prices come from a versioned rate table instead of code, so a rate change is a
+new table entry and the whole pipeline can be re-priced against it. A quote is
+the ``dynamic_details`` dict collected by handle_dynamic_questions:
+
+- ``Filing Type``: "Personal", "Business" or "Both"
+- ``Self Employment Income``: "Yes-1040-C" or "No" (personal filings)
+- ``Number of Businesses``: business filings, default 1
+- ``Business Entities``: optional per-business answers as columns,
+  ``{"State": [...], "Legal Structure": [...]}`` (or the older per-business keys
+  ``Business {i} State`` / ``Business {i} Legal Structure``)
+
+``calculate_price`` prices one quote for the UI; ``price_quotes`` prices a
+whole DataFrame of quotes in one vectorized pass.
+
+    python3 pricing.py quotes.jsonl repriced.csv --rate-version v1
+"""
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+RATE_TABLES = {
+    "v1": {
+        # Personal return price by self-employment answer; "default" for anything else
+        "personal": {"Yes-1040-C": 350, "default": 300},
+        # Business return price per business
+        "business": 540,
+        # Extra per business by legal structure
+        "legal_structure": {"Partnership - 1065": 0, "S Corp - 1120-S": 0, "C Corp - 1120": 0},
+        # Extra per business filing in a state (keys are lower-case state codes); "default" for unlisted states
+        "state": {"default": 0},
+        "overage": 75,
+    },
+}
+
+# Rate table used when none is given; PRICING_RATE_TABLES may point to a JSON file of extra tables
+RATE_VERSION = os.getenv("PRICING_RATE_VERSION", "v1")
+if os.getenv("PRICING_RATE_TABLES"):
+    with open(os.environ["PRICING_RATE_TABLES"], encoding="utf-8") as f:
+        RATE_TABLES.update(json.load(f))
+
+PERSONAL_FILINGS = ("Personal", "Both")
+BUSINESS_FILINGS = ("Business", "Both")
+BUSINESS_ENTITIES = "Business Entities"
+STRUCTURE_COLUMN = re.compile(r"^Business (\d+) Legal Structure$")
+STATE_COLUMN = re.compile(r"^Business (\d+) State$")
+
+
+def rate_table(version=None):
+    """Return the rate table for ``version`` (default: PRICING_RATE_VERSION)."""
+    version = version or RATE_VERSION
+    if version not in RATE_TABLES:
+        raise KeyError(f"Unknown rate table version: {version}")
+    return RATE_TABLES[version]
+
+
+def _state_key(state):
+    return str(state).strip().lower()
+
+
+def entity_addons(entities, rates):
+    """Summed legal-structure and state add-ons of columnar ``entities``."""
+    structures = pd.Series(entities.get("Legal Structure", []), dtype="object")
+    states = pd.Series(entities.get("State", []), dtype="object").dropna().astype(str).str.strip().str.lower()
+    total = float(
+        structures.map(rates["legal_structure"]).fillna(0).sum()
+        + states[states != ""].map(rates["state"]).fillna(rates["state"]["default"]).sum()
+    )
+    # Whole-dollar rate tables keep whole-dollar prices
+    return int(total) if total.is_integer() else total
+
+
+def calculate_price(dynamic_details, version=None):
+    """Price one quote; returns ``(price, overage_cost, total_price)``."""
+    rates = rate_table(version)
+    filing_type = dynamic_details.get("Filing Type")
+    price = 0
+
+    if filing_type in PERSONAL_FILINGS:
+        personal = rates["personal"]
+        price += personal.get(dynamic_details.get("Self Employment Income"), personal["default"])
+
+    if filing_type in BUSINESS_FILINGS:
+        price += rates["business"] * dynamic_details.get("Number of Businesses", 1)
+        if dynamic_details.get(BUSINESS_ENTITIES):
+            price += entity_addons(dynamic_details[BUSINESS_ENTITIES], rates)
+        for key, value in dynamic_details.items():
+            if STRUCTURE_COLUMN.match(key):
+                price += rates["legal_structure"].get(value, 0)
+            elif STATE_COLUMN.match(key) and value:
+                price += rates["state"].get(_state_key(value), rates["state"]["default"])
+
+    overage_cost = rates["overage"]
+    total_price = price + overage_cost
+    return price, overage_cost, total_price
+
+
+def price_quotes(quotes, version=None):
+    """
+    Price every row of a DataFrame of quotes (columns named like the
+    ``dynamic_details`` keys) and return a DataFrame with ``Base Price``,
+    ``Overage Cost``, ``Total Price`` and ``Rate Version`` aligned to it.
+    """
+    rates = rate_table(version)
+    rows = len(quotes)
+    filing_type = quotes["Filing Type"] if "Filing Type" in quotes else pd.Series(None, index=quotes.index, dtype="object")
+    personal = filing_type.isin(PERSONAL_FILINGS).to_numpy(dtype=bool)
+    business = filing_type.isin(BUSINESS_FILINGS).to_numpy(dtype=bool)
+
+    price = np.zeros(rows)
+    if "Self Employment Income" in quotes:
+        personal_rates = quotes["Self Employment Income"].map(rates["personal"]).fillna(rates["personal"]["default"])
+        price += np.where(personal, personal_rates.to_numpy(dtype=float), 0)
+    else:
+        price += np.where(personal, rates["personal"]["default"], 0)
+
+    businesses = (
+        pd.to_numeric(quotes["Number of Businesses"], errors="coerce").fillna(1).to_numpy(dtype=float)
+        if "Number of Businesses" in quotes
+        else np.ones(rows)
+    )
+    business_price = businesses * rates["business"]
+    for column in quotes.columns:
+        if STRUCTURE_COLUMN.match(str(column)):
+            business_price += quotes[column].map(rates["legal_structure"]).fillna(0).to_numpy(dtype=float)
+        elif STATE_COLUMN.match(str(column)):
+            states = quotes[column]
+            given = (states.notna() & (states.astype(str).str.strip() != "")).to_numpy(dtype=bool)
+            addon = states.astype(str).str.strip().str.lower().map(rates["state"]).fillna(rates["state"]["default"])
+            business_price += np.where(given, addon.to_numpy(dtype=float), 0)
+    if BUSINESS_ENTITIES in quotes:
+        business_price += batch_entity_addons(quotes[BUSINESS_ENTITIES], rates)
+    price += np.where(business, business_price, 0)
+
+    return pd.DataFrame(
+        {
+            "Base Price": price,
+            "Overage Cost": float(rates["overage"]),
+            "Total Price": price + rates["overage"],
+            "Rate Version": version or RATE_VERSION,
+        },
+        index=quotes.index,
+    )
+
+
+def batch_entity_addons(entities, rates):
+    """Entity add-ons for a Series of columnar entity dicts, flattened and priced in one pass."""
+    entities = entities.reset_index(drop=True)
+    columns = entities.map(lambda e: e if isinstance(e, dict) else {})
+    structures = columns.map(lambda e: e.get("Legal Structure", [])).explode().dropna()
+    states = columns.map(lambda e: e.get("State", [])).explode().dropna().astype(str).str.strip().str.lower()
+    states = states[states != ""]
+    addons = np.zeros(len(entities))
+    np.add.at(addons, structures.index.to_numpy(dtype=int), structures.map(rates["legal_structure"]).fillna(0).to_numpy(dtype=float))
+    np.add.at(addons, states.index.to_numpy(dtype=int), states.map(rates["state"]).fillna(rates["state"]["default"]).to_numpy(dtype=float))
+    return addons
+
+
+def read_quotes(path):
+    """Read quotes from CSV or JSONL; JSONL rows may nest answers under ``dynamic_details``."""
+    if path.endswith(".csv"):
+        return pd.read_csv(path).convert_dtypes()
+    quotes = pd.read_json(path, lines=True, dtype=False)
+    if "dynamic_details" in quotes:
+        details = pd.json_normalize(quotes.pop("dynamic_details").apply(lambda d: d if isinstance(d, dict) else {}).tolist(), max_level=0)
+        quotes = quotes.join(details.set_axis(quotes.index))
+    # Nullable dtypes keep integer columns with gaps (ids, business counts) as integers
+    return quotes.convert_dtypes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-price a file of quotes against a rate table.")
+    parser.add_argument("input", help="CSV or JSONL file of quotes")
+    parser.add_argument("output", help="CSV file the priced quotes are written to")
+    parser.add_argument("--rate-version", default=RATE_VERSION, help="Rate table version to price with")
+    args = parser.parse_args()
+
+    quotes = read_quotes(args.input)
+    prices = price_quotes(quotes, args.rate_version)
+    priced = quotes.drop(columns=prices.columns, errors="ignore").join(prices)
+    priced.to_csv(args.output, index=False)
+    print(f"Priced {len(priced)} quotes with rate table {args.rate_version}")
+
+
+if __name__ == "__main__":
+    main()
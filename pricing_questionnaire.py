@@ -0,0 +1,172 @@
+"""
+State machine behind the pricing questionnaire.
+
+A ``QuestionFlow`` holds the questions and, for each question, a transition
+that picks the next question from the answers so far. ``Questionnaire`` walks
+a flow one answer at a time, so the current question is a dict lookup and the
+UI only renders that question's widgets. Answers land in the ``details`` dict
+that ``pricing.calculate_price`` reads (the apps' ``dynamic_details``).
+
+Per-business answers are edited as one table (or uploaded as CSV) and stored
+as columns, ``{"State": [...], "Legal Structure": [...]}``, so validating and
+pricing hundreds of entities is one vectorized pass.
+
+Nothing here imports Streamlit; the apps render ``Questionnaire.current``.
+"""
+import numpy as np
+import pandas as pd
+
+from lead_extractor import US_STATES
+from pricing import BUSINESS_ENTITIES, BUSINESS_FILINGS, PERSONAL_FILINGS
+
+FILING_TYPES = ["Personal", "Business", "Both"]
+LEGAL_STRUCTURES = ["Partnership - 1065", "S Corp - 1120-S", "C Corp - 1120"]
+ENTITY_COLUMNS = ["State", "Legal Structure"]
+
+STATE_CODES = {name.lower(): code for code, name in US_STATES.items()}
+STATE_CODES.update({code.lower(): code for code in US_STATES})
+
+
+class Question:
+    """One question: the ``details`` key it fills, its prompt, widget type and options."""
+
+    __slots__ = ("key", "prompt", "widget", "options")
+
+    def __init__(self, key, prompt, widget, options=None):
+        self.key = key
+        self.prompt = prompt
+        self.widget = widget
+        self.options = options
+
+
+class QuestionFlow:
+    """Questions keyed by ``details`` key, with ``transitions[key](details) -> next key or None``."""
+
+    def __init__(self, start, questions, transitions):
+        self.start = start
+        self.questions = {question.key: question for question in questions}
+        self.transitions = transitions
+
+
+class Questionnaire:
+    """Progress through a QuestionFlow; ``details`` is updated in place as questions are answered."""
+
+    __slots__ = ("flow", "details", "state", "answered")
+
+    def __init__(self, flow, details=None):
+        self.flow = flow
+        self.details = {} if details is None else details
+        self.state = flow.start
+        self.answered = 0
+
+    @property
+    def current(self):
+        """The question to ask now, or None once the flow is finished."""
+        return self.flow.questions[self.state] if self.state is not None else None
+
+    @property
+    def done(self):
+        return self.state is None
+
+    def answer(self, value):
+        """Record the answer to the current question and move to the next one."""
+        if isinstance(value, dict):
+            self.details.update(value)
+        else:
+            self.details[self.state] = value
+        self.answered += 1
+        self.state = self.flow.transitions[self.state](self.details)
+
+
+def after_filing_type(details):
+    return "Self Employment Income" if details["Filing Type"] in PERSONAL_FILINGS else "Number of Businesses"
+
+
+def after_self_employment(details):
+    return "Number of Businesses" if details["Filing Type"] in BUSINESS_FILINGS else None
+
+
+def after_number_of_businesses(details):
+    return "Businesses in Same State"
+
+
+def after_same_state(details):
+    return BUSINESS_ENTITIES if details["Businesses in Same State"] == "No" else None
+
+
+def finished(details):
+    return None
+
+
+PRICING_FLOW = QuestionFlow(
+    "Filing Type",
+    [
+        Question("Filing Type", "What is your filing type?", "selectbox", FILING_TYPES),
+        Question("Self Employment Income", "Do you have self-employment income?", "radio", ["Yes-1040-C", "No"]),
+        Question("Number of Businesses", "How many businesses do you own?", "number"),
+        Question("Businesses in Same State", "Are all businesses in the same state?", "radio", ["Yes", "No"]),
+        Question(BUSINESS_ENTITIES, "Enter the state and legal structure of each business.", "entities", LEGAL_STRUCTURES),
+    ],
+    {
+        "Filing Type": after_filing_type,
+        "Self Employment Income": after_self_employment,
+        "Number of Businesses": after_number_of_businesses,
+        "Businesses in Same State": after_same_state,
+        BUSINESS_ENTITIES: finished,
+    },
+)
+
+
+def entity_table(count):
+    """Blank entity table with one row per business, as shown in the editor."""
+    return pd.DataFrame({"State": [""] * count, "Legal Structure": [LEGAL_STRUCTURES[0]] * count})
+
+
+def apply_entity_edits(table, edits):
+    """Apply a data editor's edit record (edited, added and deleted rows) to ``table``."""
+    table = table.copy()
+    for row, changes in (edits.get("edited_rows") or {}).items():
+        for column, value in changes.items():
+            table.loc[int(row), column] = value
+    if edits.get("deleted_rows"):
+        table = table.drop(index=edits["deleted_rows"])
+    if edits.get("added_rows"):
+        added = pd.DataFrame(edits["added_rows"], columns=ENTITY_COLUMNS)
+        table = pd.concat([table, added.fillna({"State": "", "Legal Structure": LEGAL_STRUCTURES[0]})])
+    return table.reset_index(drop=True)
+
+
+def read_entity_csv(file):
+    """Read an uploaded CSV with ``State`` and ``Legal Structure`` columns."""
+    table = pd.read_csv(file, dtype=str, keep_default_na=False)
+    missing = [column for column in ENTITY_COLUMNS if column not in table]
+    if missing:
+        raise ValueError(f"CSV is missing columns: {', '.join(missing)}")
+    return table[ENTITY_COLUMNS]
+
+
+def validate_entities(table, max_errors=20):
+    """
+    Validate every row of an entity table at once. Returns ``(entities,
+    errors)``: the columnar entities with states normalized to two-letter codes,
+    and up to ``max_errors`` messages for rows that are not valid.
+    """
+    states = table["State"].fillna("").astype(str).str.strip()
+    codes = states.str.lower().map(STATE_CODES)
+    structures = table["Legal Structure"]
+    bad_state = codes.isna().to_numpy()
+    bad_structure = (~structures.isin(LEGAL_STRUCTURES)).to_numpy()
+
+    errors = []
+    for row in np.flatnonzero(bad_state | bad_structure)[:max_errors]:
+        problems = []
+        if bad_state[row]:
+            problems.append(f"unknown state {states.iat[row]!r}")
+        if bad_structure[row]:
+            problems.append(f"unknown legal structure {structures.iat[row]!r}")
+        errors.append(f"Business {row + 1}: {', '.join(problems)}")
+    if len(table) == 0:
+        errors.append("Enter at least one business.")
+
+    entities = {"State": codes.tolist(), "Legal Structure": structures.tolist()}
+    return entities, errors
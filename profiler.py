@@ -0,0 +1,187 @@
+"""
+Opt-in profiling of single script runs.
+
+Streamlit executes the whole app script on every interaction, so the question
+is where one run spends its time: our code, Streamlit element building, or
+library setup. With PROFILE_RERUNS=1 (every run), or with PROFILE_QUERY=1 and
+``?profile=1`` in the URL (runs of that page only), a script run is profiled
+in two ways at once:
+
+- a sampler thread records the script thread's stack every PROFILE_INTERVAL
+  seconds, written as collapsed stacks (``frame;frame;frame count`` lines) that
+  flamegraph.pl, speedscope or inferno render directly
+- cProfile, written as a table of the PROFILE_TOP functions by cumulative time
+
+Both files go to PROFILE_DIR, named by time, app, flow stage (generate,
+analyze, qa, pricing, ...) and session, e.g.
+``20240101-120000.123-withprice-qa-1a2b3c4d.collapsed``. cProfile slows
+call-heavy code down, which inflates its share of the samples; compare
+flamegraphs with each other rather than with wall time of unprofiled runs.
+Only the newest PROFILE_MAX_FILES files are kept; older ones are deleted.
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Profile every script run
+PROFILE_RERUNS = os.getenv("PROFILE_RERUNS", "0") == "1"
+# Also profile runs whose URL carries ?profile=1; off by default so visitors cannot switch profiling on
+PROFILE_QUERY = os.getenv("PROFILE_QUERY", "0") == "1"
+# Directory profiles are written to
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Files kept in PROFILE_DIR (two per run); the oldest are deleted beyond this (0 = keep all)
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+# Seconds between stack samples
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# Functions listed in the cumulative-time table
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))
+# Sampling stops after this many seconds, in case a run never reaches its end
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+
+# Profile still open per script thread; a run cut short by st.rerun() is closed by the next one started
+_open = {}
+_lock = threading.Lock()
+
+
+def frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def prune_profiles(directory=PROFILE_DIR, keep=PROFILE_MAX_FILES):
+    """Delete the oldest profile files in ``directory`` beyond the newest ``keep``."""
+    if not keep:
+        return
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith((".collapsed", ".top.txt"))]
+    except OSError:
+        return
+    # Names start with the run's start time, so they sort oldest first
+    for name in sorted(names)[:-keep]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass  # Already removed by another run's pruning
+
+
+class RerunProfile:
+    """Sampled stacks and cProfile statistics of one script run on the calling thread."""
+
+    def __init__(self, app, session_id=None, interval=PROFILE_INTERVAL):
+        self.app = app
+        self.session_id = session_id
+        self.stage = "unknown"
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self._profile = cProfile.Profile()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="rerun-profiler", daemon=True)
+
+    def start(self):
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self._sampler.start()
+        self._profile.enable()
+        return self
+
+    def tag(self, stage=None, session_id=None):
+        """Name the flow stage (and session) the run serves, for the file names."""
+        if stage is not None:
+            self.stage = stage
+        if session_id is not None:
+            self.session_id = session_id
+
+    def _sample(self):
+        deadline = time.monotonic() + PROFILE_MAX_SECONDS
+        while not self._stopped.wait(self.interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self, finished=True):
+        """Stop profiling and write the collapsed stacks and the top-N table; returns their paths."""
+        self._profile.disable()
+        self._stopped.set()
+        self._sampler.join()
+        seconds = time.perf_counter() - self.started
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = "-".join(
+            part for part in (
+                self.started_at.strftime("%Y%m%d-%H%M%S.%f")[:-3],
+                self.app,
+                self.stage,
+                (self.session_id or "")[:8],
+            ) if part
+        )
+        base = os.path.join(PROFILE_DIR, name)
+
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+        table = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=table)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+        with open(base + ".top.txt", "w", encoding="utf-8") as f:
+            f.write(
+                f"app: {self.app}\nstage: {self.stage}\nsession: {self.session_id}\n"
+                f"wall seconds: {seconds:.3f}\nsamples: {self.samples} every {self.interval}s\n"
+            )
+            if not finished:
+                f.write("run did not reach the end of the script (st.rerun or an exception); cut off when the next run started\n")
+            f.write(table.getvalue())
+        prune_profiles()
+        return [base + ".collapsed", base + ".top.txt"]
+
+
+class _NoProfile:
+    def tag(self, stage=None, session_id=None):
+        pass
+
+    def stop(self, finished=True):
+        return []
+
+
+_NO_PROFILE = _NoProfile()
+
+
+def start_rerun_profile(query_params, app):
+    """
+    Start profiling this script run if PROFILE_RERUNS is set, or PROFILE_QUERY
+    is set and ``query_params`` (``st.query_params``) has ``profile=1``. Pass the result
+    to ``stop_rerun_profile`` at the end of the script; without profiling both
+    do nothing.
+    """
+    thread_id = threading.get_ident()
+    alive = {thread.ident for thread in threading.enumerate()}
+    with _lock:
+        unfinished = [_open.pop(ident) for ident in list(_open) if ident == thread_id or ident not in alive]
+    for profile in unfinished:
+        profile.stop(finished=False)
+    if not (PROFILE_RERUNS or (PROFILE_QUERY and query_params.get("profile") == "1")):
+        return _NO_PROFILE
+    profile = RerunProfile(app)
+    with _lock:
+        _open[thread_id] = profile
+    return profile.start()
+
+
+def stop_rerun_profile(profile):
+    """Finish ``profile`` at the end of a script run; returns the written paths."""
+    with _lock:
+        if _open.get(threading.get_ident()) is profile:
+            del _open[threading.get_ident()]
+    return profile.stop()
@@ -0,0 +1,420 @@
+"""
+Core proposal logic shared by the Streamlit apps and the headless tools.
+
+Everything here is free of Streamlit so it can run outside a script rerun:
+proposal generation and lead-detail analysis through Bedrock (cached,
+rate limited and coalesced by the bedrock_* modules), the tax classifier and
+pricing.
+"""
+import json
+import os
+import time
+
+from bedrock_cache import cache_key, cached_call, normalize_text
+from bedrock_runtime import invoke_model, invoke_model_stream, record_usage
+from lead_extractor import SKIP_LLM_CONFIDENCE, record_llm_path, score_lead_details
+from metrics import observe
+from proposal_stream import IncrementalJSONParser, iter_text_deltas
+from tax_classifier import is_tax_related
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+# Bump when a prompt changes so cached results from the old prompt are not reused
+ANALYZE_PROMPT_VERSION = "analyze-v1"
+PROPOSAL_PROMPT_VERSION = "proposal-v2"
+FUSED_PROMPT_VERSION = "fused-v1"
+
+# Mark the static proposal prompt for Bedrock prompt caching
+PROMPT_CACHING = os.getenv("BEDROCK_PROMPT_CACHING", "1") == "1"
+
+# For tax-related input, generate the proposal and extract the lead details in one call
+FUSED_TAX_MODE = os.getenv("FUSED_TAX_MODE", "1") == "1"
+
+# List of required lead details
+REQUIRED_LEAD_DETAILS = {
+    "Annual Revenue": "What is the approximate annual revenue of your business?",
+    "Industry": "Which industry does your business operate in?",
+    "Entity Type": "What is the entity type of your business (e.g., LLC, Corporation)?",
+    "Publicly Traded": "Is your business publicly traded or privately held?",
+    "Primary Accounting Software": "What is the primary accounting software your business uses (e.g., QuickBooks, Xero)?",
+    "Months to Clean-Up": "How many months of clean-up are needed?",
+    "Year to Be Filed": "Which financial year do you want to file taxes for?",
+    "States to File Taxes": "Which states do you need to file taxes in?",
+}
+
+# Static part of the proposal prompt (service catalog, instructions, output schema)
+PROPOSAL_SYSTEM_PROMPT = """    You are FinancialExpertAI, assigned to create a detailed SUMMARY PROPOSAL based on the provided requirements. 
+Your task includes identifying the specific services, required skills, and relevant certifications from the given lists. 
+The summary should be thorough, precise, and tailored to the mentioned requirements and available options.
+
+Required Services:
+
+    - Bookkeeping Clean Up
+    - Accounting Advisory
+    - Monthly Bookkeeping Support
+    - Implementation of Accounting Software
+    - Tax Filing
+    - Tax Preparation
+    - Basic Monthly Bookkeeping Support
+    - Premium Monthly Bookkeeping Support
+    - Plus Monthly Bookkeeping Support
+
+Required Skills:
+
+    - Tax Filing
+    - Accounting
+    - Auditing
+    - Financial Analysis & Management
+    - Data & Analytics
+    - Compliance & Regulation
+    - Soft Skills & General Management
+
+Required Certificates:
+
+    - Accredited in Business Valuations (ABV)
+    - Certified Public Accountant (CPA)
+    - Chartered Financial Analyst (CFA)
+    
+Required Service Lines: 
+
+    - Tax Preparation
+    - CPA/Accounting Advisory
+    - Full Charge Bookkeeping
+    - FP&A
+    - CFO
+
+Instructions:
+
+- **Proposal Description:** Summarize the customer's requirements within this heading. Ensure that all provided information is addressed without adding anything extra.
+- **Required Services:** From the list of available services, identify the specific services needed based on the customer's requirements. Present this as a list.
+- **Required Skills:** Identify the required skills that correspond to the selected services. Present this as a list.
+- **Required Certifications:** Identify the necessary certifications from the provided list based on the identified services and skills. Present this as a list.
+- **Required Software:** Mention any software requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
+- **Required Service Line:** From the list of Required Service Lines, identify the specific services needed based on the customer's requirements. Present this as a list. 
+- **Required Language:** Mention any Language requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
+- **Required Location and Time Zones:** Mention any location, time zone, or location radius if specified by the client. If not mentioned, state 'Not Mentioned'.
+- **Required Teams:** Mention any Teams requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
+- **Start/End Dates:** Mention any Start/End Dates or any Timeline requirements if specified by the client. If not mentioned, state 'Not Mentioned'.
+
+Return the response as a valid JSON object, **not a string**. The output must follow this exact format:
+
+{
+    "Proposal Description": "<Your detailed summary here>",
+    "Required Services": ["<Service 1>", "<Service 2>", "<Service N>"],
+    "Required Skills": ["<Skill 1>", "<Skill 2>", "<Skill N>"],
+    "Required Certifications": ["<Certification 1>", "<Certification 2>", "<Certification N>"],
+    "Required Software": "<Software name or 'Not Mentioned'>",
+    "Required Service Line": ["<Service Line 1>", "<Service Line 2>", "<Service Line N>"],
+    "Required Language": "<Language or 'Not Mentioned'>",
+    "Required Location and Time Zones": "<Location or 'Not Mentioned'>",
+    "Required Teams": "<Teams or 'Not Mentioned'>",
+    "Start/End Dates": "<Dates or 'Not Mentioned'>"
+}
+
+Ensure the response is a valid JSON object, without extra formatting or escape characters."""
+
+# Appended to the proposal prompt in fused mode so one call also extracts the lead details
+FUSED_DETAILS_PROMPT = f"""
+Lead details:
+
+In the same JSON object, also report the lead details found in the user input. The required lead details are:
+{json.dumps(list(REQUIRED_LEAD_DETAILS.keys()))}
+
+Add these two keys after "Start/End Dates":
+    "provided_details": A dictionary of the required lead details given in the user input, keyed by the names above.
+    "missing_details": A list of the required lead details that are not given in the user input.
+"""
+
+# Keys a fused response carries in addition to the proposal fields
+LEAD_DETAIL_KEYS = ("provided_details", "missing_details")
+
+
+def analyze_details_with_bedrock(user_input, model_response, fields=None):
+    """
+    Analyze user input and model response to extract provided details and identify missing ones using Bedrock.
+    ``fields`` restricts the analysis to a subset of the required lead details.
+    """
+    prompt = f"""
+    You are a highly intelligent assistant responsible for analyzing user input and a model-generated response. Your task is to:
+
+    1. Extract any lead details provided in either the user input or the model response.
+    2. Identify missing details based on the required lead details list and ask questions to collect them.
+    3. Return a structured JSON output.
+
+    The required lead details are:
+    {json.dumps(list(fields or REQUIRED_LEAD_DETAILS.keys()))}
+
+    Analyze the following inputs:
+    - **User Input:** {user_input}
+    - **Model Response:** {json.dumps(model_response)}
+
+    Return the results as a JSON object with these keys:
+    - "provided_details": A dictionary of all extracted lead details.
+    - "missing_details": A list of missing lead details, if any.
+    """
+
+    try:
+        # Prepare the request parameters
+        request_parameters = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": 1000,
+            "temperature": 0,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        request_body = json.dumps(request_parameters)
+
+        # Invoke the Bedrock model (rate limited, retried on throttling) and decode the body
+        response_body = invoke_model(MODEL_ID, request_body)
+
+        if not response_body:
+            return {"error": "Empty response from the model"}
+        parse_started = time.perf_counter()
+
+        # Debugging: log the raw response
+        # st.write("Raw model response:", response_body)
+
+        # Check if the response body contains valid JSON and strip extra content
+        try:
+            # Extract the first valid JSON object from the response
+            start_index = response_body.find("{")
+            if start_index == -1:
+                return {"error": "No JSON object found in model response"}
+
+            # Extract the valid JSON string
+            valid_json_str = response_body[start_index:]
+
+            # Parse the valid JSON
+            result_json = json.loads(valid_json_str)
+            record_usage(result_json.get("usage"))
+
+            # Log the parsed JSON for further debugging
+            # st.write("Parsed model response:", result_json)
+        except json.JSONDecodeError as e:
+            return {"error": f"JSON parsing error: {str(e)}"}
+
+        # Access the 'content' field and parse the details from the first item
+        model_content = result_json.get("content", [])
+        if not model_content:
+            return {"error": "No content found in model response"}
+
+        content = model_content[0].get("text", "")
+        # Extract the valid JSON part from the content
+        json_start_index = content.find("{")
+        json_end_index = content.rfind("}") + 1  # Ensure the full JSON is captured
+
+        if json_start_index == -1 or json_end_index == -1:
+            return {"error": "No valid JSON object found in content"}
+
+        # Extract the JSON string and parse it
+        valid_json_str = content[json_start_index:json_end_index]
+        try:
+            details_json = json.loads(valid_json_str)
+        except json.JSONDecodeError as e:
+            return {"error": f"Error extracting JSON from content: {str(e)}"}
+
+        observe("response_parse_seconds", time.perf_counter() - parse_started, call="analyze")
+
+        # Now, extract the provided and missing details
+        provided_details = details_json.get("provided_details", {})
+        missing_details = details_json.get("missing_details", [])
+
+        if not provided_details and not missing_details:
+            return {"error": "No provided or missing details found in model response"}
+
+        return {
+            "provided_details": provided_details,
+            "missing_details": missing_details
+        }
+
+    except Exception as e:
+        return {"error": f"Exception occurred: {str(e)}"}
+
+
+def analyze_details_cached(user_input, model_response, fields=None):
+    """
+    Memoized analyze_details_with_bedrock. Streamlit reruns the script on every
+    interaction, so the same analysis is served from the process-wide cache
+    instead of calling Bedrock again.
+    """
+    fields = list(fields or REQUIRED_LEAD_DETAILS)
+    key = cache_key(ANALYZE_PROMPT_VERSION, user_input, model_response, MODEL_ID, fields)
+    return cached_call(
+        key,
+        lambda: analyze_details_with_bedrock(user_input, model_response, fields),
+        namespace="analyze",
+        template_version=ANALYZE_PROMPT_VERSION,
+        model_id=MODEL_ID,
+    )
+
+
+def build_proposal_request(user_input, fused=False):
+    """
+    Build the Bedrock request body for a proposal from the user input.
+
+    The static catalog and instructions go in a system block marked for prompt
+    caching, so only the user input is processed fresh on each call. With
+    ``fused`` the prompt also asks for the lead details, so the reply carries
+    ``provided_details`` and ``missing_details`` next to the proposal fields.
+    """
+    system_text = PROPOSAL_SYSTEM_PROMPT + FUSED_DETAILS_PROMPT if fused else PROPOSAL_SYSTEM_PROMPT
+    system_block = {"type": "text", "text": system_text}
+    if PROMPT_CACHING:
+        system_block["cache_control"] = {"type": "ephemeral"}
+
+    # Prepare request parameters
+    request_parameters = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 2000,
+        "temperature": 0,
+        "system": [system_block],
+        "messages": [
+            {"role": "user", "content": "User Input: " + user_input}
+        ],
+    }
+    return json.dumps(request_parameters)
+
+
+def generate_proposal(user_input, fused=False):
+    """Generate a tailored financial proposal using Bedrock."""
+    try:
+        request_body = build_proposal_request(user_input, fused)
+
+        # Invoke the Bedrock model (rate limited, retried on throttling) and read the body
+        response_body = invoke_model(MODEL_ID, request_body)
+
+        # Validate response
+        if not response_body or not response_body.strip():
+            return {"error": "Empty or invalid response from the model"}
+
+        # Parse response content
+        parse_started = time.perf_counter()
+        raw_content = json.loads(response_body)
+        record_usage(raw_content.get("usage"))
+        content_text = raw_content.get("content")[0]["text"]
+        proposal = json.loads(content_text)  # Final parsed JSON object
+        observe("response_parse_seconds", time.perf_counter() - parse_started, call="proposal")
+        return proposal
+
+    except Exception as e:
+        return {"error": f"Exception occurred: {str(e)}"}
+
+
+def generate_proposal_streaming(user_input, on_field, fused=False):
+    """
+    Generate a proposal with a streamed Bedrock response. ``on_field(key, value)``
+    is called for each top-level proposal field as soon as its value is complete.
+    """
+    try:
+        started = time.perf_counter()
+        response = invoke_model_stream(MODEL_ID, build_proposal_request(user_input, fused))
+
+        parser = IncrementalJSONParser()
+        usage = {}
+        first_token_seconds = None
+        for text in iter_text_deltas(response, usage):
+            if first_token_seconds is None:
+                first_token_seconds = time.perf_counter() - started
+            for key, value in parser.feed(text):
+                on_field(key, value)
+        record_usage(usage, first_token_seconds)
+
+        if not parser.text.strip():
+            return {"error": "Empty or invalid response from the model"}
+
+        return json.loads(parser.text)  # Final parsed JSON object
+
+    except Exception as e:
+        return {"error": f"Exception occurred: {str(e)}"}
+
+
+def generate_proposal_cached(user_input, on_field=None, fused=False):
+    """
+    Cached generate_proposal. The prompt runs at temperature 0, so the same
+    normalized input always yields the same proposal and is served from the
+    result cache. With ``on_field`` the proposal is streamed on a miss and
+    replayed field by field on a hit.
+    """
+    version = FUSED_PROMPT_VERSION if fused else PROPOSAL_PROMPT_VERSION
+    key = cache_key(version, normalize_text(user_input), MODEL_ID)
+    cache_options = {"namespace": "fused" if fused else "proposal", "template_version": version, "model_id": MODEL_ID}
+    if on_field is None:
+        return cached_call(key, lambda: generate_proposal(user_input, fused), **cache_options)
+
+    streamed = []
+
+    def forward(field_key, value):
+        streamed.append(field_key)
+        on_field(field_key, value)
+
+    result = cached_call(key, lambda: generate_proposal_streaming(user_input, forward, fused), **cache_options)
+    if not streamed and "error" not in result:
+        for field_key, value in result.items():
+            on_field(field_key, value)
+    return result
+
+
+def generate_proposal_auto(user_input, on_field=None):
+    """
+    Generate a proposal, using fused mode for tax-related input so the lead
+    details come back in the same call. ``on_field`` only sees proposal fields.
+    """
+    fused = FUSED_TAX_MODE and is_tax_related(user_input)
+    if on_field is not None and fused:
+        proposal_field = on_field
+
+        def on_field(key, value):
+            if key not in LEAD_DETAIL_KEYS:
+                proposal_field(key, value)
+
+    return generate_proposal_cached(user_input, on_field, fused)
+
+
+def embedded_lead_details(model_response):
+    """
+    Take the lead details out of a fused response and return them, or None
+    if it has none. The response is left with the proposal fields only, as in
+    non-fused mode.
+    """
+    if not isinstance(model_response.get("missing_details"), list):
+        return None
+    return {
+        "provided_details": model_response.pop("provided_details", None) or {},
+        "missing_details": model_response.pop("missing_details"),
+    }
+
+
+def analyze_lead_details(user_input, model_response, analyze=analyze_details_cached, required=REQUIRED_LEAD_DETAILS):
+    """
+    Return the lead-detail analysis, extracting what the rules can from
+    ``user_input`` first and asking ``analyze(user_input, model_response,
+    fields)`` only about the fields not extracted with SKIP_LLM_CONFIDENCE.
+    Bedrock is not called at all when every required field is.
+
+    Less certain rule matches are still asked about: the LLM's answer wins,
+    and the rule value is only used when the LLM reports the field neither
+    provided nor missing.
+    """
+    scored = score_lead_details(user_input, list(required))
+    trusted = {field: value for field, (value, confidence) in scored.items() if confidence >= SKIP_LLM_CONFIDENCE}
+    remaining = [field for field in required if field not in trusted]
+    if not remaining:
+        record_llm_path(skipped=True)
+        return {"provided_details": trusted, "missing_details": []}
+
+    started = time.perf_counter()
+    result = analyze(user_input, model_response, remaining)
+    record_llm_path(skipped=False, seconds=time.perf_counter() - started)
+    if result.get("error"):
+        return result
+    provided = result.get("provided_details") or {}
+    missing = [field for field in result.get("missing_details") or [] if field not in trusted]
+    fallback = {field: value for field, (value, confidence) in scored.items() if field not in provided and field not in missing}
+    return {
+        "provided_details": {**fallback, **provided, **trusted},
+        "missing_details": missing,
+    }
+
+
+def lead_details_for(user_input, model_response):
+    """Return the lead-detail analysis, calling Bedrock only if the response does not carry it."""
+    return embedded_lead_details(model_response) or analyze_lead_details(user_input, model_response)
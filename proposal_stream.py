@@ -0,0 +1,126 @@
+"""
+Helpers for streaming Claude responses from Bedrock.
+
+``invoke_model_with_response_stream`` delivers the completion as a series of
+small text deltas. ``iter_text_deltas`` unwraps those events and
+``IncrementalJSONParser`` consumes the text as it arrives, reporting each
+top-level member of the proposal JSON object as soon as its value is complete
+so the UI can render it before the rest of the completion has been generated.
+"""
+import json
+
+
+def iter_text_deltas(stream_response, usage=None):
+    """
+    Yield the text of each content delta in a Bedrock response stream.
+
+    If ``usage`` is a dict it is updated in place with the token usage reported
+    by the ``message_start`` and ``message_delta`` events.
+    """
+    for event in stream_response["body"]:
+        chunk = event.get("chunk")
+        if not chunk:
+            continue
+        payload = json.loads(chunk["bytes"])
+        event_type = payload.get("type")
+        if event_type == "content_block_delta":
+            text = payload.get("delta", {}).get("text")
+            if text:
+                yield text
+        elif usage is not None and event_type == "message_start":
+            usage.update(payload.get("message", {}).get("usage", {}))
+        elif usage is not None and event_type == "message_delta":
+            usage.update(payload.get("usage", {}))
+
+
+class IncrementalJSONParser:
+    """
+    Incrementally scan a JSON object and report completed top-level members.
+
+    Text before the opening brace (a model preamble) is ignored. ``feed``
+    returns the ``(key, value)`` pairs completed by the new text, in order.
+    The full text is kept so the caller can still ``json.loads`` the whole
+    document once the stream ends.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        completed = []
+        text = self.text
+
+        while self._pos < len(text) and not self.done:
+            i = self._pos
+            c = text[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        if self._key is None:
+                            self._key = json.loads(text[self._key_start:i + 1])
+                        elif self._value_start is not None:
+                            self._complete(text[self._value_start:i + 1], completed)
+                continue
+
+            if self._depth == 0:
+                if c == "{":
+                    self._depth = 1
+                continue
+
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    if self._key is None:
+                        self._key_start = i
+                    elif self._value_start is None:
+                        self._value_start = i
+            elif c in "{[":
+                if self._depth == 1 and self._value_start is None:
+                    self._value_start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._value_start is not None:
+                    self._complete(text[self._value_start:i + 1], completed)
+                elif self._depth == 0:
+                    # A trailing scalar value is terminated by the closing brace
+                    if self._value_start is not None:
+                        self._complete(text[self._value_start:i], completed)
+                    self.done = True
+            elif self._depth == 1:
+                if c == ",":
+                    if self._value_start is not None:
+                        self._complete(text[self._value_start:i], completed)
+                elif c not in " \t\r\n:" and self._key is not None and self._value_start is None:
+                    # Start of a number, true, false or null
+                    self._value_start = i
+
+        return completed
+
+    def _complete(self, raw_value, completed):
+        key = self._key
+        self._key = None
+        self._value_start = None
+        try:
+            value = json.loads(raw_value.strip())
+        except json.JSONDecodeError:
+            return  # Leave it to the final json.loads of the whole document to report
+        self.fields[key] = value
+        completed.append((key, value))
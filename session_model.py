@@ -0,0 +1,286 @@
+"""
+Compact per-session state for the proposal apps.
+
+All workflow state of a Streamlit session lives in one ``ProposalSession``
+stored under ``st.session_state.proposal_session`` instead of a dozen loose
+keys. Fields are ``__slots__`` attributes, lead-detail keys are interned so
+sessions share one copy of each field name, and the chat log is append-only
+with sender codes in a byte array.
+
+``to_bytes``/``from_bytes`` give a fast binary form (marshal of builtins only,
+so loading it never runs code). ``memory_bytes`` measures a session and
+``enforce_memory_cap`` trims the oldest chat messages, and the record of the
+questions they asked, once a session grows past ``SESSION_MAX_BYTES``;
+``session_stats`` sums this over the live sessions. The proposal response and
+the lead details are never trimmed because the flow still needs them, so the
+cap bounds what grows with the conversation, not the session as a whole.
+"""
+import marshal
+import os
+import sys
+import threading
+import weakref
+from array import array
+
+# Per-session memory cap in bytes; the oldest chat messages are dropped beyond it
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(512 * 1024)))
+
+FORMAT_VERSION = 1
+MARSHAL_VERSION = 4
+
+SENDERS = ("Bot", "User")
+SENDER_CODES = {sender: code for code, sender in enumerate(SENDERS)}
+
+_live_sessions = weakref.WeakSet()
+_stats_lock = threading.Lock()
+_stats = {"created": 0, "restored": 0, "trimmed_messages": 0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def intern_keys(details):
+    """Copy of ``details`` with interned keys, so every session shares one copy of each field name."""
+    return {sys.intern(key) if isinstance(key, str) else key: value for key, value in details.items()}
+
+
+def deep_size(obj, seen=None):
+    """Approximate memory of ``obj`` and everything it references, counting shared objects once."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name) and name != "__weakref__")
+    return size
+
+
+class ChatLog:
+    """Append-only chat log: sender codes in a byte array, messages in a parallel list."""
+
+    __slots__ = ("senders", "messages")
+
+    def __init__(self):
+        self.senders = array("B")
+        self.messages = []
+
+    def append(self, sender, message):
+        self.senders.append(SENDER_CODES[sender])
+        self.messages.append(message)
+
+    def __iter__(self):
+        for code, message in zip(self.senders, self.messages):
+            yield SENDERS[code], message
+
+    def __len__(self):
+        return len(self.messages)
+
+    def drop_oldest(self, count):
+        del self.senders[:count]
+        del self.messages[:count]
+
+
+class ProposalSession:
+    """Workflow state of one proposal session."""
+
+    __slots__ = (
+        "user_input",
+        "response",
+        "lead_details",
+        "final_response",
+        "collected_details",
+        "missing_keys",
+        "dynamic_details",
+        "price_details",
+        "chat_log",
+        "asked_questions",
+        "process_started",
+        "show_final_response",
+        "show_price_estimation_button",
+        "price_estimation_started",
+        "questionnaire",
+        "entity_errors",
+        "tax_checked_input",
+        "is_tax_input",
+        "proposal_job",
+        "analysis_job",
+        "session_id",
+        "__weakref__",
+    )
+
+    def __init__(self):
+        self.user_input = ""
+        self.response = None
+        # Lead details taken out of a fused proposal response
+        self.lead_details = None
+        self.final_response = None
+        self.collected_details = {}
+        self.missing_keys = []
+        self.dynamic_details = {}
+        self.price_details = {}
+        self.chat_log = ChatLog()
+        self.asked_questions = set()
+        self.process_started = False
+        self.show_final_response = False
+        self.show_price_estimation_button = False
+        self.price_estimation_started = False
+        self.questionnaire = None
+        self.entity_errors = []
+        self.tax_checked_input = None
+        self.is_tax_input = False
+        # Ids of background jobs (job_queue) the page is waiting on
+        self.proposal_job = None
+        self.analysis_job = None
+        # Set by the session store; not part of the snapshot
+        self.session_id = None
+        _live_sessions.add(self)
+        _count("created")
+
+    def log_chat(self, sender, message):
+        """Log a chat message; a question the bot already asked is not logged again."""
+        if sender == "Bot" and message in self.asked_questions:
+            return
+        self.chat_log.append(sender, message)
+        if sender == "Bot":
+            self.asked_questions.add(sys.intern(message))
+
+    def collect(self, details):
+        """Add lead details (keys interned)."""
+        self.collected_details.update(intern_keys(details))
+
+    def memory_bytes(self):
+        # The question flow is shared by all sessions, so it is not counted
+        seen = {id(self.questionnaire.flow)} if self.questionnaire is not None else None
+        return deep_size(self, seen)
+
+    def enforce_memory_cap(self, limit=None):
+        """
+        Drop the oldest chat messages until the session fits ``limit`` bytes;
+        returns how many were dropped. Questions whose messages are dropped are
+        forgotten too (one may be logged again if the bot repeats it). A
+        session whose response and details alone exceed ``limit`` stays above it.
+        """
+        limit = SESSION_MAX_BYTES if limit is None else limit
+        dropped = 0
+        size = self.memory_bytes()
+        while size > limit and self.chat_log:
+            # Drop a quarter of the log at a time so large logs need few re-measurements
+            count = max(1, len(self.chat_log) // 4)
+            self.chat_log.drop_oldest(count)
+            dropped += count
+            self.asked_questions.intersection_update(self.chat_log.messages)
+            size = self.memory_bytes()
+        if dropped:
+            _count("trimmed_messages", dropped)
+        return dropped
+
+    def snapshot(self):
+        """
+        Field name -> builtin value for every persisted field. Fields are
+        grouped so that a session store can write only the ones that changed.
+        """
+        questionnaire = None
+        if self.questionnaire is not None:
+            questionnaire = (self.questionnaire.state, self.questionnaire.answered)
+        return {
+            "user_input": self.user_input,
+            "response": self.response,
+            "lead_details": self.lead_details,
+            "final_response": self.final_response,
+            "collected_details": self.collected_details,
+            "missing_keys": self.missing_keys,
+            "dynamic_details": self.dynamic_details,
+            "price_details": self.price_details,
+            "chat_log": (bytes(self.chat_log.senders), self.chat_log.messages),
+            "asked_questions": sorted(self.asked_questions),
+            "flags": (
+                self.process_started,
+                self.show_final_response,
+                self.show_price_estimation_button,
+                self.price_estimation_started,
+                self.tax_checked_input,
+                self.is_tax_input,
+            ),
+            "questionnaire": questionnaire,
+            "entity_errors": self.entity_errors,
+            "jobs": (self.proposal_job, self.analysis_job),
+        }
+
+    @classmethod
+    def restore(cls, values, flow=None):
+        """Rebuild a session from ``snapshot`` values; ``flow`` restores the pricing questionnaire."""
+        session = cls()
+        session.user_input = values.get("user_input", "")
+        session.response = values.get("response")
+        session.lead_details = values.get("lead_details")
+        session.final_response = values.get("final_response")
+        session.collected_details = intern_keys(values.get("collected_details") or {})
+        session.missing_keys = values.get("missing_keys") or []
+        session.dynamic_details = intern_keys(values.get("dynamic_details") or {})
+        session.price_details = values.get("price_details") or {}
+        senders, messages = values.get("chat_log") or (b"", [])
+        session.chat_log.senders = array("B", senders)
+        session.chat_log.messages = list(messages)
+        session.asked_questions = {sys.intern(question) for question in values.get("asked_questions") or ()}
+        if values.get("flags"):
+            (
+                session.process_started,
+                session.show_final_response,
+                session.show_price_estimation_button,
+                session.price_estimation_started,
+                session.tax_checked_input,
+                session.is_tax_input,
+            ) = values["flags"]
+        session.entity_errors = values.get("entity_errors") or []
+        session.proposal_job, session.analysis_job = values.get("jobs") or (None, None)
+        questionnaire = values.get("questionnaire")
+        if questionnaire is not None and flow is not None:
+            # Imported here so this module stays free of pricing dependencies
+            from pricing_questionnaire import Questionnaire
+
+            session.questionnaire = Questionnaire(flow, session.dynamic_details)
+            session.questionnaire.state, session.questionnaire.answered = questionnaire
+        _count("restored")
+        return session
+
+    def to_bytes(self):
+        """Serialize to a compact binary form (the pricing questionnaire is stored as its position)."""
+        return marshal.dumps((FORMAT_VERSION, self.snapshot()), MARSHAL_VERSION)
+
+    @classmethod
+    def from_bytes(cls, data, flow=None):
+        """Rebuild a session from ``to_bytes`` output."""
+        version, values = marshal.loads(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported session format version: {version}")
+        return cls.restore(values, flow)
+
+
+def session_from(state):
+    """Return the ProposalSession kept in a Streamlit ``st.session_state``, creating it on first use."""
+    if "proposal_session" not in state:
+        state["proposal_session"] = ProposalSession()
+    return state["proposal_session"]
+
+
+def session_stats():
+    """Number of live sessions, their total and largest memory, and cap trims so far."""
+    sizes = [session.memory_bytes() for session in list(_live_sessions)]
+    with _stats_lock:
+        stats = dict(_stats)
+    stats.update(
+        {
+            "live_sessions": len(sizes),
+            "total_bytes": sum(sizes),
+            "max_bytes": max(sizes, default=0),
+            "cap_bytes": SESSION_MAX_BYTES,
+        }
+    )
+    return stats
@@ -0,0 +1,303 @@
+"""
+Externalized storage of proposal sessions.
+
+Each session is kept as a hash (field -> marshalled value) in a backend that
+speaks the Redis hash commands ``hset``/``hgetall``/``expire``/``delete``:
+
+- ``sqlite`` (default): a local SQLite file in WAL mode, shared by every app
+  process on the host
+- ``redis://...``: a Redis server, so instances on several hosts behind a load
+  balancer share sessions (needs the ``redis`` package)
+- ``memory``: an in-process stand-in with the same interface
+- ``off``: sessions live only in ``st.session_state``
+
+Only the fields whose value changed since the last save are written, so a
+rerun that answers one question writes one small field. The session id is
+carried in the URL (``?session=...``); any instance that receives it loads
+the session from the store and carries on. An id the store does not know
+(expired, mistyped or made up) starts a new session under a fresh id.
+"""
+import hashlib
+import logging
+import marshal
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from cachetools import LRUCache
+
+from metrics import span
+from session_model import MARSHAL_VERSION, ProposalSession
+
+# Backend: "sqlite" / "sqlite:///path", "redis://host:port/db", "memory" or "off"
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite")
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.sqlite3")
+# Seconds an idle session is kept
+SESSION_TTL = int(os.getenv("SESSION_STORE_TTL", str(7 * 24 * 3600)))
+
+_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+
+class SQLiteHashClient:
+    """
+    The subset of the Redis hash API the session store uses, on a local SQLite file.
+
+    A single connection is shared by all threads behind a lock; WAL mode lets
+    several app processes on the same host read while one writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS session_fields (
+                    name TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    PRIMARY KEY (name, field)
+                ) WITHOUT ROWID"""
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_expiry (name TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS session_expiry_at ON session_expiry (expires_at)")
+
+    def hset(self, name, mapping):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO session_fields VALUES (?, ?, ?)",
+                [(name, field, value) for field, value in mapping.items()],
+            )
+        return len(mapping)
+
+    def hgetall(self, name):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT expires_at FROM session_expiry WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] <= now:
+                self._delete(name)
+                return {}
+            rows = self._conn.execute("SELECT field, value FROM session_fields WHERE name = ?", (name,)).fetchall()
+        return {field: bytes(value) for field, value in rows}
+
+    def expire(self, name, seconds):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO session_expiry VALUES (?, ?)", (name, time.time() + seconds))
+            # Expired sessions of other users are purged as a side effect
+            expired = [row[0] for row in self._conn.execute("SELECT name FROM session_expiry WHERE expires_at <= ?", (time.time(),))]
+            for old in expired:
+                self._delete(old)
+        return True
+
+    def delete(self, *names):
+        with self._lock, self._conn:
+            for name in names:
+                self._delete(name)
+        return len(names)
+
+    def _delete(self, name):
+        self._conn.execute("DELETE FROM session_fields WHERE name = ?", (name,))
+        self._conn.execute("DELETE FROM session_expiry WHERE name = ?", (name,))
+
+
+class MemoryHashClient:
+    """In-process stand-in for the Redis hash API (single instance, lost on restart)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._expiry = {}
+
+    def hset(self, name, mapping):
+        with self._lock:
+            self._hashes.setdefault(name, {}).update(mapping)
+        return len(mapping)
+
+    def hgetall(self, name):
+        with self._lock:
+            if self._expiry.get(name, float("inf")) <= time.time():
+                self._hashes.pop(name, None)
+                self._expiry.pop(name, None)
+            return dict(self._hashes.get(name, {}))
+
+    def expire(self, name, seconds):
+        with self._lock:
+            self._expiry[name] = time.time() + seconds
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            for name in names:
+                self._hashes.pop(name, None)
+                self._expiry.pop(name, None)
+        return len(names)
+
+
+def redis_client(url):
+    """Redis client for ``url``; the redis package is only needed when this backend is chosen."""
+    try:
+        import redis
+    except ImportError as e:
+        raise RuntimeError("SESSION_STORE=redis://... needs the redis package (pip install redis)") from e
+    return redis.Redis.from_url(url)
+
+
+def encode(session):
+    """Field name -> (marshalled value, digest) for every snapshot field of ``session``."""
+    encoded = {}
+    for field, value in session.snapshot().items():
+        data = marshal.dumps(value, MARSHAL_VERSION)
+        encoded[field] = (data, hashlib.blake2b(data, digest_size=16).digest())
+    return encoded
+
+
+class SessionStore:
+    """Load and incrementally save ProposalSessions in a Redis-compatible hash client."""
+
+    def __init__(self, client, ttl=SESSION_TTL, prefix="proposal-session:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats = {"loads": 0, "resumed": 0, "saves": 0, "fields_written": 0, "bytes_written": 0}
+        self._lock = threading.Lock()
+        # Digest of each field as last written, per session id; an evicted entry just means a full write
+        self._written = LRUCache(maxsize=10000)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.stats[name] += amount
+
+    def load(self, session_id, flow=None):
+        """Return the stored session for ``session_id``, or None if there is none."""
+        self._count(loads=1)
+        with span("session_store_read"):
+            fields = self.client.hgetall(self.prefix + session_id)
+        if not fields:
+            return None
+        values = {}
+        for field, data in fields.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            values[field] = marshal.loads(data)
+        session = ProposalSession.restore(values, flow)
+        session.session_id = session_id
+        # Digests of the restored session, so the next save only writes what the user changes
+        with self._lock:
+            self._written[session_id] = {field: digest for field, (data, digest) in encode(session).items()}
+        self._count(resumed=1)
+        return session
+
+    def save(self, session):
+        """Write the fields of ``session`` that changed since it was last saved or loaded."""
+        if session.session_id is None:
+            return 0
+        encoded = encode(session)
+        with self._lock:
+            previous = self._written.get(session.session_id, {})
+        changed = {field: data for field, (data, digest) in encoded.items() if previous.get(field) != digest}
+        if not changed:
+            return 0
+        name = self.prefix + session.session_id
+        with span("session_store_write"):
+            self.client.hset(name, mapping=changed)
+            if self.ttl:
+                self.client.expire(name, self.ttl)
+        with self._lock:
+            self._written[session.session_id] = {field: digest for field, (data, digest) in encoded.items()}
+        self._count(saves=1, fields_written=len(changed), bytes_written=sum(len(data) for data in changed.values()))
+        return len(changed)
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+        with self._lock:
+            self._written.pop(session_id, None)
+
+
+_store = None
+# Why the store could not be opened; it is then treated as off for the life of the process
+_store_error = None
+
+
+def get_session_store():
+    """
+    Return the process-wide session store for SESSION_STORE, or None when it
+    is off or cannot be opened (e.g. an unwritable path or no redis package).
+    """
+    global _store, _store_error
+    if _store is None and _store_error is None and SESSION_STORE != "off":
+        with _lock:
+            if _store is None and _store_error is None:
+                try:
+                    if SESSION_STORE.startswith("redis://") or SESSION_STORE.startswith("rediss://"):
+                        client = redis_client(SESSION_STORE)
+                    elif SESSION_STORE == "memory":
+                        client = MemoryHashClient()
+                    else:
+                        path = SESSION_STORE[len("sqlite:///"):] if SESSION_STORE.startswith("sqlite:///") else SESSION_STORE_PATH
+                        client = SQLiteHashClient(path)
+                except Exception as e:
+                    # Logged once; sessions then live only in st.session_state
+                    logger.exception("Could not open the session store %s; sessions will not be persisted", SESSION_STORE)
+                    _store_error = str(e) or type(e).__name__
+                else:
+                    _store = SessionStore(client)
+    return _store
+
+
+def attach_session(state, query_params, flow=None):
+    """
+    Return this browser session's ProposalSession, kept in ``state``
+    (``st.session_state``). On the first run it is resumed from the store when
+    ``query_params`` (``st.query_params``) carries a ``session`` id the store
+    holds; otherwise a new session is started under a new id, which is put in
+    the URL.
+    """
+    if "proposal_session" in state:
+        return state["proposal_session"]
+
+    store = get_session_store()
+    session_id = query_params.get("session")
+    session = None
+    if store is not None and session_id:
+        try:
+            session = store.load(session_id, flow)
+        except Exception:
+            # Store unreachable, or a snapshot that is corrupt or marshalled by another Python version
+            logger.exception("Could not resume session %s; starting a new one", session_id)
+            session = None
+    if session is None:
+        session = ProposalSession()
+        session.session_id = uuid.uuid4().hex
+    if store is not None:
+        query_params["session"] = session.session_id
+    state["proposal_session"] = session
+    return session
+
+
+def save_session(session):
+    """Write the changed fields of ``session`` to the store (no-op when the store is off)."""
+    store = get_session_store()
+    if store is None:
+        return 0
+    try:
+        return store.save(session)
+    except Exception:
+        # Persistence must never break the page, whichever backend failed
+        logger.exception("Could not save session %s", session.session_id)
+        return 0
+
+
+def session_store_stats():
+    store = get_session_store()
+    if store is None:
+        return {"backend": "off", "error": _store_error} if _store_error else {"backend": "off"}
+    with store._lock:
+        stats = dict(store.stats)
+    stats["backend"] = type(store.client).__name__
+    return stats
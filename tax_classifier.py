@@ -0,0 +1,99 @@
+"""
+Keyword classifier deciding whether a lead is about tax services.
+
+All keywords are compiled into one case-insensitive, word-bounded pattern, so
+a text is scanned once and "syntax" or "profiling" no longer count as "tax" or
+"filing", while hyphenated wording such as "tax-exempt", "pre-tax" or
+"e-filing" still does. Each keyword carries a weight; a text is tax-related when the summed
+weight of the distinct keywords it mentions reaches ``TAX_THRESHOLD``.
+
+The keyword set can be replaced with ``TAX_KEYWORDS``, a comma-separated list
+of ``keyword:weight`` pairs (weight defaults to 1).
+"""
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache, cached
+
+DEFAULT_TAX_KEYWORDS = {
+    "tax": 1.0,
+    "taxes": 1.0,
+    "taxation": 1.0,
+    "taxable": 1.0,
+    "tax preparation": 1.0,
+    "tax filing": 1.0,
+    "tax return": 1.0,
+    "tax returns": 1.0,
+    "filing": 1.0,
+    "irs": 1.0,
+    "1040": 1.0,
+    "1065": 1.0,
+    "1120": 1.0,
+    "1120-s": 1.0,
+    "e-file": 1.0,
+    # One filing phrase ("file a return", "file our returns") is enough on its own
+    "file": 0.5,
+    "filed": 0.5,
+    "return": 0.5,
+    "returns": 0.5,
+    "deduction": 0.5,
+    "deductions": 0.5,
+}
+
+# Summed keyword weight at which a text counts as tax-related
+TAX_THRESHOLD = float(os.getenv("TAX_THRESHOLD", "1.0"))
+# Distinct inputs whose classification is kept in memory
+CLASSIFIER_CACHE_SIZE = int(os.getenv("TAX_CLASSIFIER_CACHE_SIZE", "4096"))
+
+
+def parse_keywords(spec):
+    """Parse ``"tax:1,filing:1,file:0.5"`` into a keyword -> weight dict."""
+    keywords = {}
+    for item in spec.split(","):
+        keyword, separator, weight = item.strip().rpartition(":")
+        if not separator:
+            keyword, weight = weight, "1"
+        if keyword:
+            keywords[keyword.lower()] = float(weight or 1)
+    return keywords
+
+
+def compile_keywords(keywords):
+    # Longest first so "tax preparation" is matched as a whole before "tax" and "1120-S" before "1120"
+    alternation = "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternation})\b", re.I)
+
+
+TAX_KEYWORDS = parse_keywords(os.environ["TAX_KEYWORDS"]) if os.getenv("TAX_KEYWORDS") else DEFAULT_TAX_KEYWORDS
+TAX_PATTERN = compile_keywords(TAX_KEYWORDS)
+
+
+def tax_score(user_input):
+    """Summed weight of the distinct tax keywords in ``user_input``."""
+    matches = {match.lower() for match in TAX_PATTERN.findall(user_input)}
+    return sum(TAX_KEYWORDS[match] for match in matches)
+
+
+@cached(LRUCache(maxsize=CLASSIFIER_CACHE_SIZE), lock=threading.Lock())
+def is_tax_related(user_input):
+    """Check if the user input relates to tax services."""
+    return tax_score(user_input) >= TAX_THRESHOLD
+
+
+def tax_scores_batch(texts):
+    """Return a float array with the tax score of every text in ``texts``."""
+    texts = pd.Series(list(texts), dtype="object").fillna("")
+    found = texts.str.findall(TAX_PATTERN).explode().dropna().str.lower()
+    # Count each keyword once per text, like tax_score
+    pairs = pd.DataFrame({"row": found.index, "keyword": found.to_numpy()}).drop_duplicates()
+    scores = np.zeros(len(texts))
+    np.add.at(scores, pairs["row"].to_numpy(dtype=int), pairs["keyword"].map(TAX_KEYWORDS).to_numpy(dtype=float))
+    return scores
+
+
+def classify_batch(texts):
+    """Vectorized is_tax_related: a boolean array for a list or Series of texts."""
+    return tax_scores_batch(texts) >= TAX_THRESHOLD